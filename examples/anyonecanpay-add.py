@@ -12,7 +12,7 @@ def main():
 
     for spend_hash in sys.argv[2:]:
         spend_hash = pyspv.hexstring_to_bytes(spend_hash)
-        spend = spv.wallet.spends[spend_hash]['spend']
+        spend = spv.wallet.get_spend(spend_hash)
 
         for input_creator in spend.create_input_creators(spv, pyspv.transaction.Transaction.SIGHASH_ALL | pyspv.transaction.Transaction.SIGHASH_ANYONECANPAY):
             tx.inputs.append(pyspv.transaction.UnsignedTransactionInput(input_creator))
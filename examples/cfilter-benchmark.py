@@ -0,0 +1,71 @@
+import os
+import time
+
+import pyspv
+
+from pyspv.block import Block, BlockHeader
+from pyspv.cfilter import FilterQuery, GCSFilter, local_filter_items, siphash
+from pyspv.script import Script
+from pyspv.transaction import Transaction, TransactionInput, TransactionOutput, TransactionPrevOut
+
+BLOCK_COUNT        = 10
+TRANSACTION_COUNT  = 2000
+OUTPUTS_PER_TX     = 2
+
+# Scripts in the wallet matched against each filter, and how many times each filter is matched
+WALLET_SCRIPTS     = 200
+MATCH_ROUNDS       = 10
+
+def make_block():
+    # Spending a random prevout to P2PKH outputs to random addresses
+    transactions = []
+    for _ in range(TRANSACTION_COUNT):
+        inputs = [TransactionInput(prevout=TransactionPrevOut(os.urandom(32), 0), script=Script())]
+        outputs = [TransactionOutput(amount=1, script=Script(b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac')) for _ in range(OUTPUTS_PER_TX)]
+        transactions.append(Transaction(pyspv.Bitcoin, inputs=inputs, outputs=outputs))
+
+    header = BlockHeader(pyspv.Bitcoin, prev_block_hash=os.urandom(32))
+    return Block(pyspv.Bitcoin, header=header, transactions=transactions)
+
+def build_one_at_a_time(items, block_hash):
+    # Hashing each item separately, for comparison with GCSFilter.build
+    gcs = GCSFilter(block_hash, len(items), b'')
+    return sorted((siphash(gcs.k0, gcs.k1, item) * gcs.n * GCSFilter.M) >> 64 for item in items)
+
+def main():
+    print("Making {} blocks with {} transactions each...".format(BLOCK_COUNT, TRANSACTION_COUNT))
+    blocks = [make_block() for _ in range(BLOCK_COUNT)]
+
+    start = time.time()
+    block_items = [local_filter_items(block) for block in blocks]
+    items_time = time.time() - start
+
+    start = time.time()
+    filters = [GCSFilter.build(items, block.header.hash()) for block, items in zip(blocks, block_items)]
+    build_time = time.time() - start
+
+    start = time.time()
+    for block, items in zip(blocks, block_items):
+        build_one_at_a_time(items, block.header.hash())
+    slow_time = time.time() - start
+
+    query = FilterQuery([b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac' for _ in range(WALLET_SCRIPTS)])
+    start = time.time()
+    for _ in range(MATCH_ROUNDS):
+        for gcs in filters:
+            query.matches(gcs)
+    match_time = (time.time() - start) / (MATCH_ROUNDS * BLOCK_COUNT)
+
+    total_items = sum(len(items) for items in block_items)
+    total_size = sum(len(gcs.serialize()) for gcs in filters)
+
+    print("collecting items: {:.1f}ms per block".format(items_time * 1000 / BLOCK_COUNT))
+    print("building filters: {:.1f}ms per block ({:.0f} items/s), {:.1f} bytes per item".format(build_time * 1000 / BLOCK_COUNT, total_items / build_time, total_size / total_items))
+    print("hashing items one at a time: {:.1f}ms per block".format(slow_time * 1000 / BLOCK_COUNT))
+    print("matching {} wallet scripts: {:.1f}ms per filter ({:.0f} filters/s, NumPy {})".format(WALLET_SCRIPTS, match_time * 1000, 1 / match_time, 'on' if pyspv.cfilter.numpy is not None else 'off'))
+
+    for block, items, gcs in zip(blocks, block_items, filters):
+        assert list(gcs.decode()) == build_one_at_a_time(items, block.header.hash())
+
+if __name__ == "__main__":
+    main()
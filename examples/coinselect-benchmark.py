@@ -0,0 +1,45 @@
+import random
+import time
+
+import pyspv
+
+from pyspv import coinselect
+from pyspv.wallet import Wallet
+
+SPEND_COUNTS = (10000, 100000)
+
+# The old selection is much slower, so it only gets this many passes (instead of 1000) for the larger wallet
+APPROXIMATE_ITERATIONS = { 10000: 1000, 100000: 100 }
+
+class BenchmarkWallet:
+    # Just enough for Wallet.approximate_best_subset
+    class spv:
+        logging_level = pyspv.WARNING
+
+def main():
+    for count in SPEND_COUNTS:
+        # Lots of small coins, like a wallet that receives many small payments
+        amounts = sorted(random.randint(pyspv.Bitcoin.DUST_LIMIT, 100 * pyspv.Bitcoin.DUST_LIMIT) for _ in range(count))
+        target = sum(amounts) // 3 + 12345
+
+        print("{} spends, target {}".format(count, pyspv.Bitcoin.format_money(target)))
+
+        iterations = APPROXIMATE_ITERATIONS[count]
+        start = time.time()
+        r = Wallet.approximate_best_subset(BenchmarkWallet(), amounts, target, iterations)
+        print("  approximate_best_subset ({} passes): {:.3f}s, {} over".format(iterations, time.time() - start, sum(amounts[i] for i in r) - target))
+
+        start = time.time()
+        r = coinselect.branch_and_bound(amounts, target, pyspv.Bitcoin.DUST_LIMIT)
+        print("  branch_and_bound: {:.3f}s, {}".format(time.time() - start, 'no match' if r is None else '{} over'.format(sum(amounts[i] for i in r) - target)))
+
+        start = time.time()
+        r = coinselect.random_subsets(amounts, target)
+        print("  random_subsets ({}): {:.3f}s, {} over".format('numpy' if coinselect.numpy is not None else 'python', time.time() - start, sum(amounts[i] for i in r) - target))
+
+        start = time.time()
+        r = coinselect.select_subset(amounts, target, pyspv.Bitcoin.DUST_LIMIT)
+        print("  select_subset: {:.3f}s, {} over".format(time.time() - start, sum(amounts[i] for i in r) - target))
+
+if __name__ == "__main__":
+    main()
@@ -108,7 +108,9 @@ def sendspendtoaddress(spend_hash, address, amount, memo=''):
     }
 
 @exception_printer
-def getbalance():
+def getbalance(by_state=False):
+    if str(by_state).lower() in ('1', 'true'):
+        return dict((k, dict((state, spv.coin.format_money(v)) for state, v in states.items())) for k, states in spv.wallet.get_balances().items())
     return dict((k, spv.coin.format_money(v)) for k, v in spv.wallet.balance.items())
 
 @exception_printer
@@ -118,9 +120,9 @@ def getnewaddress(label='', compressed=False):
     else:
         compressed = False
 
-    pk = pyspv.keys.PrivateKey.create_new()
-    spv.wallet.add('private_key', pk, {'label': label})
-    return pk.get_public_key(compressed).as_address(spv.coin)
+    pk = spv.new_private_key(label)
+    _, _, address = spv.wallet.public_key_cache.get(pk, compressed)
+    return address
 
 @exception_printer
 def getnewstealthaddress(label=''):
@@ -128,6 +130,12 @@ def getnewstealthaddress(label=''):
     spv.wallet.add('private_key', pk, {'label': label, 'stealth_payments': True})
     return pyspv.base58_check(spv.coin, pk.get_public_key(True).pubkey, version_bytes=spv.coin.STEALTH_ADDRESS_VERSION_BYTES, suffix_bytes=spv.coin.STEALTH_ADDRESS_SUFFIX_BYTES)
 
+@exception_printer
+def watchxpub(xpub, label=''):
+    '''Watch the addresses of a BIP32 extended public key. ExtendedPublicKeyPaymentMonitor has to be included for this to work'''
+    spv.wallet.add('xpub', pyspv.bip32.ExtendedPublicKey.from_string(xpub, spv.coin), {'label': label, 'used_index': -1})
+    return 'watching {}'.format(xpub)
+
 @exception_printer
 def getnewpubkey(label='', compressed=False):
     if str(compressed).lower() in ('1', 'true'):
@@ -135,9 +143,9 @@ def getnewpubkey(label='', compressed=False):
     else:
         compressed = False
 
-    pk = pyspv.keys.PrivateKey.create_new()
-    spv.wallet.add('private_key', pk, {'label': label})
-    return pk.get_public_key(compressed).as_hex()
+    pk = spv.new_private_key(label)
+    public_key, _, _ = spv.wallet.public_key_cache.get(pk, compressed)
+    return public_key.as_hex()
 
 @exception_printer
 def listspends(include_spent=False):
@@ -152,12 +160,13 @@ def listspends(include_spent=False):
     else:
         include_spent = False
 
-    def f(spend):
+    def f(spend, state, confirmations):
         r = {
             'id': pyspv.bytes_to_hexstring(spend.hash()),
             'class': spend.__class__.__name__,
             'amount': spv.coin.format_money(spend.amount),
-            'confirmations': spend.get_confirmations(spv),
+            'state': state,
+            'confirmations': confirmations,
         }
 
         if hasattr(spend, 'prevout'):
@@ -171,17 +180,18 @@ def listspends(include_spent=False):
 
         return r
 
-    for spend in spv.wallet.spends.values():
-        is_spent = spend['spend'].is_spent(spv)
-        if not include_spent and is_spent:
+    # The wallet keeps each spend's state and height, so nothing has to be asked of the spends themselves
+    for spend in spv.wallet.get_spends():
+        state, confirmations, spendable = spv.wallet.get_spend_state(spend.hash())
+        if not include_spent and state == 'spent':
             continue
 
-        if is_spent:
-            result['spent'].append(f(spend['spend']))
-        elif spend['spend'].is_spendable(spv):
-            result['spendable'].append(f(spend['spend']))
+        if state == 'spent':
+            result['spent'].append(f(spend, state, confirmations))
+        elif spendable:
+            result['spendable'].append(f(spend, state, confirmations))
         else:
-            result['not_spendable'].append(f(spend['spend']))#str(spend['spend']) + ', confirmations={}'.format(spend['spend'].get_confirmations(spv)))
+            result['not_spendable'].append(f(spend, state, confirmations))
 
     return result
     #return 'Spendable:\n' + '\n'.join(spendable) + '\nNot Spendable ({} confirmations required):\n'.format(spv.coin.TRANSACTION_CONFIRMATION_DEPTH) + '\n'.join(not_spendable)
@@ -222,9 +232,9 @@ def genmultisig(nreq, mtotal, *pubkeys):
 
     # Create new keys if necessary
     while len(pubkeys) < mtotal:
-        pk = pyspv.keys.PrivateKey.create_new()
-        spv.wallet.add('private_key', pk, {'label': ''})
-        pubkeys.append(pk.get_public_key(compressed=True).as_hex())
+        pk = spv.new_private_key()
+        public_key, _, _ = spv.wallet.public_key_cache.get(pk, True)
+        pubkeys.append(public_key.as_hex())
 
     pubkeys = [pyspv.keys.PublicKey.from_hex(pubkey) for pubkey in pubkeys]
     pubkeys.sort()
@@ -283,6 +293,7 @@ def server_main():
     rpc_server.register_function(getnewaddress)
     rpc_server.register_function(getnewstealthaddress)
     rpc_server.register_function(getnewpubkey)
+    rpc_server.register_function(watchxpub)
     rpc_server.register_function(getbalance)
     rpc_server.register_function(sendtoaddress)
     rpc_server.register_function(sendspendtoaddress)
@@ -0,0 +1,49 @@
+import hashlib
+import time
+
+import pyspv
+
+from pyspv.keys import PrivateKey, PublicKey
+from pyspv.stealthscan import StealthScanner
+
+STEALTH_KEY_COUNT    = 100
+EPHEMERAL_KEY_COUNT  = 50
+
+def scan_one_at_a_time(stealth_keys, ephemeral_keys):
+    # The way the stealth monitor used to find payments, for comparison
+    r = {}
+    for ephemeral_key in ephemeral_keys:
+        for stealth_key in stealth_keys:
+            shared_secret = int.from_bytes(hashlib.sha256(PublicKey(ephemeral_key).multiply(stealth_key.as_int()).pubkey).digest(), 'big')
+            payment_key = stealth_key.add_constant(shared_secret)
+            r[payment_key.get_public_key(True).as_hash160(pyspv.Bitcoin)] = (stealth_key, shared_secret)
+    return r
+
+def main():
+    stealth_keys = [PrivateKey.create_new() for _ in range(STEALTH_KEY_COUNT)]
+    ephemeral_keys = [PrivateKey.create_new().get_public_key(True).pubkey for _ in range(EPHEMERAL_KEY_COUNT)]
+    scans = STEALTH_KEY_COUNT * EPHEMERAL_KEY_COUNT
+
+    print("Scanning {} ephemeral keys against {} stealth keys...".format(EPHEMERAL_KEY_COUNT, STEALTH_KEY_COUNT))
+
+    start = time.time()
+    expected = scan_one_at_a_time(stealth_keys, ephemeral_keys)
+    print("one at a time: {:.0f} scans/s".format(scans / (time.time() - start)))
+
+    for processes in (1, None):
+        scanner = StealthScanner(pyspv.Bitcoin, processes=processes)
+        for stealth_key in stealth_keys:
+            scanner.add_key(stealth_key)
+
+        # The first parallel scan starts the worker processes
+        scanner.scan(ephemeral_keys)
+
+        start = time.time()
+        r = scanner.scan(ephemeral_keys)
+        print("scanner with {} process(es): {:.0f} scans/s".format(scanner.processes, scans / (time.time() - start)))
+
+        assert r == expected
+        scanner.close()
+
+if __name__ == "__main__":
+    main()
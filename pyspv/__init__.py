@@ -3,10 +3,14 @@ import ipaddress
 import sys
 import time
 
+from . import bip32
 from . import blockchain
+from . import blockstore
 from . import inv
+from . import keypool
 from . import keys
 from . import network
+from . import rescan
 from . import script
 from . import transaction
 from . import transactionbuilder
@@ -24,6 +28,8 @@ from .payments.multisig import MultisigScriptHashPayment
 from .monitors.stealth import StealthAddressPaymentMonitor
 from .payments.stealth import StealthAddressPayment
 
+from .monitors.xpub import ExtendedPublicKeyPaymentMonitor
+
 from .util import *
 
 VERSION = 'pyspv 0.0.1-alpha1'
@@ -49,9 +55,38 @@ class pyspv:
     :type tor: boolean
     :param sync_block_start: specify the block number to start syncing at
     :type sync_block_start: integer or None
+    :param serve_blockchain: answer getheaders/getblocks from peers, so other instances can sync from this one
+    :type serve_blockchain: boolean
+    :param static_peers: peers to always try to connect to first, such as a local instance with serve_blockchain enabled
+    :type static_peers: list of tuple (string, integer)
+    :param compact_filters: sync with compact block filters (BIP157/158) instead of downloading every block.  Only blocks
+                            whose filters match the wallet are downloaded.  Stealth payments can't be detected this way.
+    :type compact_filters: boolean
+    :param serve_filters: build a compact filter for each full block received and answer getcfilters/getcfheaders
+                          from peers (implies serve_blockchain).  The filters have output scripts and spent prevouts,
+                          and are only used by pyspv instances that have this one as a static peer.
+    :type serve_filters: boolean
+    :param block_scan_processes: number of worker processes used to find the transactions in each block that the wallet
+                                 cares about, before they're unserialized and run through the monitors, and to check
+                                 stealth payments against our stealth keys.  1 scans in this process and None uses one
+                                 process per CPU.
+    :type block_scan_processes: integer or None
+    :param block_store: keep the full blocks we download on disk, so the wallet can be rescanned without downloading
+                        them again, and serve them to peers
+    :type block_store: boolean
+    :param block_store_depth: only keep (about) this many of the most recent blocks in the block store
+    :type block_store_depth: integer or None
+    :param block_store_size: keep the block store under (about) this many bytes
+    :type block_store_size: integer or None
+    :param wallet_snapshot: save a snapshot of the wallet's spends at shutdown and start from it next time, instead of
+                            loading every spend (see :py:class:`pyspv.wallet.Wallet`)
+    :type wallet_snapshot: boolean
+    :param key_pool_size: keep this many keys generated ahead of time in the wallet, for :py:attr:`key_pool` to hand
+                          out, and refill it in the background when it's half empty.  0 disables the key pool.
+    :type key_pool_size: integer
     '''
 
-    def __init__(self, app_name, testnet=False, peer_goal=8, logging_level=WARNING, listen=('', 0), coin=Bitcoin, tor=False, sync_block_start=None):
+    def __init__(self, app_name, testnet=False, peer_goal=8, logging_level=WARNING, listen=('', 0), coin=Bitcoin, tor=False, sync_block_start=None, serve_blockchain=False, static_peers=(), compact_filters=False, serve_filters=False, block_scan_processes=1, block_store=False, block_store_depth=None, block_store_size=None, wallet_snapshot=False, key_pool_size=0):
         self.app_name = app_name
         self.time_offset = 0
         self.logging_level = logging_level
@@ -69,10 +104,48 @@ class pyspv:
 
         if self.args.sync_block_start is not None:
             self.sync_block_start = self.args.sync_block_start
+
+        if self.args.serve_blockchain:
+            serve_blockchain = True
+
+        if self.args.compact_filters:
+            compact_filters = True
+
+        if self.args.serve_filters:
+            serve_filters = True
+
+        if self.args.block_scan_processes is not None:
+            block_scan_processes = None if self.args.block_scan_processes < 0 else self.args.block_scan_processes
+
+        if self.args.block_store:
+            block_store = True
+
+        if self.args.block_store_depth is not None:
+            block_store_depth = self.args.block_store_depth
+            block_store = True
+
+        if self.args.block_store_size is not None:
+            block_store_size = self.args.block_store_size * 1024 * 1024
+            block_store = True
+
+        if self.args.wallet_snapshot:
+            wallet_snapshot = True
+
+        if self.args.key_pool_size is not None:
+            key_pool_size = self.args.key_pool_size
+
+        if serve_filters:
+            # Filter clients need our headers too
+            serve_blockchain = True
+
+        self.compact_filters = compact_filters
+        self.block_scan_processes = block_scan_processes
             
         self.testnet = testnet
         self.coin = coin.Testnet if testnet else coin
 
+        static_peers = list(static_peers) + [(addr, self.coin.DEFAULT_PORT if port is None else port) for addr, port in self.args.addnode]
+
         self.config = Config(app_name, self.coin, testnet=testnet)
 
         if self.logging_level <= DEBUG:
@@ -83,10 +156,16 @@ class pyspv:
         self.blockchain = blockchain.Blockchain(spv=self)
         self.txdb = txdb.TransactionDatabase(spv=self)
 
-        self.wallet = wallet.Wallet(spv=self, monitors=[PubKeyPaymentMonitor, MultisigScriptHashPaymentMonitor, StealthAddressPaymentMonitor])
+        self.blockstore = blockstore.BlockStore(spv=self, max_depth=block_store_depth, max_size=block_store_size) if block_store else None
+
+        self.wallet = wallet.Wallet(spv=self, monitors=[PubKeyPaymentMonitor, MultisigScriptHashPaymentMonitor, StealthAddressPaymentMonitor, ExtendedPublicKeyPaymentMonitor], block_scan_processes=block_scan_processes, snapshot=wallet_snapshot)
         self.wallet.load()
 
-        self.network_manager = network.Manager(spv=self, peer_goal=peer_goal, listen=listen, tor=tor, user_agent=VERSION)
+        self.key_pool = keypool.KeyPool(self, size=key_pool_size) if key_pool_size > 0 else None
+        if self.key_pool is not None:
+            self.key_pool.start()
+
+        self.network_manager = network.Manager(spv=self, peer_goal=peer_goal, listen=listen, tor=tor, user_agent=VERSION, serve_blockchain=serve_blockchain, static_peers=static_peers, compact_filters=compact_filters, serve_filters=serve_filters)
         self.network_manager.start()
 
     def __parse_arguments(self):
@@ -96,9 +175,34 @@ class pyspv:
         parser.add_argument('--tor', action='store_const', default=False, const=True)
         parser.add_argument('--torproxy', type=str, default=None, help='specify tor proxy (default 127.0.0.1:9050, implies --tor)')
         parser.add_argument('--sync-block-start', type=int, default=None, help='specify the block number at which to start downloading full blocks')
+        parser.add_argument('--serve-blockchain', action='store_const', default=False, const=True, help='answer getheaders/getblocks so other instances can sync from this one')
+        parser.add_argument('--compact-filters', action='store_const', default=False, const=True, help='sync using compact block filters instead of full blocks')
+        parser.add_argument('--serve-filters', action='store_const', default=False, const=True, help='build compact filters for received blocks and serve them to peers (implies --serve-blockchain)')
+        parser.add_argument('--block-scan-processes', type=int, default=None, help='scan blocks for wallet transactions and stealth payments with this many worker processes (default 1, -1 for one per CPU)')
+        parser.add_argument('--block-store', action='store_const', default=False, const=True, help='keep downloaded blocks on disk for rescans and serving them to peers')
+        parser.add_argument('--block-store-depth', type=int, default=None, help='only keep this many recent blocks in the block store (implies --block-store)')
+        parser.add_argument('--block-store-size', type=int, default=None, help='keep the block store under this many MB (implies --block-store)')
+        parser.add_argument('--wallet-snapshot', action='store_const', default=False, const=True, help='start the wallet from a snapshot of its spends saved at the last shutdown')
+        parser.add_argument('--key-pool-size', type=int, default=None, help='keep this many new keys ready to hand out (default 0, no key pool)')
+        parser.add_argument('--addnode', type=str, action='append', default=[], help='always try to connect to this peer (ip:port), may be given more than once')
         args, remaining = parser.parse_known_args()
         sys.argv = [sys.argv[0]] + remaining
 
+        addnodes = []
+        for addnode in args.addnode:
+            if ':' in addnode:
+                addr, port = addnode.split(':')
+                port = int(port)
+            else:
+                addr = addnode
+                port = None
+
+            # Raise an exception if the provided address is invalid
+            ipaddress.IPv4Address(addr)
+            assert port is None or 0 <= port <= 65535
+            addnodes.append((addr, port))
+        args.addnode = addnodes
+
         if args.torproxy is not None:
             if ':' in args.torproxy:
                 addr, port = args.torproxy.split(':')
@@ -122,10 +226,15 @@ class pyspv:
 
         After calling :py:meth:`~pyspv.shutdown`, you may call :py:meth:`~pyspv.join` to block on shutdown.'''
         self.network_manager.shutdown()
+        if self.key_pool is not None:
+            self.key_pool.shutdown()
     
     def join(self):
         '''Block until shutdown is complete.  If :py:meth:`~pyspv.shutdown` hasn't been called yet, this function will block forever.'''
         self.network_manager.join()
+        if self.key_pool is not None:
+            self.key_pool.join()
+        self.wallet.save_snapshot()
 
     def adjusted_time(self):
         '''
@@ -149,6 +258,16 @@ class pyspv:
                 # TODO - we should inform the app that we can't get good time data
                 self.time_offset = 0
 
+    def new_private_key(self, label=''):
+        '''Returns a new private key that's been added to the wallet with *label*.  Comes from the key pool when there is
+        one, otherwise the key is created and added to the wallet right away.'''
+        if self.key_pool is not None:
+            return self.key_pool.take(label=label)
+
+        private_key = keys.PrivateKey.create_new()
+        self.wallet.add('private_key', private_key, {'label': label})
+        return private_key
+
     def new_transaction_builder(self, memo=''):
         '''Creates a new transaction builder.
 
@@ -169,6 +288,36 @@ class pyspv:
         tx_inv = inv.Inv(inv.Inv.MSG_TX, tx.hash())
         self.network_manager.add_to_inventory(tx_inv, tx, network.Manager.INVENTORY_FLAG_MUST_CONFIRM if must_confirm else 0)
 
+    def rescan(self, from_height=None, to_height=None, items=None, progress=None):
+        '''Scans the main chain blocks from *from_height* to *to_height* again for payments to wallet items that were added
+        after those blocks were seen, such as an imported private key.  The rescan runs in the background while everything
+        else keeps running.
+
+        :param from_height: the first block to scan, or None to start a day before the earliest birthday of the items
+                            (see :py:meth:`pyspv.wallet.Wallet.add`)
+        :type from_height: integer or None
+        :param to_height: the last block to scan, or None for the current best chain height
+        :type to_height: integer or None
+        :param items: the wallet items to look for, or None to look for every item in the wallet
+        :type items: list of tuple (collection_name, item)
+        :param progress: called with (height, from_height, to_height) after each block is scanned
+        :type progress: function or None
+        :returns: Returns the started :py:class:`pyspv.rescan.Rescan`, which can be joined or cancelled
+        :raises pyspv.rescan.RescanRangeUnavailable: if some of the blocks aren't in the block store and are too old to
+                                                     be downloaded again
+        '''
+        if from_height is None:
+            timestamp = self.wallet.get_earliest_birthday(items) - (24 * 60 * 60)
+            from_height = self.blockchain.get_height_at_time(timestamp)
+            if from_height is None and self.blockstore is not None:
+                from_height = self.blockstore.get_height_at_time(timestamp)
+            if from_height is None:
+                raise rescan.RescanRangeUnavailable("the blocks from before the items' birthday aren't in the block store or the blockchain in memory")
+
+        r = rescan.Rescan(self, from_height, to_height=to_height, items=items, progress=progress, processes=self.wallet.block_scanner.processes)
+        r.start()
+        return r
+
     def on_tx(self, tx):
         '''Called for every transaction seen on the network, not including those found in blocks.
 
@@ -188,6 +337,9 @@ class pyspv:
         self.wallet.on_block(block)
         self.txdb.on_block(block)
 
+        if self.blockstore is not None:
+            self.blockstore.on_block(block)
+
     def on_block_added(self, block_header, block_height):
         '''Called when the blockchain is extended to a height of *block_height* with the block specified by *block_header*.
 
@@ -200,6 +352,11 @@ class pyspv:
            new link in the blockchain.  
         '''
         self.txdb.on_block_added(block_header, block_height)
+        self.wallet.on_block_added(block_header, block_height)
+        self.network_manager.on_block_added(block_header, block_height)
+
+        if self.blockstore is not None:
+            self.blockstore.on_block_added(block_header, block_height)
 
     def on_block_removed(self, block_header, block_height):
         '''Called when the blockchain is reduced from a height of *block_height* by removing the block specified by *block_header*.
@@ -208,4 +365,9 @@ class pyspv:
         will not function properly.
         '''
         self.txdb.on_block_removed(block_header, block_height)
+        self.wallet.on_block_removed(block_header, block_height)
+        self.network_manager.on_block_removed(block_header, block_height)
+
+        if self.blockstore is not None:
+            self.blockstore.on_block_removed(block_header, block_height)
 
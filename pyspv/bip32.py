@@ -0,0 +1,102 @@
+import hashlib
+import hmac
+import struct
+
+from . import base58
+from .keys import PublicKey, secp256k1_order
+from .util import *
+
+class InvalidExtendedKey(Exception):
+    pass
+
+class InvalidChildIndex(Exception):
+    '''Raised for the (roughly 1 in 2^127) child indexes that BIP32 says to skip'''
+    pass
+
+class ExtendedPublicKey:
+    '''
+    A BIP32 extended public key (an "xpub").  Children are derived with CKDpub, so only non-hardened children can be
+    derived, and no private key is ever needed.  Used to watch the addresses of a wallet whose keys are kept elsewhere,
+    see :py:class:`pyspv.monitors.xpub.ExtendedPublicKeyPaymentMonitor`.
+    '''
+
+    HARDENED = 0x80000000
+
+    def __init__(self, public_key, chain_code, depth=0, parent_fingerprint=b'\x00\x00\x00\x00', child_number=0):
+        assert public_key.is_compressed() and len(chain_code) == 32
+        self.public_key = public_key
+        self.chain_code = chain_code
+        self.depth = depth
+        self.parent_fingerprint = parent_fingerprint
+        self.child_number = child_number
+
+    def __hash__(self):
+        return hash((self.public_key.pubkey, self.chain_code))
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, ExtendedPublicKey) and self.public_key == other.public_key and self.chain_code == other.chain_code)
+
+    def get_fingerprint(self, coin):
+        return self.public_key.as_hash160(coin)[:4]
+
+    def derive_child_public_key(self, i):
+        '''Returns the public key of child i.  Raises InvalidChildIndex if BIP32 says to skip i.'''
+        if i & ExtendedPublicKey.HARDENED:
+            raise InvalidChildIndex("hardened children can't be derived from a public key")
+
+        I = hmac.new(self.chain_code, self.public_key.pubkey + struct.pack('>L', i), hashlib.sha512).digest()
+        c = int.from_bytes(I[:32], 'big')
+        if c >= secp256k1_order:
+            raise InvalidChildIndex("child {} is invalid".format(i))
+
+        # parent + c * generator, compressed like the parent
+        return self.public_key.add_constant(c), I[32:]
+
+    def derive_child(self, i, coin):
+        '''Returns the ExtendedPublicKey of child i'''
+        public_key, chain_code = self.derive_child_public_key(i)
+        return ExtendedPublicKey(public_key, chain_code, depth=self.depth + 1, parent_fingerprint=self.get_fingerprint(coin), child_number=i)
+
+    def derive_public_keys(self, start, count):
+        '''Returns a list of (i, public key) for the children from start to start+count-1, leaving out the ones that BIP32
+        says to skip'''
+        public_keys = []
+        for i in range(start, start + count):
+            try:
+                public_key, _ = self.derive_child_public_key(i)
+            except InvalidChildIndex:
+                continue
+            public_keys.append((i, public_key))
+        return public_keys
+
+    def as_string(self, coin):
+        data = bytes([self.depth]) + self.parent_fingerprint + struct.pack('>L', self.child_number) + self.chain_code + self.public_key.pubkey
+        return base58_check(coin, data, version_bytes=coin.EXTENDED_PUBLIC_KEY_VERSION_BYTES)
+
+    def __str__(self):
+        return '<ExtendedPublicKey {} depth={} child={}>'.format(self.public_key.as_hex(), self.depth, self.child_number)
+
+    @staticmethod
+    def from_string(s, coin):
+        try:
+            data = int.to_bytes(base58.decode(s), coin.EXTENDED_KEY_BYTE_LENGTH, 'big')
+        except (ValueError, OverflowError):
+            raise InvalidExtendedKey("Extended key is not valid base58 or has the wrong length")
+
+        k = len(coin.EXTENDED_PUBLIC_KEY_VERSION_BYTES)
+        if data[:k] != coin.EXTENDED_PUBLIC_KEY_VERSION_BYTES:
+            raise InvalidExtendedKey("Extended key version is incorrect")
+
+        if coin.hash(data[:-4])[:4] != data[-4:]:
+            raise InvalidExtendedKey("Extended key checksum is incorrect")
+
+        data = data[k:-4]
+        depth = data[0]
+        parent_fingerprint = data[1:5]
+        child_number = struct.unpack('>L', data[5:9])[0]
+        chain_code = data[9:41]
+        pubkey = data[41:74]
+        if pubkey[0] not in (0x02, 0x03):
+            raise InvalidExtendedKey("Extended key doesn't hold a compressed public key")
+
+        return ExtendedPublicKey(PublicKey(pubkey), chain_code, depth=depth, parent_fingerprint=parent_fingerprint, child_number=child_number)
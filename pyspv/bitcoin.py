@@ -17,6 +17,8 @@ class Bitcoin:
     STEALTH_ADDRESS_VERSION_BYTES = b'\x09'
     STEALTH_ADDRESS_SUFFIX_BYTES  = b'\x00\x00'
     STEALTH_ADDRESS_BYTE_LENGTH   = 40 # 33 byte compressed pubkey + 1 version byte + 2 suffix bytes + 4 for checksum
+    EXTENDED_PUBLIC_KEY_VERSION_BYTES = b'\x04\x88\xb2\x1e'
+    EXTENDED_KEY_BYTE_LENGTH          = 82 # 4 version bytes + 74 bytes of key data + 4 for checksum
     
     NETWORK_MAGIC              = bytes([0xF9, 0xBE, 0xB4, 0xD9]) 
 
@@ -157,6 +159,7 @@ class BitcoinTestnet(Bitcoin):
     P2SH_ADDRESS_VERSION_BYTES    = bytes([196])
     PRIVATE_KEY_VERSION_BYTES     = bytes([0x6f + 0x80])
     STEALTH_ADDRESS_VERSION_BYTES = bytes([0x09 + 0x80])
+    EXTENDED_PUBLIC_KEY_VERSION_BYTES = b'\x04\x35\x87\xcf'
     NETWORK_MAGIC                 = bytes([0x0B, 0x11, 0x09, 0x07])
 
     DEFAULT_PORT = 18333
@@ -61,25 +61,76 @@ class Block:
     BLOCK_DIFFICULTY_LIMIT = ((1 << 256) - 1) >> 32
     assert target_to_bits(BLOCK_DIFFICULTY_LIMIT) == 0x1d00ffff
 
-    def __init__(self, coin, header=None, transactions=None, previous_block=None):
+    def __init__(self, coin, header=None, transactions=None, previous_block=None, raw_transactions=None):
         self.coin = coin
         self.header = BlockHeader(coin) if header is None else header
-        self.transactions = [] if transactions is None else transactions
+
+        # Blocks that come from the network keep their transactions serialized in raw_transactions and each one is only
+        # unserialized when it's asked for.  Most transactions in a block don't matter to us.
+        self.raw_transactions = raw_transactions
+        if raw_transactions is not None:
+            self.__transactions = [None] * len(raw_transactions)
+        else:
+            self.__transactions = [] if transactions is None else transactions
+        self.__transaction_hashes = None
 
         self.previous_block = previous_block
         self.connected = previous_block is not None and previous_block.connected
 
+    @property
+    def transactions(self):
+        '''All of the transactions in the block.  Unserializes every one of them, see get_transaction.'''
+        if self.raw_transactions is not None and None in self.__transactions:
+            for i in range(len(self.__transactions)):
+                self.get_transaction(i)
+        return self.__transactions
+
+    def get_transaction(self, i):
+        tx = self.__transactions[i]
+        if tx is None:
+            tx, _ = Transaction.unserialize(self.raw_transactions[i], self.coin)
+            self.__transactions[i] = tx
+        return tx
+
+    def get_transaction_count(self):
+        return len(self.__transactions)
+
+    def get_transaction_hashes(self):
+        if self.__transaction_hashes is None:
+            if self.raw_transactions is not None:
+                self.__transaction_hashes = [self.coin.hash(data) for data in self.raw_transactions]
+            else:
+                self.__transaction_hashes = [tx.hash() for tx in self.__transactions]
+        return self.__transaction_hashes
+
+    def is_final(self, height, block_time):
+        '''True if every transaction in the block is final'''
+        for i in range(len(self.__transactions)):
+            # Transactions without a lock time are always final, which can be seen without unserializing them
+            if self.raw_transactions is not None and self.raw_transactions[i][-4:] == b'\x00\x00\x00\x00':
+                continue
+            if not self.get_transaction(i).is_final(height, block_time):
+                return False
+        return True
+
+    def __is_coinbase(self, i):
+        if self.raw_transactions is None:
+            return self.__transactions[i].is_coinbase()
+        # one input, spending the null prevout
+        data = self.raw_transactions[i]
+        return data[4] == 1 and data[5:41] == (b'\x00' * 32) + b'\xff\xff\xff\xff'
+
     def check(self):
-        if len(self.transactions) == 0 or self.serialize_size() > self.coin.MAX_BLOCK_SIZE:
+        if len(self.__transactions) == 0 or self.serialize_size() > self.coin.MAX_BLOCK_SIZE:
             return False
 
         if not self.header.check() or not self.header.merkle_root_hash == self.calculate_merkle_root():
             return False
 
-        if not self.transactions[0].is_coinbase():
+        if not self.__is_coinbase(0):
             return False
 
-        if not all(not tx.is_coinbase() for tx in self.transactions[1:]):
+        if any(self.__is_coinbase(i) for i in range(1, len(self.__transactions))):
             return False
 
         # We can't verify transactions inputs because we don't have a full UTXO set to check against.
@@ -87,7 +138,7 @@ class Block:
         return True
 
     def calculate_merkle_root(self):
-        hashes = [tx.hash() for tx in self.transactions]
+        hashes = list(self.get_transaction_hashes())
 
         while len(hashes) != 1:
             if (len(hashes) % 2) == 1:
@@ -105,38 +156,48 @@ class Block:
         header, data = BlockHeader.unserialize(data, coin)
 
         num_transactions, data = Serialize.unserialize_variable_int(data)
-        transactions = []
+
+        # Only find where each transaction is, see get_transaction
+        raw_transactions = []
+        offset = 0
         for i in range(num_transactions):
             try:
-                tx, data = Transaction.unserialize(data, coin)
+                size = Transaction.unserialize_size(data, offset)
             except:
                 raise BadSerializedBlock("block {} couldn't unserialize because transaction {} failed to unserialize".format(bytes_to_hexstring(header.hash()), i))
-            transactions.append(tx)
+            raw_transactions.append(data[offset:offset+size])
+            offset += size
 
-        block = Block(coin, header=header, transactions=transactions)
-        return block, data
+        block = Block(coin, header=header, raw_transactions=raw_transactions)
+        return block, data[offset:]
 
     def serialize(self):
         data_list = []
         data_list.append(self.header.serialize())
-        data_list.append(Serialize.serialize_variable_int(len(self.transactions)))
+        data_list.append(Serialize.serialize_variable_int(len(self.__transactions)))
 
-        for tx in self.transactions:
-            data_list.append(tx.serialize())
+        if self.raw_transactions is not None:
+            data_list.extend(self.raw_transactions)
+        else:
+            for tx in self.__transactions:
+                data_list.append(tx.serialize())
 
         return b''.join(data_list)
 
     def serialize_size(self):
         data_size = 0
         data_size += self.header.serialize_size()
-        data_size += Serialize.serialize_variable_int_size(len(self.transactions))
+        data_size += Serialize.serialize_variable_int_size(len(self.__transactions))
 
-        for tx in self.transactions:
-            data_size += tx.serialize_size()
+        if self.raw_transactions is not None:
+            data_size += sum(len(data) for data in self.raw_transactions)
+        else:
+            for tx in self.__transactions:
+                data_size += tx.serialize_size()
 
         return data_size
 
     def __str__(self):
-        return '<block {} ntx={}>'.format(bytes_to_hexstring(self.header.hash()), len(self.transactions))
+        return '<block {} ntx={}>'.format(bytes_to_hexstring(self.header.hash()), len(self.__transactions))
 
 
@@ -33,11 +33,19 @@ class Blockchain:
 
         self.unknown_referenced_blocks = collections.defaultdict(set)
 
+        # height -> block_link for the part of the main chain we have in memory
+        self.main_chain = {}
+        self.main_chain_height = 0
+
         with self.blockchain_lock:
             with closing(shelve.open(self.blockchain_db_file)) as db:
                 if 'needs_headers' not in db or self.spv.args.resync:
                     db['needs_headers'] = True
 
+                # With compact block filters we only ever sync headers. This is the height where checking filters starts.
+                if 'filter_start_height' not in db or self.spv.args.resync:
+                    db['filter_start_height'] = None
+
                 # Make sure sync_block_start is consistent between restarts
                 if 'sync_block_start' not in db:
                     db['sync_block_start'] = None
@@ -47,6 +55,7 @@ class Blockchain:
 
                 self.sync_block_start = db['sync_block_start']
                 self.best_chain = (checkpoint if (self.sync_block_start is None or self.sync_block_start >= checkpoint['height']) else genesis)
+                self.__index_main_chain()
 
                 if 'blockchain' not in db or self.spv.args.resync:
                     db['blockchain'] = {
@@ -56,6 +65,7 @@ class Blockchain:
                     }
 
                 self.needs_headers = db['needs_headers']
+                self.filter_start_height = db['filter_start_height']
 
                 # load blocks from db
                 start = db['blockchain']['start']
@@ -82,6 +92,7 @@ class Blockchain:
                         block_link['main'] = True
                         block_link['height'] = link['height']
                         self.best_chain = block_link
+                        self.__index_main_chain()
                     else:
                         if self.best_chain is not block_link:
                             #print("Error connecting block {}".format(str(block_link['header'])))#bytes_to_hexstring(block_link['hash'])))
@@ -91,6 +102,12 @@ class Blockchain:
                 if self.spv.logging_level <= INFO:
                     print('[BLOCKCHAIN] done ({:5.3f} sec)'.format(time.time()-start_time))
 
+                if self.spv.compact_filters and not self.needs_headers:
+                    # We were syncing full blocks before, so pick up with filters from here
+                    self.needs_headers = db['needs_headers'] = True
+                    if self.filter_start_height is None:
+                        self.filter_start_height = db['filter_start_height'] = self.best_chain['height'] + 1
+
     def create_block_link(self, hash, height=0, main=False, connected=False, prev=None, header=None, work=None):
         if work is None and header is not None:
             work = header.work()
@@ -113,6 +130,68 @@ class Blockchain:
     def get_best_chain_height(self):
         return self.best_chain['height']
 
+    def get_headers_after(self, locator_hashes, stop_hash, max_count):
+        '''Serves getheaders/getblocks: the reverse of BlockLocator. Finds the first hash in locator_hashes that's on our
+        main chain and returns up to max_count main chain headers after it, ending early at stop_hash.  Only the part of the
+        chain we have in memory can be served, so an empty list is returned if none of the locator hashes are known.'''
+        with self.blockchain_lock:
+            start_height = None
+            for block_hash in locator_hashes:
+                block_link = self.blocks.get(block_hash, None)
+                if block_link is not None and block_link['main'] and self.main_chain.get(block_link['height'], None) is block_link:
+                    start_height = block_link['height']
+                    break
+
+            if start_height is None:
+                return []
+
+            headers = []
+            for height in range(start_height + 1, min(start_height + 1 + max_count, self.main_chain_height + 1)):
+                block_link = self.main_chain.get(height, None)
+                if block_link is None:
+                    break
+                headers.append(block_link['header'])
+                if block_link['hash'] == stop_hash:
+                    break
+
+            return headers
+
+    def get_main_chain_hashes(self, start_height, stop_height):
+        '''Returns the block hashes of the main chain from start_height to stop_height inclusive, or None if we don't have
+        all of them in memory'''
+        with self.blockchain_lock:
+            block_hashes = []
+            for height in range(start_height, stop_height + 1):
+                block_link = self.main_chain.get(height, None)
+                if block_link is None:
+                    return None
+                block_hashes.append(block_link['hash'])
+            return block_hashes
+
+    def get_height_at_time(self, timestamp):
+        '''Walks back the main chain in memory and returns the height just after the last block from before timestamp, or
+        None if all of the blocks in memory are at or after timestamp'''
+        with self.blockchain_lock:
+            height = self.main_chain_height
+            while True:
+                block_link = self.main_chain.get(height, None)
+                if block_link is None or block_link['header'] is None:
+                    return None
+                if block_link['header'].timestamp < timestamp:
+                    return height + 1
+                height -= 1
+
+    def get_block_height(self, block_hash):
+        '''Returns the height of block_hash if it's in the main chain, otherwise None'''
+        with self.blockchain_lock:
+            block_link = self.blocks.get(block_hash, None)
+            if block_link is None or not block_link['main']:
+                return None
+            return block_link['height']
+
+    def get_filter_start_height(self):
+        return self.filter_start_height
+
     def get_needs_headers(self):
         with self.blockchain_lock:
             return self.needs_headers
@@ -164,7 +243,17 @@ class Blockchain:
                     changes = changes + self.__connect_block_link(blockchain, new_block_link)
                     assert self.best_chain is new_block_link
 
-                    if (self.best_chain['header'].timestamp >= self.spv.wallet.creation_time - (24 * 60 * 60)) or (self.sync_block_start is not None and self.best_chain['height'] >= self.sync_block_start):
+                    if self.spv.compact_filters and self.filter_start_height is not None:
+                        continue
+
+                    if (self.best_chain['header'].timestamp >= self.spv.wallet.get_earliest_birthday() - (24 * 60 * 60)) or (self.sync_block_start is not None and self.best_chain['height'] >= self.sync_block_start):
+                        if self.spv.compact_filters:
+                            # Keep syncing headers, the network manager fetches filters from here on
+                            if self.spv.logging_level <= INFO:
+                                print('[BLOCKCHAIN] checking compact block filters from height {}'.format(self.best_chain['height']))
+                            self.filter_start_height = db['filter_start_height'] = self.best_chain['height']
+                            continue
+
                         print('headers sync done, switching to full blocks')
                         self.needs_headers = db['needs_headers'] = False
                         break
@@ -245,7 +334,7 @@ class Blockchain:
                     # All transactions in the block have to be final
                     block = referenced_by_block_link.get('block', None)
                     if block is not None:
-                        if not all(tx.is_final(height, block_time) for tx in block.transactions):
+                        if not block.is_final(height, block_time):
                             error = "not all transactions in block are final"
                             break
 
@@ -265,7 +354,7 @@ class Blockchain:
                                 s.push_bytes(bytes(v))
                                 s = s.serialize()
 
-                                coinbase_script = block.transactions[0].inputs[0].script
+                                coinbase_script = block.get_transaction(0).inputs[0].script
                                 if coinbase_script.serialize()[:len(s)] != s:
                                     error = "coinbase doesn't have encoded block height"
                                     break
@@ -467,11 +556,26 @@ class Blockchain:
 
             changes.append(('added', notify_block_link['header'], notify_block_link['height']))
 
+        self.__index_main_chain()
+
         if self.spv.logging_level <= INFO and blockchain is not None:
             print('[BLOCKCHAIN] new best chain = {} (height={})'.format(bytes_to_hexstring(self.best_chain['hash']), self.best_chain['height']))
  
         return changes
 
+    def __index_main_chain(self):
+        # Forget heights above the new best chain (only happens if the old chain was longer)
+        for height in range(self.best_chain['height'] + 1, self.main_chain_height + 1):
+            self.main_chain.pop(height, None)
+
+        # Walk back until we reach the part of the index that's still correct
+        block_link = self.best_chain
+        while block_link is not None and self.main_chain.get(block_link['height'], None) is not block_link:
+            self.main_chain[block_link['height']] = block_link
+            block_link = block_link['prev']
+
+        self.main_chain_height = self.best_chain['height']
+
 class BlockLocator:
     def __init__(self, block_link):
         self.hashes = [block_link['hash']]
@@ -0,0 +1,126 @@
+import multiprocessing
+import threading
+
+from .script import classify_input_script, classify_output_script
+from .serialize import Serialize
+from .util import *
+
+def _key_matches(scan_keys, r):
+    if r is None or r[0] not in scan_keys:
+        return False
+    keys = scan_keys[r[0]]
+    return keys is None or r[1] in keys
+
+def match_raw_transaction(data, scan_keys, prevouts):
+    '''Returns True if the serialized transaction in data spends one of prevouts (serialized TransactionPrevOuts) or has
+    an input or output script whose classified key is in scan_keys (template -> set of keys, or None to match every
+    script with that template).  The transaction is walked in place without building a Transaction.'''
+    num_inputs, offset = Serialize.read_variable_int(data, 4)
+    for _ in range(num_inputs):
+        if data[offset:offset+36] in prevouts:
+            return True
+        script_size, offset = Serialize.read_variable_int(data, offset + 36)
+        if _key_matches(scan_keys, classify_input_script(data[offset:offset+script_size])):
+            return True
+        offset += script_size + 4
+
+    num_outputs, offset = Serialize.read_variable_int(data, offset)
+    for _ in range(num_outputs):
+        script_size, offset = Serialize.read_variable_int(data, offset + 8)
+        if _key_matches(scan_keys, classify_output_script(data[offset:offset+script_size])):
+            return True
+        offset += script_size
+
+    return False
+
+def merge_scan_keys(scan_keys):
+    '''Merges a list of scan keys (see :py:meth:`pyspv.monitors.basemonitor.BaseMonitor.get_scan_keys`) into one'''
+    merged = {}
+    for monitor_keys in scan_keys:
+        for template, keys in monitor_keys.items():
+            if keys is None or (template in merged and merged[template] is None):
+                merged[template] = None
+            else:
+                merged.setdefault(template, set()).update(keys)
+    return merged
+
+class BlockScanner:
+    '''Finds the transactions in a block that the wallet's monitors could be interested in, so that only those have to
+    be classified and run through the monitors.
+
+    The monitors' watch sets (see :py:meth:`pyspv.monitors.basemonitor.BaseMonitor.get_scan_keys`) are merged and
+    copied into a pool of worker processes, and each scan splits the block's serialized transactions across the
+    workers.  Every worker walks its share of the raw transactions and returns the indexes of the ones that match.
+    The keys only change when the wallet gets a new key or address, so the pool is only restarted then.  The
+    prevouts being watched change with almost every payment and are sent along with each scan instead.
+
+    Small blocks, and scanners with only one process, are matched in this process.
+    '''
+
+    # Blocks with fewer transactions than this are matched in this process
+    PARALLEL_SCAN_THRESHOLD = 200
+
+    # Each worker gets this many chunks of a block, so a slow chunk doesn't hold up the rest
+    CHUNKS_PER_PROCESS = 4
+
+    def __init__(self, processes=None):
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.lock = threading.Lock()
+        self.pool = None
+        self.scan_keys = {}
+        self.scan_keys_sizes = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def scan(self, raw_transactions, prevouts):
+        '''raw_transactions is a list of serialized transactions and prevouts a set of serialized TransactionPrevOuts.
+        Returns the sorted indexes of the transactions that match prevouts or the scan keys.'''
+        with self.lock:
+            if self.processes <= 1 or len(raw_transactions) < BlockScanner.PARALLEL_SCAN_THRESHOLD:
+                return [i for i, data in enumerate(raw_transactions) if match_raw_transaction(data, self.scan_keys, prevouts)]
+
+            if self.pool is None:
+                self.pool = process_pool(self.processes, _init_worker, (self.scan_keys,))
+
+            chunk_size = max(1, len(raw_transactions) // (self.processes * BlockScanner.CHUNKS_PER_PROCESS))
+            chunks = [(i, raw_transactions[i:i+chunk_size], prevouts) for i in range(0, len(raw_transactions), chunk_size)]
+
+            r = []
+            for indexes in self.pool.map(_worker_scan, chunks):
+                r.extend(indexes)
+            return r
+
+    def update_scan_keys(self, scan_keys):
+        '''scan_keys is a list of each monitor's scan keys.  Monitors only ever add keys, so if none of the sizes changed
+        since the last call the keys didn't either and the workers can be kept.'''
+        sizes = [sorted((template, None if keys is None else len(keys)) for template, keys in monitor_keys.items()) for monitor_keys in scan_keys]
+        if sizes == self.scan_keys_sizes:
+            return
+
+        with self.lock:
+            self.__set_scan_keys(scan_keys, sizes)
+
+    def __set_scan_keys(self, scan_keys, sizes):
+        # call with lock held
+        self.scan_keys = dict((template, None if keys is None else frozenset(keys)) for template, keys in merge_scan_keys(scan_keys).items())
+        self.scan_keys_sizes = sizes
+
+        # The workers have the old keys
+        self.close()
+
+# Each worker process has its own copy of the scan keys
+_worker_scan_keys = None
+
+def _init_worker(scan_keys):
+    global _worker_scan_keys
+    _worker_scan_keys = scan_keys
+
+def _worker_scan(chunk):
+    start, raw_transactions, prevouts = chunk
+    return [start + i for i, data in enumerate(raw_transactions) if match_raw_transaction(data, _worker_scan_keys, prevouts)]
@@ -0,0 +1,305 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+
+from .block import Block, BlockHeader
+from .util import *
+
+class BlockStore:
+    '''
+    Keeps the full blocks of the main chain on disk, so the wallet can be rescanned without downloading them again and
+    so they can be served to peers that ask for them with getdata.
+
+    Blocks are appended to segment files ("blocks/blk00000.dat", "blocks/blk00001.dat", ...) of about SEGMENT_SIZE
+    bytes each.  "blocks/blocks.idx" is indexed by height and holds, for each block, which segment it's in, where, and
+    its hash.  Like the filter database, the index covers a continuous run of blocks starting at the first block we
+    stored, and a reorganization truncates the index and segments back to the fork.  Segments are read through
+    memory maps.
+
+    With max_depth set only the blocks that many from the tip are kept, and with max_size the segments are kept under
+    that many bytes.  Both prune whole segments, oldest first, so a little more than asked for is kept.
+
+    Blocks are held in on_block until on_block_added puts them on the main chain, since a block might not be on the main
+    chain yet (or ever) when it arrives.
+    '''
+
+    INDEX_HEADER = struct.Struct("<L")
+    INDEX_RECORD = struct.Struct("<LQL32s")
+
+    SEGMENT_SIZE = 128 * 1024 * 1024
+
+    # Blocks that arrived but aren't part of the main chain yet
+    MAX_PENDING_BLOCKS = 20
+
+    def __init__(self, spv, max_depth=None, max_size=None):
+        self.spv = spv
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.path = self.spv.config.get_file("blocks")
+        self.index_file = os.sep.join([self.path, "blocks.idx"])
+        self.db_lock = threading.Lock()
+        self.pending_blocks = collections.OrderedDict()
+
+        # block_hash -> height for every block in the index.  The rest of the index is read from disk when needed.
+        self.block_heights = {}
+        self.start_height = None
+
+        # segment -> the first height in it, and segment -> the size of its blocks
+        self.segment_start_heights = collections.OrderedDict()
+        self.segment_sizes = {}
+
+        # segment -> mmap, created when a segment is first read
+        self.segment_maps = {}
+
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+        if self.spv.args.resync:
+            for filename in os.listdir(self.path):
+                os.remove(os.sep.join([self.path, filename]))
+
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                data = f.read()
+
+            if len(data) >= BlockStore.INDEX_HEADER.size:
+                self.start_height = BlockStore.INDEX_HEADER.unpack_from(data, 0)[0]
+
+                # Ignore a partially written record at the end
+                count = (len(data) - BlockStore.INDEX_HEADER.size) // BlockStore.INDEX_RECORD.size
+                for i in range(count):
+                    segment, offset, size, block_hash = BlockStore.INDEX_RECORD.unpack_from(data, BlockStore.INDEX_HEADER.size + i * BlockStore.INDEX_RECORD.size)
+                    self.block_heights[block_hash] = self.start_height + i
+                    if segment not in self.segment_start_heights:
+                        self.segment_start_heights[segment] = self.start_height + i
+                    self.segment_sizes[segment] = offset + size
+
+                self.__truncate(self.start_height + count)
+
+        if self.spv.logging_level <= DEBUG:
+            print('[BLOCKSTORE] {} blocks starting at height {}'.format(len(self.block_heights), self.start_height))
+
+    def get_height_range(self):
+        '''Returns (first height, next height) of the blocks in the store, or None if it's empty'''
+        with self.db_lock:
+            if self.start_height is None or len(self.block_heights) == 0:
+                return None
+            return self.start_height, self.start_height + len(self.block_heights)
+
+    def has_block(self, block_hash):
+        with self.db_lock:
+            return block_hash in self.block_heights
+
+    def get_block_data(self, block_hash):
+        '''Returns the serialized block, or None if it isn't in the store'''
+        with self.db_lock:
+            height = self.block_heights.get(block_hash, None)
+            if height is None:
+                return None
+            return self.__read_block(height)
+
+    def get_block_data_at_height(self, height):
+        '''Returns the serialized main chain block at height, or None if it isn't in the store'''
+        with self.db_lock:
+            if self.start_height is None or not (self.start_height <= height < self.start_height + len(self.block_heights)):
+                return None
+            return self.__read_block(height)
+
+    def get_height_at_time(self, timestamp):
+        '''Returns the height just after the last block in the store from before timestamp, or None if all of the blocks
+        in the store are at or after timestamp.  Block timestamps are only roughly in order, so this is approximate.'''
+        with self.db_lock:
+            if self.start_height is None or len(self.block_heights) == 0:
+                return None
+
+            # Block low is from before timestamp, the answer is in (low, high]
+            low, high = self.start_height, self.start_height + len(self.block_heights)
+            if self.__read_timestamp(low) >= timestamp:
+                return None
+
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self.__read_timestamp(middle) < timestamp:
+                    low = middle
+                else:
+                    high = middle
+            return high
+
+    def get_block(self, block_hash):
+        data = self.get_block_data(block_hash)
+        if data is None:
+            return None
+        block, _ = Block.unserialize(data, self.spv.coin)
+        return block
+
+    def on_block(self, block):
+        with self.db_lock:
+            self.pending_blocks[block.header.hash()] = block.serialize()
+            while len(self.pending_blocks) > BlockStore.MAX_PENDING_BLOCKS:
+                self.pending_blocks.popitem(last=False)
+
+    def on_block_added(self, block_header, block_height):
+        block_hash = block_header.hash()
+
+        with self.db_lock:
+            block_data = self.pending_blocks.pop(block_hash, None)
+            if block_data is None:
+                # Only a header, or a block we got before a restart
+                return
+
+            next_height = None if self.start_height is None else self.start_height + len(self.block_heights)
+            if next_height != block_height:
+                # The index has to cover a continuous run of blocks, so start over from here
+                if self.spv.logging_level <= WARNING and next_height is not None:
+                    print('[BLOCKSTORE] missing blocks {} to {}, restarting the store at height {}'.format(next_height, block_height - 1, block_height))
+                self.__reset(block_height)
+
+            # Start a new segment when the current one is full
+            segment = next(reversed(self.segment_start_heights)) if len(self.segment_start_heights) else 0
+            if self.segment_sizes.get(segment, 0) >= BlockStore.SEGMENT_SIZE:
+                segment += 1
+            if segment not in self.segment_start_heights:
+                self.segment_start_heights[segment] = block_height
+                self.segment_sizes[segment] = 0
+
+            offset = self.segment_sizes[segment]
+            with open(self.__segment_file(segment), 'ab') as f:
+                f.write(block_data)
+            with open(self.index_file, 'ab') as f:
+                f.write(BlockStore.INDEX_RECORD.pack(segment, offset, len(block_data), block_hash))
+
+            self.block_heights[block_hash] = block_height
+            self.segment_sizes[segment] = offset + len(block_data)
+
+            self.__prune(block_height)
+
+    def on_block_removed(self, block_header, block_height):
+        with self.db_lock:
+            if self.start_height is not None and block_height < self.start_height + len(self.block_heights):
+                self.__truncate(block_height)
+
+    def close(self):
+        with self.db_lock:
+            self.__close_maps()
+
+    def __segment_file(self, segment):
+        return os.sep.join([self.path, "blk{:05}.dat".format(segment)])
+
+    def __segments_on_disk(self):
+        # Including any left behind by a crash before their first block made it into the index
+        return [int(filename[3:8]) for filename in os.listdir(self.path) if filename.startswith('blk') and filename.endswith('.dat')]
+
+    def __read_record(self, height):
+        # call with db_lock held
+        with open(self.index_file, 'rb') as f:
+            f.seek(BlockStore.INDEX_HEADER.size + (height - self.start_height) * BlockStore.INDEX_RECORD.size)
+            return BlockStore.INDEX_RECORD.unpack(f.read(BlockStore.INDEX_RECORD.size))
+
+    def __read_block(self, height):
+        # call with db_lock held
+        segment, offset, size, _ = self.__read_record(height)
+
+        segment_map = self.segment_maps.get(segment, None)
+        if segment_map is None or len(segment_map) < offset + size:
+            # Not mapped yet, or the segment has grown since
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.__segment_file(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.segment_maps[segment] = segment_map
+
+        return segment_map[offset:offset+size]
+
+    def __read_timestamp(self, height):
+        # call with db_lock held
+        header, _ = BlockHeader.unserialize(self.__read_block(height)[:80], self.spv.coin)
+        return header.timestamp
+
+    def __close_maps(self, segments=None):
+        # call with db_lock held. Segments have to be unmapped before they're truncated or deleted
+        for segment in list(self.segment_maps.keys()) if segments is None else segments:
+            segment_map = self.segment_maps.pop(segment, None)
+            if segment_map is not None:
+                segment_map.close()
+
+    def __reset(self, start_height):
+        # call with db_lock held
+        self.__close_maps()
+        for segment in self.__segments_on_disk():
+            os.remove(self.__segment_file(segment))
+
+        with open(self.index_file, 'wb') as f:
+            f.write(BlockStore.INDEX_HEADER.pack(start_height))
+
+        self.start_height = start_height
+        self.block_heights = {}
+        self.segment_start_heights = collections.OrderedDict()
+        self.segment_sizes = {}
+
+    def __truncate(self, height):
+        # call with db_lock held. Drops the blocks at height and above
+        count = height - self.start_height
+        if count <= 0:
+            self.__reset(height)
+            return
+
+        end_segment, end_offset, end_size, _ = self.__read_record(height - 1)
+
+        for segment in [segment for segment in self.__segments_on_disk() if segment > end_segment]:
+            self.__close_maps([segment])
+            os.remove(self.__segment_file(segment))
+            self.segment_start_heights.pop(segment, None)
+            self.segment_sizes.pop(segment, None)
+
+        self.__close_maps([end_segment])
+        with open(self.__segment_file(end_segment), 'r+b') as f:
+            f.truncate(end_offset + end_size)
+        self.segment_sizes[end_segment] = end_offset + end_size
+
+        for block_hash in [block_hash for block_hash, h in self.block_heights.items() if h >= height]:
+            self.block_heights.pop(block_hash)
+
+        with open(self.index_file, 'r+b') as f:
+            f.truncate(BlockStore.INDEX_HEADER.size + count * BlockStore.INDEX_RECORD.size)
+
+    def __prune(self, tip_height):
+        # call with db_lock held. Deletes the oldest segments, but never the one being written to
+        prune_segments = []
+        total_size = sum(self.segment_sizes.values())
+        segments = list(self.segment_start_heights.items())
+        for (segment, _), (_, next_start_height) in zip(segments, segments[1:]):
+            too_deep = self.max_depth is not None and (tip_height - (next_start_height - 1)) >= self.max_depth
+            too_big = self.max_size is not None and total_size > self.max_size
+            if not (too_deep or too_big):
+                break
+            prune_segments.append((segment, next_start_height))
+            total_size -= self.segment_sizes[segment]
+
+        if len(prune_segments) == 0:
+            return
+
+        new_start_height = prune_segments[-1][1]
+        with open(self.index_file, 'rb') as f:
+            f.seek(BlockStore.INDEX_HEADER.size + (new_start_height - self.start_height) * BlockStore.INDEX_RECORD.size)
+            records = f.read()
+
+        # Write the new index next to the old one and swap them, so a crash leaves one or the other
+        with open(self.index_file + '.new', 'wb') as f:
+            f.write(BlockStore.INDEX_HEADER.pack(new_start_height))
+            f.write(records)
+        os.replace(self.index_file + '.new', self.index_file)
+
+        for segment, _ in prune_segments:
+            self.__close_maps([segment])
+            os.remove(self.__segment_file(segment))
+            self.segment_start_heights.pop(segment)
+            self.segment_sizes.pop(segment)
+
+        for block_hash in [block_hash for block_hash, h in self.block_heights.items() if h < new_start_height]:
+            self.block_heights.pop(block_hash)
+        self.start_height = new_start_height
+
+        if self.spv.logging_level <= DEBUG:
+            print('[BLOCKSTORE] pruned {} segments, blocks start at height {}'.format(len(prune_segments), new_start_height))
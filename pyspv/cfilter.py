@@ -0,0 +1,314 @@
+from .script import OP_RETURN
+from .serialize import Serialize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class InvalidFilter(Exception):
+    pass
+
+def _siprounds(v0, v1, v2, v3, rounds, mask):
+    for _ in range(rounds):
+        v0 = (v0 + v1) & mask
+        v1 = ((v1 << 13) | (v1 >> 51)) & mask
+        v1 ^= v0
+        v0 = ((v0 << 32) | (v0 >> 32)) & mask
+        v2 = (v2 + v3) & mask
+        v3 = ((v3 << 16) | (v3 >> 48)) & mask
+        v3 ^= v2
+        v0 = (v0 + v3) & mask
+        v3 = ((v3 << 21) | (v3 >> 43)) & mask
+        v3 ^= v0
+        v2 = (v2 + v1) & mask
+        v1 = ((v1 << 17) | (v1 >> 47)) & mask
+        v1 ^= v2
+        v2 = ((v2 << 32) | (v2 >> 32)) & mask
+    return v0, v1, v2, v3
+
+def _siphash_lanes(k0, k1, words, ones, mask):
+    # SipHash-2-4 on any number of messages at once.  Each message is a 64-bit lane in a big integer (lanes are 128 bits
+    # apart so carries and rotated bits land in the unused upper half, which mask clears), so every Python operation
+    # below works on all of the messages.  ones has a 1 at the bottom of each lane.
+    v0 = (k0 ^ 0x736f6d6570736575) * ones
+    v1 = (k1 ^ 0x646f72616e646f6d) * ones
+    v2 = (k0 ^ 0x6c7967656e657261) * ones
+    v3 = (k1 ^ 0x7465646279746573) * ones
+
+    for m in words:
+        v3 ^= m
+        v0, v1, v2, v3 = _siprounds(v0, v1, v2, v3, 2, mask)
+        v0 ^= m
+
+    v2 ^= 0xff * ones
+    v0, v1, v2, v3 = _siprounds(v0, v1, v2, v3, 4, mask)
+
+    return v0 ^ v1 ^ v2 ^ v3
+
+def _message_words(data):
+    # 8 byte little endian words, the last one padded and tagged with the message length
+    end = len(data) & ~7
+    words = [int.from_bytes(data[i:i+8], 'little') for i in range(0, end, 8)]
+    words.append(((len(data) & 0xff) << 56) | int.from_bytes(data[end:], 'little'))
+    return words
+
+def _pack_lanes(values):
+    return int.from_bytes(b''.join(value.to_bytes(16, 'little') for value in values), 'little')
+
+def siphash(k0, k1, data):
+    '''SipHash-2-4 of data with the 128-bit key (k0, k1), as used by BIP158'''
+    return _siphash_lanes(k0, k1, _message_words(data), 1, 0xffffffffffffffff)
+
+class FilterQuery:
+    '''A set of items (a sequence of bytes, usually scriptPubKeys) to be matched against many filters.  The items
+    are hashed again with every filter's key, so they're prepared once here and hashed all at the same time.'''
+
+    def __init__(self, items):
+        self.items = list(set(items))
+
+        # Items of the same length in words are hashed together
+        by_word_count = {}
+        for item in self.items:
+            by_word_count.setdefault(len(item) // 8 + 1, []).append(item)
+
+        self.groups = []
+        for word_count, items in by_word_count.items():
+            words = [_message_words(item) for item in items]
+            self.groups.append({
+                'count': len(items),
+                'words': [_pack_lanes([w[i] for w in words]) for i in range(word_count)],
+                'ones' : _pack_lanes([1] * len(items)),
+                'mask' : _pack_lanes([0xffffffffffffffff] * len(items)),
+            })
+
+    def __len__(self):
+        return len(self.items)
+
+    def hashes(self, k0, k1):
+        r = []
+        for group in self.groups:
+            lanes = _siphash_lanes(k0, k1, group['words'], group['ones'], group['mask']).to_bytes(16 * group['count'], 'little')
+            r.extend(int.from_bytes(lanes[i:i+8], 'little') for i in range(0, len(lanes), 16))
+        return r
+
+    def matches(self, gcs):
+        '''Returns True if any of the items are probably in the filter gcs'''
+        if gcs.n == 0 or len(self.items) == 0:
+            return False
+
+        f = gcs.n * GCSFilter.M
+        return gcs.match_sorted(sorted(set((h * f) >> 64 for h in self.hashes(gcs.k0, gcs.k1))))
+
+class GCSFilter:
+    '''A BIP158 Golomb-coded set.  The items are hashed into the range [0, n * M) with a key taken from the block hash,
+    sorted, and the differences between consecutive values are written out Golomb-Rice coded with parameter P.
+
+    The basic filter type contains every output script in the block (except OP_RETURN outputs) and the scripts of every
+    output spent by the block.  We can't build those without a UTXO set, so the filters we build and serve are our own
+    type (see :py:func:`local_filter_items`), which only other pyspv instances ask for.'''
+
+    BASIC_FILTER_TYPE = 0
+
+    # Not a BIP158 type.  Served to peers that have us as a static peer (see Manager.NODE_LOCAL_FILTERS).
+    LOCAL_FILTER_TYPE = 0x80
+
+    P = 19
+    M = 784931
+
+    def __init__(self, block_hash, n, data):
+        self.k0 = int.from_bytes(block_hash[0:8], 'little')
+        self.k1 = int.from_bytes(block_hash[8:16], 'little')
+        self.n = n
+        self.data = data
+
+    def hash_to_range(self, item):
+        return (siphash(self.k0, self.k1, item) * self.n * GCSFilter.M) >> 64
+
+    def decode(self):
+        '''Returns an iterator over the hashed values in the filter, in sorted order'''
+        if numpy is not None:
+            return iter(self.__decode_array().tolist())
+        return self.__decode_python()
+
+    def __decode_array(self):
+        # With NumPy only the end of each unary quotient is found one code at a time, with str.index() on the bits.  The
+        # P bit remainders are then read for all of the codes at once, a bit position at a time, and the values are the
+        # running sum of the differences.
+        bits = self.__bits()
+        find = bits.index
+        p = GCSFilter.P
+        ends = [0] * self.n
+        pos = 0
+        try:
+            for i in range(self.n):
+                pos = find('0', pos)
+                ends[i] = pos
+                pos += 1 + p
+        except ValueError:
+            pos = len(bits) + 1
+        if pos > len(bits):
+            raise InvalidFilter("filter data ends before all {} items were decoded".format(self.n))
+
+        ends = numpy.array(ends, dtype=numpy.int64)
+        quotients = ends.copy()
+        quotients[1:] -= ends[:-1] + 1 + p
+
+        bit_array = numpy.unpackbits(numpy.frombuffer(self.data, dtype=numpy.uint8)).astype(numpy.int64)
+        remainders = numpy.zeros(self.n, dtype=numpy.int64)
+        for k in range(1, p + 1):
+            remainders = (remainders << 1) | bit_array[ends + k]
+
+        return numpy.cumsum((quotients << p) + remainders)
+
+    def __decode_python(self):
+        bits = self.__bits()
+        find = bits.index
+        p = GCSFilter.P
+        pos = 0
+        value = 0
+        try:
+            for _ in range(self.n):
+                # Quotient in unary (1s terminated by a 0) followed by a P bit remainder
+                q_end = find('0', pos)
+                value += ((q_end - pos) << p) + int(bits[q_end+1:q_end+1+p], 2)
+                pos = q_end + 1 + p
+                yield value
+        except ValueError:
+            raise InvalidFilter("filter data ends before all {} items were decoded".format(self.n))
+
+    def match_any(self, items):
+        '''Returns True if any of items (a sequence of bytes) is probably in the filter.  Use a FilterQuery to match
+        the same items against many filters.'''
+        return FilterQuery(items).matches(self)
+
+    def match_sorted(self, targets):
+        '''targets is a sorted list of hashed values (see hash_to_range).  Returns True if any of them are in the filter.'''
+        if self.n == 0 or len(targets) == 0:
+            return False
+
+        if numpy is not None:
+            values = self.__decode_array()
+            i = numpy.minimum(numpy.searchsorted(values, targets), self.n - 1)
+            return bool((values[i] == numpy.array(targets, dtype=numpy.int64)).any())
+
+        target_index = 0
+        target = targets[0]
+
+        # This is the same loop as __decode_python(), inlined since it's where filter matching spends its time.  Both lists are
+        # sorted, so walk them together and stop as soon as there's a match.
+        bits = self.__bits()
+        find = bits.index
+        p = GCSFilter.P
+        pos = 0
+        value = 0
+        try:
+            for _ in range(self.n):
+                q_end = find('0', pos)
+                value += ((q_end - pos) << p) + int(bits[q_end+1:q_end+1+p], 2)
+                pos = q_end + 1 + p
+
+                while target < value:
+                    target_index += 1
+                    if target_index == len(targets):
+                        return False
+                    target = targets[target_index]
+
+                if target == value:
+                    return True
+        except ValueError:
+            raise InvalidFilter("filter data ends before all {} items were decoded".format(self.n))
+
+        return False
+
+    def __bits(self):
+        if len(self.data) == 0:
+            return ''
+        # A binary string lets str.index() find the end of each unary run, which is much faster than testing one bit at a time
+        return format(int.from_bytes(self.data, 'big'), '0{}b'.format(len(self.data) * 8))
+
+    def serialize(self):
+        return Serialize.serialize_variable_int(self.n) + self.data
+
+    @staticmethod
+    def unserialize(data, block_hash):
+        n, data = Serialize.unserialize_variable_int(data)
+        return GCSFilter(block_hash, n, data)
+
+    @staticmethod
+    def build(items, block_hash):
+        '''Build the filter for the set of items (a sequence of bytes, duplicates are ignored)'''
+        query = FilterQuery(items)
+        gcs = GCSFilter(block_hash, len(query), b'')
+
+        f = gcs.n * GCSFilter.M
+        gcs.data = _golomb_rice_encode(sorted((h * f) >> 64 for h in query.hashes(gcs.k0, gcs.k1)), GCSFilter.P)
+        return gcs
+
+def _golomb_rice_encode(values, p):
+    # values must be sorted.  Codes are collected in an integer and written out 64 bits at a time into a buffer that's
+    # allocated up front for the expected size (the quotient is almost always 0 or 1, so about p + 2 bits per value).
+    buf = bytearray((len(values) * (p + 2)) // 8 + 8)
+    buf_size = len(buf)
+    mask = (1 << p) - 1
+
+    acc = 0
+    acc_bits = 0
+    pos = 0
+    last_value = 0
+    for value in values:
+        delta = value - last_value
+        last_value = value
+
+        # q 1s, a 0, then the p bit remainder
+        q = delta >> p
+        acc = (((acc << (q + 1)) | (((1 << q) - 1) << 1)) << p) | (delta & mask)
+        acc_bits += q + 1 + p
+
+        if acc_bits >= 64:
+            acc_bits -= 64
+            if pos + 8 > buf_size:
+                buf.extend(bytes(buf_size))
+                buf_size = len(buf)
+            buf[pos:pos+8] = (acc >> acc_bits).to_bytes(8, 'big')
+            acc &= (1 << acc_bits) - 1
+            pos += 8
+
+    if acc_bits:
+        # Pad the last byte with 0s
+        tail_size = (acc_bits + 7) // 8
+        buf[pos:pos+tail_size] = (acc << (tail_size * 8 - acc_bits)).to_bytes(tail_size, 'big')
+        pos += tail_size
+
+    del buf[pos:]
+    return bytes(buf)
+
+def basic_filter_items(block):
+    '''The output scripts of every transaction in block, skipping empty scripts and OP_RETURN outputs.
+
+    A BIP158 basic filter also contains the scripts of the outputs the block spends, but that needs a UTXO set which
+    we don't have.'''
+    items = set()
+    for tx in block.transactions:
+        for output in tx.outputs:
+            program = output.script.program
+            if len(program) and program[0] != OP_RETURN:
+                items.add(program)
+    return items
+
+def local_filter_items(block):
+    '''The items of a LOCAL_FILTER_TYPE filter: the output scripts from :py:func:`basic_filter_items` and the serialized
+    prevout of every input, so a client finds the blocks spending its coins by their prevouts instead of their scripts.'''
+    items = basic_filter_items(block)
+    for tx in block.transactions:
+        if not tx.is_coinbase():
+            for input in tx.inputs:
+                items.add(input.prevout.serialize())
+    return items
+
+def filter_hash(coin, filter_data):
+    return coin.hash(filter_data)
+
+def filter_header(coin, filter_data, previous_filter_header):
+    '''BIP157 filter headers commit to the filter and, through the previous header, to every filter before it'''
+    return coin.hash(filter_hash(coin, filter_data) + previous_filter_header)
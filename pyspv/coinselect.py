@@ -0,0 +1,175 @@
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Strategies for Wallet.select_spends and TransactionBuilder.finish
+STRATEGIES = ('approximate', 'bnb')
+
+# How long a selection can search for before settling for the best subset found so far
+TIME_BUDGET = 0.25
+
+# Branch and bound gives up after trying this many combinations
+BNB_MAX_TRIES = 100000
+
+RANDOM_TRIALS = 1000
+
+# Random subsets are drawn this many coins' worth at a time, so 100k coins don't need 1000 rows of 100k at once
+RANDOM_CHUNK_SIZE = 4 * 1024 * 1024
+
+def branch_and_bound(amounts, target, window, max_tries=BNB_MAX_TRIES, deadline=None):
+    '''Searches for a subset of amounts that adds up to between target and target + window, depth first from the
+    largest coins down, and returns the indexes of the one closest to target or None if there isn't one.  A branch is
+    cut as soon as it goes over target + window or what's left can't reach target.'''
+    if numpy is not None:
+        order = numpy.argsort(-numpy.array(amounts, dtype=numpy.int64), kind='stable').tolist()
+    else:
+        order = sorted(range(len(amounts)), key=lambda i: -amounts[i])
+
+    values = [amounts[i] for i in order]
+
+    # remaining[i] is the sum of values[i:]
+    remaining = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + values[i]
+
+    best = None
+    best_total = None
+    selected = []
+    total = 0
+    i = 0
+    for tries in range(max_tries):
+        if deadline is not None and (tries % 1000) == 0 and time.time() > deadline:
+            break
+
+        backtrack = False
+        if total + remaining[i] < target or total > target + window:
+            backtrack = True
+        elif total >= target:
+            if best is None or total < best_total:
+                best = list(selected)
+                best_total = total
+                if total == target:
+                    break
+            backtrack = True
+
+        if not backtrack:
+            selected.append(i)
+            total += values[i]
+            i += 1
+            continue
+
+        # Leave out the last coin that was put in and go on without it.  Leaving out a coin and then putting in
+        # another of the same value is the same branch again, so those are skipped too.
+        if len(selected) == 0:
+            break
+        excluded = selected.pop()
+        total -= values[excluded]
+        i = excluded + 1
+        while i < len(values) and values[i] == values[excluded]:
+            i += 1
+
+    return None if best is None else [order[j] for j in best]
+
+def random_subsets(amounts, target, trials=RANDOM_TRIALS, deadline=None):
+    '''For each trial, goes through amounts in order putting in each coin with a probability of 1/2 and stops once the
+    total reaches target.  Returns the indexes of the subset with the smallest total, or None if none of them reached
+    target.  With NumPy the trials are run a chunk at a time over arrays.'''
+    if numpy is None:
+        return _random_subsets_python(amounts, target, trials, deadline)
+
+    values = numpy.array(amounts, dtype=numpy.int64)
+    chunk_trials = max(1, RANDOM_CHUNK_SIZE // max(1, len(values)))
+
+    best = None
+    best_total = None
+    done = 0
+    while done < trials and (deadline is None or done == 0 or time.time() <= deadline):
+        rows = min(chunk_trials, trials - done)
+        done += rows
+
+        masks = numpy.random.random((rows, len(values))) < 0.5
+        sums = numpy.cumsum(numpy.where(masks, values, 0), axis=1)
+        reached = sums >= target
+        hits = reached.any(axis=1)
+        if not hits.any():
+            continue
+
+        # The total of each trial is its sum when it first reached target
+        first = reached.argmax(axis=1)
+        totals = sums[numpy.arange(rows), first]
+        totals[~hits] = numpy.iinfo(numpy.int64).max
+        r = int(totals.argmin())
+        if best is None or int(totals[r]) < best_total:
+            best_total = int(totals[r])
+            best = numpy.nonzero(masks[r, :first[r] + 1])[0].tolist()
+            if best_total == target:
+                break
+
+    return best
+
+def _random_subsets_python(amounts, target, trials, deadline):
+    best = None
+    best_total = None
+    for trial in range(trials):
+        if deadline is not None and trial > 0 and time.time() > deadline:
+            break
+
+        included = []
+        total = 0
+        for i, amount in enumerate(amounts):
+            if random.getrandbits(1):
+                included.append(i)
+                total += amount
+                if total >= target:
+                    break
+
+        if total >= target and (best is None or total < best_total):
+            best = included
+            best_total = total
+            if total == target:
+                break
+
+    return best
+
+def largest_first(amounts, target):
+    '''Returns the indexes of the largest amounts, in order, up to the first one that brings the total to target, or
+    None if amounts don't add up to target'''
+    selected = []
+    total = 0
+    for i in sorted(range(len(amounts)), key=lambda i: -amounts[i]):
+        selected.append(i)
+        total += amounts[i]
+        if total >= target:
+            return selected
+    return None
+
+def select_subset(amounts, target, change_cost, time_budget=TIME_BUDGET):
+    '''Returns the indexes of a subset of amounts to pay target with.  Branch and bound looks for a total within
+    change_cost over target, which is spent without a change output.  If there isn't one, random subsets look for the
+    smallest total that leaves at least change_cost in change, and failing that any total over target.  Random subsets
+    rarely reach a target that needs nearly all of the coins, so the largest coins are taken when they don't.  Returns
+    None only if amounts don't add up to target.'''
+    deadline = time.time() + time_budget
+
+    r = branch_and_bound(amounts, target, change_cost, deadline=deadline)
+    if r is not None:
+        return r
+
+    total = sum(amounts)
+    for t in (target + change_cost, target):
+        if total < t:
+            continue
+        r = random_subsets(amounts, t, deadline=deadline)
+        if r is not None:
+            return r
+
+    for t in (target + change_cost, target):
+        r = largest_first(amounts, t)
+        if r is not None:
+            return r
+
+    return None
@@ -0,0 +1,186 @@
+import collections
+import os
+import struct
+import threading
+
+from .cfilter import GCSFilter, filter_header, local_filter_items
+from .util import *
+
+class FilterDatabase:
+    '''
+    Builds a compact filter for every full block we receive and keeps the filters of the main chain on disk so they
+    can be served to peers with getcfilters/getcfheaders.  The filters are GCSFilter.LOCAL_FILTER_TYPE filters, which
+    other pyspv instances can sync from but BIP157 clients can't.
+
+    Filters are stored in two append-only files: "cfilters.dat" holds the filter data, and "cfilters.idx" is indexed by
+    height and holds, for each block, where its filter is in the data file along with the block hash, filter hash and
+    filter header.  The index starts at the first block we had a full block for (the filter header before it is taken
+    to be all 0s), and a reorganization truncates both files back to the fork.
+
+    Filters are built in on_block, since a block might not be on the main chain yet (or ever) when it arrives, and
+    are written out when on_block_added adds the block to the main chain.
+    '''
+
+    INDEX_HEADER = struct.Struct("<L")
+    INDEX_RECORD = struct.Struct("<QL32s32s32s")
+
+    # Filters that were built for blocks that aren't part of the main chain yet
+    MAX_PENDING_FILTERS = 100
+
+    def __init__(self, spv):
+        self.spv = spv
+        self.index_file = self.spv.config.get_file("cfilters.idx")
+        self.data_file = self.spv.config.get_file("cfilters.dat")
+        self.db_lock = threading.Lock()
+        self.pending_filters = collections.OrderedDict()
+
+        # block_hash -> height for every block in the index.  The rest of the index is read from disk when needed.
+        self.block_heights = {}
+        self.start_height = None
+        self.data_size = 0
+
+        if self.spv.args.resync:
+            for filename in (self.index_file, self.data_file):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                data = f.read()
+
+            if len(data) >= FilterDatabase.INDEX_HEADER.size:
+                self.start_height = FilterDatabase.INDEX_HEADER.unpack_from(data, 0)[0]
+
+                # Ignore a partially written record at the end
+                count = (len(data) - FilterDatabase.INDEX_HEADER.size) // FilterDatabase.INDEX_RECORD.size
+                for i in range(count):
+                    offset, size, block_hash, _, _ = FilterDatabase.INDEX_RECORD.unpack_from(data, FilterDatabase.INDEX_HEADER.size + i * FilterDatabase.INDEX_RECORD.size)
+                    self.block_heights[block_hash] = self.start_height + i
+                    self.data_size = offset + size
+
+                self.__truncate(self.start_height + count)
+
+        if self.spv.logging_level <= DEBUG:
+            print('[FILTERDB] {} filters starting at height {}'.format(len(self.block_heights), self.start_height))
+
+    def get_next_height(self):
+        '''Returns the height of the next filter to be added, or None if there aren't any filters'''
+        with self.db_lock:
+            return None if self.start_height is None else self.start_height + len(self.block_heights)
+
+    def on_block(self, block):
+        items = local_filter_items(block)
+        gcs = GCSFilter.build(items, block.header.hash())
+
+        with self.db_lock:
+            self.pending_filters[block.header.hash()] = gcs.serialize()
+            while len(self.pending_filters) > FilterDatabase.MAX_PENDING_FILTERS:
+                self.pending_filters.popitem(last=False)
+
+    def on_block_added(self, block_header, block_height):
+        block_hash = block_header.hash()
+
+        with self.db_lock:
+            filter_data = self.pending_filters.pop(block_hash, None)
+            if filter_data is None:
+                # Only a header, or a block we got before a restart
+                return
+
+            next_height = None if self.start_height is None else self.start_height + len(self.block_heights)
+            if next_height != block_height:
+                # The filters have to cover a continuous run of blocks, so start over from here
+                if self.spv.logging_level <= WARNING and next_height is not None:
+                    print('[FILTERDB] no filter for blocks {} to {}, restarting filters at height {}'.format(next_height, block_height - 1, block_height))
+                self.__reset(block_height)
+
+            previous_filter_header = self.__read_records(block_height - 1, 1)[0][4] if len(self.block_heights) else (b'\x00' * 32)
+            filter_hash = self.spv.coin.hash(filter_data)
+            record = FilterDatabase.INDEX_RECORD.pack(self.data_size, len(filter_data), block_hash, filter_hash, filter_header(self.spv.coin, filter_data, previous_filter_header))
+
+            with open(self.data_file, 'ab') as f:
+                f.write(filter_data)
+            with open(self.index_file, 'ab') as f:
+                f.write(record)
+
+            self.block_heights[block_hash] = block_height
+            self.data_size += len(filter_data)
+
+    def on_block_removed(self, block_header, block_height):
+        with self.db_lock:
+            if self.start_height is not None and block_height < self.start_height + len(self.block_heights):
+                self.__truncate(block_height)
+
+    def get_filter_hashes(self, start_height, stop_hash, max_count):
+        '''Returns (previous_filter_header, filter_hashes) for the blocks from start_height to stop_hash, or None if we don't
+        have them all or there are more than max_count'''
+        with self.db_lock:
+            stop_height = self.__check_range(start_height, stop_hash, max_count)
+            if stop_height is None:
+                return None
+
+            records = self.__read_records(start_height - 1, stop_height - start_height + 2) if start_height > self.start_height else \
+                      [None] + self.__read_records(start_height, stop_height - start_height + 1)
+
+        previous_filter_header = records[0][4] if records[0] is not None else (b'\x00' * 32)
+        return previous_filter_header, [record[3] for record in records[1:]]
+
+    def get_filters(self, start_height, stop_hash, max_count):
+        '''Returns a list of (block_hash, filter_data) for the blocks from start_height to stop_hash, or None if we don't have
+        them all or there are more than max_count'''
+        with self.db_lock:
+            stop_height = self.__check_range(start_height, stop_hash, max_count)
+            if stop_height is None:
+                return None
+
+            records = self.__read_records(start_height, stop_height - start_height + 1)
+
+            # The filters are next to each other in the data file, so read them all at once
+            start = records[0][0]
+            with open(self.data_file, 'rb') as f:
+                f.seek(start)
+                data = f.read(records[-1][0] + records[-1][1] - start)
+
+        return [(block_hash, data[offset-start:offset-start+size]) for offset, size, block_hash, _, _ in records]
+
+    def __check_range(self, start_height, stop_hash, max_count):
+        # call with db_lock held. Returns the height of stop_hash if the request can be answered
+        stop_height = self.block_heights.get(stop_hash, None)
+        if stop_height is None or start_height < self.start_height or start_height > stop_height:
+            return None
+        if stop_height - start_height + 1 > max_count:
+            return None
+        return stop_height
+
+    def __read_records(self, height, count):
+        # call with db_lock held
+        with open(self.index_file, 'rb') as f:
+            f.seek(FilterDatabase.INDEX_HEADER.size + (height - self.start_height) * FilterDatabase.INDEX_RECORD.size)
+            data = f.read(count * FilterDatabase.INDEX_RECORD.size)
+        return [FilterDatabase.INDEX_RECORD.unpack_from(data, i * FilterDatabase.INDEX_RECORD.size) for i in range(count)]
+
+    def __reset(self, start_height):
+        # call with db_lock held
+        with open(self.index_file, 'wb') as f:
+            f.write(FilterDatabase.INDEX_HEADER.pack(start_height))
+        with open(self.data_file, 'wb') as f:
+            pass
+
+        self.start_height = start_height
+        self.block_heights = {}
+        self.data_size = 0
+
+    def __truncate(self, height):
+        # call with db_lock held. Drops the filters at height and above
+        count = height - self.start_height
+        if count <= 0:
+            self.__reset(height)
+            return
+
+        self.data_size = sum(self.__read_records(height - 1, 1)[0][0:2])
+        for block_hash in [block_hash for block_hash, h in self.block_heights.items() if h >= height]:
+            self.block_heights.pop(block_hash)
+
+        with open(self.index_file, 'r+b') as f:
+            f.truncate(FilterDatabase.INDEX_HEADER.size + count * FilterDatabase.INDEX_RECORD.size)
+        with open(self.data_file, 'r+b') as f:
+            f.truncate(self.data_size)
@@ -0,0 +1,66 @@
+import threading
+
+from .keys import PublicKey
+
+class PublicKeyCache:
+    '''
+    Remembers what was derived from each private key in the wallet: its uncompressed and compressed public keys, their
+    hash160s and their addresses.  Deriving a public key is an EC multiplication through OpenSSL, so a wallet with tens
+    of thousands of keys would otherwise spend most of its startup doing the same math as the last time.
+
+    Everything is kept in the wallet database (see :py:class:`pyspv.walletdb.WalletDatabase`), by the hash of the
+    private key, and read in one go when the cache is created.  Keys that aren't in it yet are derived once, when they
+    are first asked for, and saved.
+    '''
+
+    def __init__(self, spv, walletdb):
+        self.spv = spv
+        self.walletdb = walletdb
+        self.lock = threading.Lock()
+
+        # key_id -> ((uncompressed pubkey, hash160, address), (compressed pubkey, hash160, address))
+        self.keys = dict(self.walletdb.get_public_keys())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, private_key, compressed):
+        '''Returns (public_key, hash160, address) for private_key'''
+        key_id = self.spv.coin.hash(private_key.secret)
+        with self.lock:
+            derived = self.keys.get(key_id, None)
+
+        if derived is None:
+            derived = self.__derive(private_key)
+
+            # The wallet database's batch lock comes before ours
+            with self.walletdb.batch(), self.lock:
+                if key_id not in self.keys:
+                    self.keys[key_id] = derived
+                    self.walletdb.save_public_keys(key_id, derived)
+
+        pubkey, hash160, address = derived[1 if compressed else 0]
+        return PublicKey(pubkey), hash160, address
+
+    def derive(self, private_keys):
+        '''Derives and saves the public keys of each of private_keys that isn't in the cache yet, all in one commit.  The
+        keys are derived without holding any lock.'''
+        key_ids = [self.spv.coin.hash(private_key.secret) for private_key in private_keys]
+        with self.lock:
+            missing = [(key_id, private_key) for key_id, private_key in zip(key_ids, private_keys) if key_id not in self.keys]
+
+        derived = [(key_id, self.__derive(private_key)) for key_id, private_key in missing]
+
+        with self.walletdb.batch(), self.lock:
+            for key_id, public_keys in derived:
+                self.keys[key_id] = public_keys
+                self.walletdb.save_public_keys(key_id, public_keys)
+
+    def __derive(self, private_key):
+        # The compressed key comes from the uncompressed one without any EC math
+        uncompressed = private_key.get_public_key(False).pubkey
+        derived = []
+        for pubkey in (uncompressed, PublicKey.compress(uncompressed)):
+            public_key = PublicKey(pubkey)
+            derived.append((pubkey, public_key.as_hash160(self.spv.coin), public_key.as_address(self.spv.coin)))
+        return tuple(derived)
@@ -0,0 +1,101 @@
+import collections
+import threading
+
+from .keys import PrivateKey
+from .util import *
+
+class KeyPool(threading.Thread):
+    '''
+    Keeps private keys ready to be handed out, so issuing a new address doesn't have to generate a key, derive its
+    public keys and write it to the wallet while the caller waits.
+
+    Keys in the pool are already in the wallet, as 'private_key' items with an empty label, so the monitors watch them
+    from the start.  The wallet database keeps which of them are still in the pool (see
+    :py:class:`pyspv.walletdb.WalletDatabase`), and the pool is read back from there at startup.  :py:meth:`take`
+    pops a key and takes it out of the pool table, which is one small write.
+
+    Whenever the pool drops below low_water_mark keys, a background thread generates keys up to size, BATCH_SIZE at a
+    time.  Each batch's public keys are derived into the wallet's :py:class:`pyspv.keycache.PublicKeyCache` first, and
+    then the keys are added to the wallet and the pool in one wallet batch, so a batch is two commits.  If the pool
+    runs out, take creates a key right away, like it would without a pool.
+    '''
+
+    BATCH_SIZE = 100
+
+    # How often the thread checks whether it was shut down
+    WAIT_TIME = 1
+
+    def __init__(self, spv, size=1000, low_water_mark=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.spv = spv
+        self.size = size
+        self.low_water_mark = size // 2 if low_water_mark is None else low_water_mark
+        self.keys = collections.deque(self.spv.wallet.walletdb.get_pool_keys())
+        self.keys_lock = threading.Lock()
+        self.refill_event = threading.Event()
+        self.running = False
+
+        if self.spv.logging_level <= INFO:
+            print('[KEYPOOL] {} keys in the pool'.format(len(self.keys)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def start(self):
+        self.running = True
+        self.refill_event.set()
+        threading.Thread.start(self)
+
+    def shutdown(self):
+        self.running = False
+        self.refill_event.set()
+
+    def take(self, label=''):
+        '''Returns a private key that's in the wallet with label and hasn't been handed out before'''
+        with self.keys_lock:
+            private_key = self.keys.popleft() if len(self.keys) else None
+            if len(self.keys) < self.low_water_mark:
+                self.refill_event.set()
+
+        if private_key is None:
+            if self.spv.logging_level <= WARNING:
+                print('[KEYPOOL] the pool is empty, creating a key')
+            private_key = PrivateKey.create_new()
+            self.spv.wallet.add('private_key', private_key, {'label': label})
+            return private_key
+
+        with self.spv.wallet.batch():
+            self.spv.wallet.walletdb.remove_pool_key(private_key)
+            if label != '':
+                self.spv.wallet.update('private_key', private_key, {'label': label})
+
+        return private_key
+
+    def run(self):
+        while self.running:
+            self.refill_event.wait(KeyPool.WAIT_TIME)
+            if not self.running:
+                break
+            if not self.refill_event.is_set():
+                continue
+            self.refill_event.clear()
+
+            while self.running and len(self.keys) < self.size:
+                self.__add_keys(min(KeyPool.BATCH_SIZE, self.size - len(self.keys)))
+
+    def __add_keys(self, count):
+        private_keys = [PrivateKey.create_new() for _ in range(count)]
+
+        # Derived before the keys go into the wallet, so the monitors find them in the cache
+        self.spv.wallet.public_key_cache.derive(private_keys)
+
+        with self.spv.wallet.batch():
+            for private_key in private_keys:
+                self.spv.wallet.add('private_key', private_key, {'label': ''})
+                self.spv.wallet.walletdb.add_pool_key(private_key)
+
+        with self.keys_lock:
+            self.keys.extend(private_keys)
+
+        if self.spv.logging_level <= DEBUG:
+            print('[KEYPOOL] added {} keys, {} in the pool'.format(count, len(self.keys)))
@@ -1,4 +1,6 @@
 
+from ..script import ClassifiedTransaction
+
 class BaseMonitor:
     def __init__(self, spv):
         self.spv = spv
@@ -11,3 +13,44 @@ class BaseMonitor:
     def on_tx(self, tx):
         raise NotImplementedError("Implement me")
 
+    def on_classified_tx(self, classified_tx):
+        '''Called by the wallet with a :py:class:`pyspv.script.ClassifiedTransaction`.  Monitors that only care about some
+        script templates should override this, the default implementation falls back to on_tx'''
+        self.on_tx(classified_tx.tx)
+
+    def on_classified_block(self, classified_txs):
+        '''Called by the wallet with the classified transactions of a block, in order'''
+        for classified_tx in classified_txs:
+            self.on_classified_tx(classified_tx)
+
+    def get_filter_scripts(self):
+        '''Returns the scriptPubKeys this monitor is looking for, used to match compact block filters. Filters contain the
+        output scripts of every transaction in a block and the scripts of the outputs they spend, so watching the scripts
+        we're paid to also finds the transactions that spend our coins.'''
+        return []
+
+    def get_scan_keys(self):
+        '''Returns a dict of script template -> set of the keys (as classified by :py:mod:`pyspv.script`) this monitor is
+        looking for in transaction inputs and outputs, used to skip the transactions in a block that can't matter to it.
+        A template that maps to None matches every script of that template.  Monitors that need to see every
+        transaction return None, which is the default.'''
+        return None
+
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        '''Returns the scan keys (see get_scan_keys) for just one item from a wallet collection, used to rescan past blocks
+        for a newly added item.  Returns an empty dict for items the monitor doesn't use, or None (the default) if it
+        can't tell, in which case rescans use all of get_scan_keys.'''
+        return None
+
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        '''Returns the public keys (serialized) an item from a wallet collection lets the wallet sign with, so the spends
+        the wallet couldn't sign for that need them (see :py:meth:`pyspv.wallet.Spend.get_signing_keys`) are looked at
+        again when it's added.  Returns an empty set for items that don't sign anything, or None (the default) if the
+        monitor can't tell, in which case every spend the wallet can't sign for is looked at again.'''
+        return None
+
+    def get_scan_prevouts(self):
+        '''Returns the TransactionPrevOuts this monitor is watching to be spent, besides the prevouts of the spends in the
+        wallet, which the wallet always watches'''
+        return []
+
@@ -87,6 +87,9 @@ class MultisigScriptHashSpend(Spend):
                 n += 1
         return n >= self.address_info['nreq']
 
+    def get_signing_keys(self):
+        return self.address_info['public_keys']
+
     def get_confirmations(self, spv):
         return spv.txdb.get_tx_depth(self.prevout.tx_hash)
         
@@ -127,16 +130,12 @@ class MultisigScriptHashPaymentMonitor(BaseMonitor):
 
     def __init__(self, spv):
         BaseMonitor.__init__(self, spv)
-        self.spend_by_prevout = {}
-        self.script_addresses = {}
-
-    def on_new_spend(self, spend):
-        # We only care about multisig spends
-        if not isinstance(spend, MultisigScriptHashSpend):
-            return
+        self.filter_scripts = set()
 
-        # Save spend to check if it gets spent
-        self.spend_by_prevout[spend.prevout] = spend
+        # address_info for every redemption script in the wallet, by script hash (for outputs) and by the script itself
+        # (for spending inputs), so scripts can be matched without hashing
+        self.script_hash_addresses = {}
+        self.redemption_scripts = {}
 
     def on_new_redemption_script(self, redemption_script, metadata):
         # parse redemption_script to verify it's a multisig redemption script
@@ -168,72 +167,86 @@ class MultisigScriptHashPaymentMonitor(BaseMonitor):
         if (redemption_script[-2] - OP_1 + 1) != len(public_keys):
             return
 
-        address = base58_check(self.spv.coin, self.spv.coin.hash160(redemption_script), version_bytes=self.spv.coin.P2SH_ADDRESS_VERSION_BYTES)
+        redemption_script_hash = self.spv.coin.hash160(redemption_script)
+        address = base58_check(self.spv.coin, redemption_script_hash, version_bytes=self.spv.coin.P2SH_ADDRESS_VERSION_BYTES)
 
         # TODO on_public_key could check if any of our redemption_scripts reference that pubkey and if a private key is available for signing, etc
 
-        self.script_addresses[address] = {
+        address_info = {
             'address'          : address,
             'redemption_script': bytes_to_hexstring(redemption_script, reverse=False),
             'nreq'             : nreq,
             'public_keys'      : public_keys,
         }
 
+        self.script_hash_addresses[redemption_script_hash] = address_info
+        self.redemption_scripts[redemption_script] = address_info
+
         self.spv.wallet.add_temp('address', address, {'redemption_script': redemption_script})
 
+        self.filter_scripts.add(bytes([OP_HASH160, 20]) + redemption_script_hash + bytes([OP_EQUAL]))
+
         if self.spv.logging_level <= DEBUG:
             print('[MULTISIGSCRIPTHASHPAYMENTMONITOR] watching for multi-signature payment to {}'.format(address))
             print('[MULTISIGSCRIPTHASHPAYMENTMONITOR] {} of {} public_keys: {}'.format(nreq, len(public_keys), ', '.join(bytes_to_hexstring(public_key, reverse=False) for public_key in public_keys)))
 
+    def get_filter_scripts(self):
+        return list(self.filter_scripts)
+
+    def get_scan_keys(self):
+        return {
+            TEMPLATE_P2SH          : self.script_hash_addresses,
+            TEMPLATE_MULTISIG_SPEND: self.redemption_scripts,
+        }
+
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        if collection_name != 'redemption_script':
+            return {}
+
+        return {
+            TEMPLATE_P2SH          : set([self.spv.coin.hash160(item)]),
+            TEMPLATE_MULTISIG_SPEND: set([item]),
+        }
+
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        # Payments are only found for redemption scripts already in the wallet, so it's their private keys that count
+        return set()
+
     def on_tx(self, tx):
-        tx_hash = tx.hash()
+        self.on_classified_tx(ClassifiedTransaction(tx))
+
+    def on_classified_tx(self, classified_tx):
+        tx = classified_tx.tx
+        tx_hash = classified_tx.tx_hash
 
         # check inputs, they might spend coins from the wallet
+        spent_inputs = set()
         for i, input in enumerate(tx.inputs):
-            spend = self.spend_by_prevout.get(input.prevout, None)
-            if spend is not None:
-                # Have we've seen this spend before?
-                if tx_hash in spend.spent_in:
-                    continue
-
-                # Update this Spend with a new spend tx
-                spend.spent_in.add(tx_hash)
-                self.spv.wallet.update_spend(spend)
+            # The wallet watches the prevouts of all of its spends, and we only care about multisig spends
+            spend = self.spv.wallet.get_spend_by_prevout(input.prevout)
+            if spend is None or not isinstance(spend, MultisigScriptHashSpend):
+                continue
 
-                if self.spv.logging_level <= INFO:
-                    print('[MULTISIGSCRIPTHASHPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
+            spent_inputs.add(i)
 
+            # Have we've seen this spend before?
+            if tx_hash in spend.spent_in:
                 continue
 
-            # check this input and if it's a multisig p2sh spend (OP_0 <sig> .. <sig> <redemption_script>) and check to see if 
-            # the redemption script is in our wallet. if it is, remember this spend for later.
-            if len(input.script.program) == 0 or input.script.program[0] != OP_0:
-                continue
+            # Update this Spend with a new spend tx
+            spend.spent_in.add(tx_hash)
+            self.spv.wallet.update_spend(spend)
+
+            if self.spv.logging_level <= INFO:
+                print('[MULTISIGSCRIPTHASHPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
 
-            # Break the program into data pushes... TODO: move this to script.py
-            index = 1
-            pushes = []
-            while index < len(input.script.program):
-                size = input.script.program[index]
-                if size == OP_PUSHDATA1 and (index+1) < len(input.script.program):
-                    size = input.script.program[index+1]
-                    index += 2
-                elif size == OP_PUSHDATA2 and (index+2) < len(input.script.program):
-                    size = input.script.program[index+1] | (input.script.program[index+2] << 8)
-                    index += 3
-                elif size == OP_PUSHDATA4 and (index+4) < len(input.script.program):
-                    size = input.script.program[index+1] | (input.script.program[index+2] << 8) | (input.script.program[index+3] << 16) | (input.script.program[index+4] << 24)
-                    index += 5
-                pushes.append(input.script.program[index:index+size])
-                index += size
-
-            # The last data push has to be our redemption script
-            if len(pushes) == 0:
+        # check the other multisig p2sh spends (OP_0 <sig> .. <sig> <redemption_script>) to see if the redemption script
+        # is in our wallet. if it is, remember this spend for later.
+        for i, input, redemption_script in classified_tx.get_inputs(TEMPLATE_MULTISIG_SPEND):
+            if i in spent_inputs:
                 continue
 
-            redemption_script = pushes[-1]
-            address = base58_check(self.spv.coin, self.spv.coin.hash160(redemption_script), version_bytes=self.spv.coin.P2SH_ADDRESS_VERSION_BYTES)
-            address_info = self.script_addresses.get(address, None)
+            address_info = self.redemption_scripts.get(redemption_script, None)
             if address_info is None:
                 continue
 
@@ -253,20 +266,15 @@ class MultisigScriptHashPaymentMonitor(BaseMonitor):
             if self.spv.logging_level <= DEBUG:
                 print('[MULTISIGSCRIPTHASHPAYMENTMONITOR] tx {} spends {} from our wallet but we dont know the spend yet!'.format(bytes_to_hexstring(tx_hash), input.prevout))
 
-        for i, output in enumerate(tx.outputs):
-            # Analyze the script for P2SH
-            script = output.script.program
-            if len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[-1] == OP_EQUAL:
-                redemption_script_hash = script[2:22]
-            else:
-                continue
-
+        for i, output, redemption_script_hash in classified_tx.get_outputs(TEMPLATE_P2SH):
             # Check to see if we care about this scripthash
-            address = base58_check(self.spv.coin, redemption_script_hash, version_bytes=self.spv.coin.P2SH_ADDRESS_VERSION_BYTES)
-            address_info = self.script_addresses.get(address, None)
+            address_info = self.script_hash_addresses.get(redemption_script_hash, None)
             if address_info is None:
                 continue
 
+            address = address_info['address']
+            script = output.script.program
+
             self.spv.txdb.save_tx(tx)
 
             # Build a multisig payment
@@ -106,76 +106,96 @@ class PubKeyPaymentMonitor(BaseMonitor):
 
     def __init__(self, spv):
         BaseMonitor.__init__(self, spv)
-        self.pubkey_addresses = {}
-        self.spend_by_prevout = {}
 
-    def on_new_spend(self, spend):
-        # We only care about PubKeySpend
-        if not isinstance(spend, PubKeySpend):
-            return
-
-        # Save spend to check if it gets spent
-        self.spend_by_prevout[spend.prevout] = spend
+        # address_info for every key in the wallet, by hash160 (for pay-to-pubkey-hash) and by the serialized public key
+        # (for pay-to-pubkey and spending inputs), so scripts can be matched without hashing or going to the wallet file
+        self.pubkey_hash_addresses = {}
+        self.public_keys = {}
+        self.filter_scripts = set()
 
     def on_new_private_key(self, private_key, metadata):
         for compressed in (False, True):
-            public_key = private_key.get_public_key(compressed)
-            address = public_key.as_address(self.spv.coin)
+            public_key, hash160, address = self.spv.wallet.public_key_cache.get(private_key, compressed)
 
-            self.pubkey_addresses[address] = {
+            address_info = {
                 'address'       : address,
                 'public_key_hex': public_key.as_hex(),
             }
 
+            self.pubkey_hash_addresses[hash160] = address_info
+            self.public_keys[public_key.pubkey] = address_info
+
             self.spv.wallet.add_temp('public_key', public_key, {'private_key': private_key})
             self.spv.wallet.add_temp('address', address, {'public_key': public_key})
 
+            # Pay-to-pubkey-hash and pay-to-pubkey
+            self.filter_scripts.add(bytes([OP_DUP, OP_HASH160, 20]) + hash160 + bytes([OP_EQUALVERIFY, OP_CHECKSIG]))
+            self.filter_scripts.add(bytes([len(public_key.pubkey)]) + public_key.pubkey + bytes([OP_CHECKSIG]))
+
             if self.spv.logging_level <= DEBUG:
                 print('[PUBKEYPAYMENTMONITOR] watching for payments to {}'.format(address))
 
-    def on_tx(self, tx):
-        tx_hash = tx.hash()
+    def get_filter_scripts(self):
+        return list(self.filter_scripts)
 
-        # check inputs, they might spend coins from the wallet, even if we don't know about the coins yet
-        for i, input in enumerate(tx.inputs):
-            spend = self.spend_by_prevout.get(input.prevout, None)
-            if spend is not None:
-                # Have we've seen this spend before?
-                if tx_hash in spend.spent_in:
-                    continue
+    def get_scan_keys(self):
+        return {
+            TEMPLATE_P2PKH       : self.pubkey_hash_addresses,
+            TEMPLATE_P2PK        : self.public_keys,
+            TEMPLATE_PUBKEY_SPEND: self.public_keys,
+        }
 
-                # Update this Spend with a new spend tx
-                spend.spent_in.add(tx_hash)
-                self.spv.wallet.update_spend(spend)
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        if collection_name != 'private_key':
+            return {}
 
-                if self.spv.logging_level <= INFO:
-                    print('[PUBKEYPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
+        derived = [self.spv.wallet.public_key_cache.get(item, compressed) for compressed in (False, True)]
+        return {
+            TEMPLATE_P2PKH       : set(hash160 for _, hash160, _ in derived),
+            TEMPLATE_P2PK        : set(public_key.pubkey for public_key, _, _ in derived),
+            TEMPLATE_PUBKEY_SPEND: set(public_key.pubkey for public_key, _, _ in derived),
+        }
 
-                continue
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        if collection_name != 'private_key':
+            return set()
+        return set(self.spv.wallet.public_key_cache.get(item, compressed)[0].pubkey for compressed in (False, True))
 
-            # check this input and if it's a pubkey spend (<sig> <pubkey>) check to see if 
-            # pubkey is in our wallet. if it is, remember this spend for later.
-            if len(input.script.program) < 106:
-                continue
+    def on_tx(self, tx):
+        self.on_classified_tx(ClassifiedTransaction(tx))
 
-            # The first data push must be a signature
-            size = input.script.program[0]
-            if not (68 <= size <= 73):
+    def on_classified_tx(self, classified_tx):
+        tx = classified_tx.tx
+        tx_hash = classified_tx.tx_hash
+
+        # check inputs, they might spend coins from the wallet, even if we don't know about the coins yet
+        spent_inputs = set()
+        for i, input in enumerate(tx.inputs):
+            # The wallet watches the prevouts of all of its spends, and we only care about PubKeySpend
+            spend = self.spv.wallet.get_spend_by_prevout(input.prevout)
+            if spend is None or not isinstance(spend, PubKeySpend):
                 continue
 
-            # The second data push has to be a pubkey, though in the future we may need to extract the public key from the signature
-            size2 = input.script.program[size+1]
-            if size2 not in (33, 65):
+            spent_inputs.add(i)
+
+            # Have we've seen this spend before?
+            if tx_hash in spend.spent_in:
                 continue
 
-            public_key_bytes = input.script.program[size+2:]
-            if len(public_key_bytes) != size2:
+            # Update this Spend with a new spend tx
+            spend.spent_in.add(tx_hash)
+            self.spv.wallet.update_spend(spend)
+
+            if self.spv.logging_level <= INFO:
+                print('[PUBKEYPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
+
+        # check the other pubkey spends (<sig> <pubkey>) to see if pubkey is in our wallet. if it is, remember this spend for later.
+        for i, input, public_key_bytes in classified_tx.get_inputs(TEMPLATE_PUBKEY_SPEND):
+            if i in spent_inputs:
                 continue
 
             # Do we care about this public key?
-            public_key = PublicKey(public_key_bytes)
-            public_key_metadata = self.spv.wallet.get('public_key', public_key)
-            if public_key_metadata is None:
+            if public_key_bytes not in self.public_keys:
                 continue
 
             # TODO verify signature!
@@ -196,27 +216,18 @@ class PubKeyPaymentMonitor(BaseMonitor):
             if self.spv.logging_level <= DEBUG:
                 print('[PUBKEYPAYMENTMONITOR] tx {} spends {} from our wallet but we dont know the spend yet!'.format(bytes_to_hexstring(tx_hash), input.prevout))
 
-        for i, output in enumerate(tx.outputs):
-            # Analyze the script for standard pubkey payments
-            script = output.script.program
-            if len(script) == 25 and script[0] == OP_DUP \
-                         and script[1] == OP_HASH160 and script[2] == 20 \
-                         and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
-                # Pay-to-pubkey-hash
-                address = base58_check(self.spv.coin, script[3:23], version_bytes=self.spv.coin.ADDRESS_VERSION_BYTES)
-            elif len(script) in (35, 67) and script[0] in (33, 65) and \
-                         script[0] == (len(script) - 2) and script[-1] == OP_CHECKSIG:
-                # Pay-to-pubkey
-                address = base58_check(self.spv.coin, self.spv.coin.hash160(script[1:-1]), version_bytes=self.spv.coin.ADDRESS_VERSION_BYTES)
-            else:
-                # Not a pubkey payment
-                continue
+        # Pay-to-pubkey-hash and pay-to-pubkey payments
+        payments = [(i, output, self.pubkey_hash_addresses.get(key, None)) for i, output, key in classified_tx.get_outputs(TEMPLATE_P2PKH)] + \
+                   [(i, output, self.public_keys.get(key, None)) for i, output, key in classified_tx.get_outputs(TEMPLATE_P2PK)]
 
+        for i, output, address_info in payments:
             # Is this an address we care about?
-            address_info = self.pubkey_addresses.get(address, None)
             if address_info is None:
                 continue
 
+            address = address_info['address']
+            script = output.script.program
+
             # Yes, first make sure it's in the txdb
             self.spv.txdb.save_tx(tx)
 
@@ -229,8 +240,8 @@ class PubKeyPaymentMonitor(BaseMonitor):
             unknown_pubkey_spend_key = (tx_hash, i)
             unknown_pubkey_spend_metadata = self.spv.wallet.get('unknown_pubkey_spends', unknown_pubkey_spend_key)
             if unknown_pubkey_spend_metadata is not None:
-                for tx_hash in unknown_pubkey_spend_metadata['spent_in']:
-                    spend.spent_in.add(tx_hash)
+                for spent_in_hash in unknown_pubkey_spend_metadata['spent_in']:
+                    spend.spent_in.add(spent_in_hash)
 
             # Add to the wallet
             if not self.spv.wallet.add_spend(spend):
@@ -5,6 +5,7 @@ from .basemonitor import BaseMonitor
 from .pubkey import PubKeySpend
 from .. import base58
 from ..keys import PrivateKey, PublicKey
+from ..stealthscan import StealthScanner
 from ..serialize import Serialize
 from ..transaction import TransactionPrevOut, TransactionOutput, TransactionInput
 from ..transactionbuilder import TransactionBuilder
@@ -58,32 +59,72 @@ class StealthAddressPaymentMonitor(BaseMonitor):
     def __init__(self, spv):
         BaseMonitor.__init__(self, spv)
         self.stealth_keys = {}
-        self.spend_by_prevout = {}
+        self.filter_scripts = set()
+        self.scanner = StealthScanner(spv.coin, processes=spv.block_scan_processes)
 
     def on_new_spend(self, spend):
         # We only care about StealthAddressSpend
         if not isinstance(spend, StealthAddressSpend):
             return
 
-        # Save spend to check if it gets spent
-        self.spend_by_prevout[spend.prevout] = spend
+        # Watch its script for compact block filters, the wallet watches its prevout to see if it gets spent
+        self.filter_scripts.add(spend.script)
 
     def on_new_private_key(self, private_key, metadata):
         if metadata.get('stealth_payments', False):
             self.stealth_keys[private_key] = metadata
+            self.scanner.add_key(private_key)
 
             if self.spv.logging_level <= DEBUG:
                 print('[STEALTHADDRESSPAYMENTMONITOR] watching for stealth payments to {}'.format(private_key.get_public_key(True).as_address(self.spv.coin)))
 
+    def get_filter_scripts(self):
+        # Payments can't be found with compact block filters since each one goes to a new address and filters don't include
+        # the OP_RETURN output with the ephemeral key. We can only watch for spends of payments we already know about.
+        return list(self.filter_scripts)
+
+    def get_scan_keys(self):
+        # Any ephemeral key could be a payment to us
+        return {TEMPLATE_STEALTH_EPHEMERAL: None} if len(self.stealth_keys) else {}
+
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        if collection_name != 'private_key' or not metadata.get('stealth_payments', False):
+            return {}
+        return {TEMPLATE_STEALTH_EPHEMERAL: None}
+
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        # Stealth payments carry their own payment key
+        return set()
+
     def on_tx(self, tx):
-        #return # TODO right now OpenSSL breaks on 64-bit MT
-        tx_hash = tx.hash()
+        self.on_classified_tx(ClassifiedTransaction(tx))
+
+    def on_classified_block(self, classified_txs):
+        # The whole block is scanned at once, so that big blocks can be spread across the scanner's worker processes
+        ephemeral_keys = [epubkey_bytes for classified_tx in classified_txs for _, _, epubkey_bytes in classified_tx.get_outputs(TEMPLATE_STEALTH_EPHEMERAL)]
+        stealth_payment_addresses = self.__scan(ephemeral_keys)
+
+        for classified_tx in classified_txs:
+            self.__process_tx(classified_tx, stealth_payment_addresses)
+
+    def on_classified_tx(self, classified_tx):
+        ephemeral_keys = [epubkey_bytes for _, _, epubkey_bytes in classified_tx.get_outputs(TEMPLATE_STEALTH_EPHEMERAL)]
+        self.__process_tx(classified_tx, self.__scan(ephemeral_keys))
+
+    def __scan(self, ephemeral_keys):
+        if len(ephemeral_keys) == 0 or len(self.scanner) == 0:
+            return {}
+        return self.scanner.scan(ephemeral_keys)
+
+    def __process_tx(self, classified_tx, stealth_payment_addresses):
+        tx = classified_tx.tx
+        tx_hash = classified_tx.tx_hash
 
         # check inputs, they might spend coins from the wallet
         # for stealth addresses, we can't know they're getting spend before we've received payment
         for i, input in enumerate(tx.inputs):
-            spend = self.spend_by_prevout.get(input.prevout, None)
-            if spend is None:
+            spend = self.spv.wallet.get_spend_by_prevout(input.prevout)
+            if spend is None or not isinstance(spend, StealthAddressSpend):
                 continue
 
             # Have we've seen this spend before?
@@ -97,50 +138,23 @@ class StealthAddressPaymentMonitor(BaseMonitor):
             if self.spv.logging_level <= INFO:
                 print('[STEALTHADDRESSPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
 
-        # First, build a list of OP_RETURN outputs that fit a stealth payment profile
-        # And turn those parameters into a set of stealth addresses
-        stealth_payment_addresses = {}
-        for i, output in enumerate(tx.outputs):
-            script = output.script.program
-            if len(script) == 35 and script[0] == OP_RETURN and script[1] == 33 and script[2] in (0x02, 0x03):
-                epubkey = PublicKey(script[2:])
-                for stealth_key in self.stealth_keys:
-                    shared_secret_public_key = epubkey.multiply(stealth_key.as_int())
-                    hasher = hashlib.sha256()
-                    hasher.update(shared_secret_public_key.pubkey)
-                    shared_secret = hasher.digest()
-
-                    payment_key = stealth_key.add_constant(int.from_bytes(shared_secret, 'big'))
-                    stealth_payment_addresses[payment_key.get_public_key(True).as_hash160(self.spv.coin)] = {
-                        'stealth_key': stealth_key,
-                        'private_key': payment_key,
-                    }
-
-
-        if list(stealth_payment_addresses) == 0:
+        # stealth_payment_addresses has the addresses our stealth keys would be paid to for the ephemeral keys in the
+        # block (or transaction) this one came from. Payments go to them with a pay-to-pubkey-hash output.
+        if len(stealth_payment_addresses) == 0 or len(classified_tx.get_outputs(TEMPLATE_STEALTH_EPHEMERAL)) == 0:
             return
 
-        for i, output in enumerate(tx.outputs):
-            # Analyze the script for standard pubkey payments to one of our stealth addresses
+        for i, output, address_bytes in classified_tx.get_outputs(TEMPLATE_P2PKH):
+            # Is this a standard pubkey payment to one of our stealth addresses?
             script = output.script.program
-            if len(script) == 25 and script[0] == OP_DUP \
-                         and script[1] == OP_HASH160 and script[2] == 20 \
-                         and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
-                # Pay-to-pubkey-hash
-                address_bytes = script[3:23]
-            else:
-                # Not a pubkey payment
-                continue
-
-            # Is this an address we care about?
-            address_info = stealth_payment_addresses.get(address_bytes, None)
-            if address_info is None:
+            r = stealth_payment_addresses.get(address_bytes, None)
+            if r is None:
                 continue
 
             # Yes, first save this private key
-            stealth_key = self.stealth_keys[address_info['stealth_key']]
+            stealth_key, shared_secret = r
+            payment_key = stealth_key.add_constant(shared_secret)
             try:
-                self.spv.wallet.add('stealth_private_keys', address_info['private_key'], {'label': stealth_key['label']})
+                self.spv.wallet.add('stealth_private_keys', payment_key, {'label': self.stealth_keys[stealth_key]['label']})
             except DuplicateWalletItem:
                 # This is fine.
                 pass
@@ -149,9 +163,9 @@ class StealthAddressPaymentMonitor(BaseMonitor):
             self.spv.txdb.save_tx(tx)
 
             # Build a stealth spend
-            address = address_info['private_key'].get_public_key(True).as_address(self.spv.coin)
+            address = base58_check(self.spv.coin, address_bytes, version_bytes=self.spv.coin.ADDRESS_VERSION_BYTES)
             prevout = TransactionPrevOut(tx_hash, i)
-            spend = StealthAddressSpend(self.spv.coin, 'default', output.amount, address, prevout, script, {'private_key': address_info['private_key'].serialize()})
+            spend = StealthAddressSpend(self.spv.coin, 'default', output.amount, address, prevout, script, {'private_key': payment_key.serialize()})
 
             # Add the spend to the wallet
             if not self.spv.wallet.add_spend(spend):
@@ -0,0 +1,221 @@
+import struct
+
+from .basemonitor import BaseMonitor
+from ..serialize import Serialize
+from ..transaction import TransactionPrevOut
+from ..wallet import Spend
+
+from ..script import *
+from ..util import *
+
+class ExtendedPublicKeySpend(Spend):
+    '''A payment to an address derived from an extended public key.  The private keys aren't in the wallet, so these
+    spends can't be signed here: they're never spendable, and are kept in their own category, out of the way of the
+    wallet's coins.  Serialized the same way as a :py:class:`pyspv.monitors.pubkey.PubKeySpend`.'''
+
+    def __init__(self, coin, category, amount, address, prevout, script, address_info, spent_in=None):
+        Spend.__init__(self, coin, category, amount)
+
+        self.prevout = prevout
+        self.script = script
+        self.address = address
+        self.address_info = address_info
+        self.spent_in = set([] if spent_in is None else spent_in)
+
+    def hash(self):
+        '''one spend is equal to another only based on the prevout value'''
+        return self.coin.hash(self.prevout.serialize())
+
+    def is_spent(self, spv):
+        return any(not spv.txdb.is_conflicted(tx_hash) for tx_hash in self.spent_in)
+
+    def is_spendable(self, spv):
+        return False
+
+    def get_signing_keys(self):
+        # No key added to the wallet makes it spendable
+        return []
+
+    def get_confirmations(self, spv):
+        return spv.txdb.get_tx_depth(self.prevout.tx_hash)
+
+    def create_input_creators(self, spv, hash_flags):
+        raise Exception("signature error: {} is watch-only, its private key is derived from child {} of {} offline".format(self.address, self.address_info['index'], self.address_info['xpub']))
+
+    def serialize(self):
+        return Serialize.serialize_string(self.category) + Serialize.serialize_variable_int(self.amount) + \
+               self.prevout.serialize() + Serialize.serialize_string(self.address) + \
+               struct.pack('<L', len(self.script)) + self.script + \
+               Serialize.serialize_dict(self.address_info) + \
+               Serialize.serialize_list(list(self.spent_in))
+
+    @staticmethod
+    def unserialize(data, coin):
+        category, data = Serialize.unserialize_string(data)
+        amount, data = Serialize.unserialize_variable_int(data)
+        prevout, data = TransactionPrevOut.unserialize(data)
+        address, data = Serialize.unserialize_string(data)
+
+        script_length = struct.unpack("<L", data[:4])[0]
+        script = data[4:4+script_length]
+
+        address_info, data = Serialize.unserialize_dict(data[4+script_length:])
+
+        spent_in, data = Serialize.unserialize_list(data)
+
+        spend = ExtendedPublicKeySpend(coin, category, amount, address, prevout, script, address_info, spent_in=spent_in)
+        return spend, data
+
+    def __str__(self):
+        return '<ExtendedPublicKeySpend {} BTC prevout={} address={}{}>'.format(self.coin.format_money(self.amount), str(self.prevout), self.address, ' SPENT' if len(self.spent_in) else '')
+
+class ExtendedPublicKeyPaymentMonitor(BaseMonitor):
+    '''
+    Watches the addresses derived from BIP32 extended public keys (see :py:class:`pyspv.bip32.ExtendedPublicKey`), for
+    wallets whose private keys are kept offline.  Add an xpub to the wallet's 'xpub' collection with metadata
+    {'label': label, 'used_index': -1}, and its children are watched for pay-to-pubkey-hash and pay-to-pubkey payments.
+
+    Only the children from GAP_LIMIT below the highest used index to GAP_LIMIT past it are derived, BATCH_SIZE at a
+    time.  Each is indexed by hash160 and by public key, so outputs match with one dict lookup.  A payment to a child
+    moves the highest used index up, which is saved in the xpub's metadata, and derives another batch when the
+    lookahead gets shorter than GAP_LIMIT.  Nothing else is saved, so the wallet's size and load time don't depend on
+    how many addresses have been handed out.  Addresses handed out in order are paid close to in order, so the
+    GAP_LIMIT children below the highest used one are still watched after pyspv restarts, for payments that come in
+    late.  Children further below are watched until pyspv restarts, coins already paid to them are tracked by the
+    wallet like any other spend.
+    '''
+
+    spend_classes = [ExtendedPublicKeySpend]
+
+    # Addresses past the highest used one that are watched, as in BIP44
+    GAP_LIMIT = 20
+    BATCH_SIZE = 20
+
+    CATEGORY = 'watch_only'
+
+    def __init__(self, spv):
+        BaseMonitor.__init__(self, spv)
+
+        # xpub string -> [xpub, metadata, index of the next child to derive]
+        self.xpubs = {}
+
+        # address_info for every derived child, by hash160 and by the serialized public key
+        self.pubkey_hash_addresses = {}
+        self.public_keys = {}
+        self.filter_scripts = set()
+
+    def on_new_xpub(self, xpub, metadata):
+        xpub_string = xpub.as_string(self.spv.coin)
+        metadata = dict(metadata)
+        metadata.setdefault('used_index', -1)
+        start_index = max(0, metadata['used_index'] + 1 - ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+        self.xpubs[xpub_string] = [xpub, metadata, start_index]
+        self.__extend(xpub_string)
+
+        if self.spv.logging_level <= DEBUG:
+            print('[EXTENDEDPUBLICKEYPAYMENTMONITOR] watching {} from child {}'.format(xpub_string, start_index))
+
+    def __extend(self, xpub_string):
+        # Derive batches until the lookahead past the highest used child is GAP_LIMIT long
+        state = self.xpubs[xpub_string]
+        xpub, metadata, _ = state
+        while state[2] < metadata['used_index'] + 1 + ExtendedPublicKeyPaymentMonitor.GAP_LIMIT:
+            for i, public_key in xpub.derive_public_keys(state[2], ExtendedPublicKeyPaymentMonitor.BATCH_SIZE):
+                self.__watch(xpub_string, i, public_key)
+            state[2] += ExtendedPublicKeyPaymentMonitor.BATCH_SIZE
+
+    def __watch(self, xpub_string, i, public_key):
+        hash160 = public_key.as_hash160(self.spv.coin)
+        address_info = {
+            'address'       : public_key.as_address(self.spv.coin),
+            'public_key_hex': public_key.as_hex(),
+            'xpub'          : xpub_string,
+            'index'         : i,
+        }
+
+        self.pubkey_hash_addresses[hash160] = address_info
+        self.public_keys[public_key.pubkey] = address_info
+
+        # Pay-to-pubkey-hash and pay-to-pubkey
+        self.filter_scripts.add(bytes([OP_DUP, OP_HASH160, 20]) + hash160 + bytes([OP_EQUALVERIFY, OP_CHECKSIG]))
+        self.filter_scripts.add(bytes([len(public_key.pubkey)]) + public_key.pubkey + bytes([OP_CHECKSIG]))
+
+    def get_filter_scripts(self):
+        return list(self.filter_scripts)
+
+    def get_scan_keys(self):
+        return {
+            TEMPLATE_P2PKH: self.pubkey_hash_addresses,
+            TEMPLATE_P2PK : self.public_keys,
+        }
+
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        if collection_name != 'xpub':
+            return {}
+
+        xpub_string = item.as_string(self.spv.coin)
+        return {
+            TEMPLATE_P2PKH: set(hash160 for hash160, address_info in self.pubkey_hash_addresses.items() if address_info['xpub'] == xpub_string),
+            TEMPLATE_P2PK : set(pubkey for pubkey, address_info in self.public_keys.items() if address_info['xpub'] == xpub_string),
+        }
+
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        # Watch-only
+        return set()
+
+    def on_tx(self, tx):
+        self.on_classified_tx(ClassifiedTransaction(tx))
+
+    def on_classified_tx(self, classified_tx):
+        tx = classified_tx.tx
+        tx_hash = classified_tx.tx_hash
+
+        # check inputs, they might spend coins paid to one of our xpubs
+        for i, input in enumerate(tx.inputs):
+            spend = self.spv.wallet.get_spend_by_prevout(input.prevout)
+            if spend is None or not isinstance(spend, ExtendedPublicKeySpend):
+                continue
+
+            # Have we've seen this spend before?
+            if tx_hash in spend.spent_in:
+                continue
+
+            spend.spent_in.add(tx_hash)
+            self.spv.wallet.update_spend(spend)
+
+            if self.spv.logging_level <= INFO:
+                print('[EXTENDEDPUBLICKEYPAYMENTMONITOR] tx {} spends {} amount={}'.format(bytes_to_hexstring(tx_hash), input.prevout, self.spv.coin.format_money(spend.amount)))
+
+        # Pay-to-pubkey-hash and pay-to-pubkey payments
+        payments = [(i, output, self.pubkey_hash_addresses.get(key, None)) for i, output, key in classified_tx.get_outputs(TEMPLATE_P2PKH)] + \
+                   [(i, output, self.public_keys.get(key, None)) for i, output, key in classified_tx.get_outputs(TEMPLATE_P2PK)]
+
+        for i, output, address_info in payments:
+            if address_info is None:
+                continue
+
+            address = address_info['address']
+            self.spv.txdb.save_tx(tx)
+            self.__use(address_info['xpub'], address_info['index'])
+
+            prevout = TransactionPrevOut(tx_hash, i)
+            spend = ExtendedPublicKeySpend(self.spv.coin, ExtendedPublicKeyPaymentMonitor.CATEGORY, output.amount, address, prevout, output.script.program, address_info)
+
+            if not self.spv.wallet.add_spend(spend):
+                if self.spv.logging_level <= DEBUG:
+                    print('[EXTENDEDPUBLICKEYPAYMENTMONITOR] payment of {} to {} already seen'.format(output.amount, address))
+                continue
+
+            if self.spv.logging_level <= INFO:
+                print('[EXTENDEDPUBLICKEYPAYMENTMONITOR] processed payment of {} to {} (child {} of {})'.format(output.amount, address, address_info['index'], address_info['xpub']))
+
+    def __use(self, xpub_string, i):
+        # Move the highest used index up to i, extend the lookahead and save it.  Saving tells the wallet the filter
+        # scripts changed, so the new children have to be watched by then.
+        xpub, metadata, _ = self.xpubs[xpub_string]
+        if i <= metadata['used_index']:
+            return
+
+        metadata['used_index'] = i
+        self.__extend(xpub_string)
+        self.spv.wallet.update('xpub', xpub, metadata)
@@ -1,18 +1,23 @@
 import collections
 import ipaddress
 import random
+import shelve
 import socket
 import struct
 import threading
 import time
 import traceback
 
+from contextlib import closing
+
 from . import socks
 
 from .block import Block, BlockHeader
 from .bloom import Bloom
+from .cfilter import FilterQuery, GCSFilter, InvalidFilter
+from .filterdb import FilterDatabase
 from .inv import Inv
-from .serialize import Serialize
+from .serialize import Serialize, SerializeDataTooShort
 from .transaction import Transaction
 from .util import *
 
@@ -30,16 +35,51 @@ class Manager(threading.Thread):
 
     PEER_RECORD_SIZE = 14
 
-    PROTOCOL_VERSION = 60002
+    PROTOCOL_VERSION = 70012
+    SENDHEADERS_VERSION = 70012 # BIP130
     SERVICES = 1
 
     BLOCKCHAIN_SYNC_WAIT_TIME = 10
 
+    # Upper bounds on request timeouts. The actual deadlines are derived per peer from measured
+    # latency and throughput (see Peer.request_timeout)
     HEADERS_REQUEST_TIMEOUT   = 25
     GETBLOCKS_REQUEST_TIMEOUT = 60
     BLOCK_REQUEST_TIMEOUT     = 120
     TX_REQUEST_TIMEOUT        = 30
 
+    MAX_HEADERS_MESSAGE_SIZE = 2000 * 81
+
+    # Batch sizes when serving getheaders/getblocks, same as the reference client
+    MAX_HEADERS_PER_MESSAGE = 2000
+    MAX_BLOCKS_PER_INV      = 500
+    MAX_LOCATOR_HASHES      = 101
+
+    STATIC_PEER_RETRY_TIME = 30
+
+    # Compact block filters (BIP157)
+    NODE_COMPACT_FILTERS      = (1 << 6)
+
+    # Our own filters aren't BIP158 filters, so they're advertised with a service bit from the range for experiments
+    # and only asked of static peers
+    NODE_LOCAL_FILTERS        = (1 << 24)
+    MAX_CFHEADERS_PER_REQUEST = 2000
+
+    # BIP157 filter headers are only used once this many peers have sent the same ones
+    CFHEADERS_AGREEMENT       = 2
+    MAX_CFILTERS_PER_REQUEST  = 1000
+    FILTERS_REQUEST_TIMEOUT   = 60
+    EXPECTED_FILTER_SIZE      = 20*1024
+    MATCHED_BLOCK_RETRY_TIME  = 5*60
+
+    # Header sync waits when filters fall this far behind. Has to be less than the number of headers Blockchain
+    # keeps on disk, so that after a restart we still have the block hashes the next filters are requested by.
+    MAX_FILTER_LAG = 1000
+
+    # Blocks downloaded again for a wallet rescan
+    RESCAN_BLOCKS_PER_PEER    = 16
+    RESCAN_BLOCK_RETRY_TIME   = 2*60
+
     MAX_MESSAGE_SIZE = 2*1024*1024
 
     INVENTORY_CHECK_TIME = 3
@@ -51,17 +91,26 @@ class Manager(threading.Thread):
     INVENTORY_FLAG_HOLD_FOREVER = 0x01
     INVENTORY_FLAG_MUST_CONFIRM = 0x02
 
-    def __init__(self, spv=None, peer_goal=1, listen=('', 0), tor=False, user_agent='pyspv'):
+    def __init__(self, spv=None, peer_goal=1, listen=('', 0), tor=False, user_agent='pyspv', serve_blockchain=False, static_peers=(), compact_filters=False, serve_filters=False):
         threading.Thread.__init__(self)
         self.spv = spv
         self.peer_goal = peer_goal
         self.user_agent = '/{}/'.format(user_agent).replace(' ', ':')
 
+        # When serving, peers (usually other pyspv instances on the LAN) can sync headers from us
+        self.serve_blockchain = serve_blockchain
+
+        # Peers we always try to stay connected to, ahead of anything in the address store
+        self.static_peers = list(static_peers)
+        self.static_peer_retry_times = {}
+
         self.peers = {}
         self.peer_addresses_db_file = self.spv.config.get_file("addresses.dat")
         self.peer_address_lock = threading.Lock()
         self.load_peer_addresses()
 
+        self.seed_resolver = SeedResolver(self)
+
         self.inv_lock = threading.Lock()
         self.inprogress_invs = {}
         self.inventory = collections.deque()
@@ -75,6 +124,36 @@ class Manager(threading.Thread):
         self.headers_request = None
         self.headers_request_last_peer = None
 
+        # Running estimate of block size, used to compute block request deadlines
+        self.expected_block_size = self.spv.coin.MAX_BLOCK_SIZE
+
+        # Instead of downloading every block, fetch their compact filters and only download the blocks that match
+        self.compact_filters = compact_filters
+        self.filter_lock = threading.Lock()
+        self.filter_request = None
+        self.filter_hashes = {}
+        self.filter_headers = {}
+        self.filter_headers_check = None
+        self.filter_reorgs = collections.deque()
+        self.filter_query = FilterQuery([])
+        self.filter_query_items = (frozenset(), frozenset())
+        self.expected_filter_size = Manager.EXPECTED_FILTER_SIZE
+        self.filters_db_file = self.spv.config.get_file("cfilters")
+        self.load_filter_state()
+
+        # When serving filters, we build them from the full blocks we receive and answer getcfilters/getcfheaders
+        self.filterdb = None
+        if serve_filters:
+            if compact_filters:
+                if self.spv.logging_level <= WARNING:
+                    print("[NETWORK] can't serve filters without downloading every block, not serving filters")
+            else:
+                self.filterdb = FilterDatabase(self.spv)
+
+        # block_hash -> [callback, time last requested] for blocks a rescan wants downloaded again
+        self.rescan_lock = threading.Lock()
+        self.rescan_blocks = collections.OrderedDict()
+
         self.tor = tor
         if tor:
             # Using Tor disables incoming connections
@@ -90,6 +169,7 @@ class Manager(threading.Thread):
 
     def start(self):
         self.running = False
+        self.seed_resolver.start()
         threading.Thread.start(self)
 
         # Wait for thread to start ...
@@ -101,6 +181,7 @@ class Manager(threading.Thread):
         for _, p in self.peers.items():
             p.shutdown()
 
+        self.seed_resolver.shutdown()
         self.running = False
 
     def join(self, *args, **kwargs):
@@ -122,6 +203,8 @@ class Manager(threading.Thread):
                     print(line, end='')
 
                 print("\n*** STACKTRACE - END ***")
+        if self.seed_resolver.is_alive():
+            self.seed_resolver.join(*args, **kwargs)
         threading.Thread.join(self, *args, **kwargs)
 
     def run(self):
@@ -136,7 +219,8 @@ class Manager(threading.Thread):
             now = time.time()
 
             if len(self.peer_addresses) < 5:
-                self.get_new_addresses_from_peer_sources()
+                # Non-blocking, the seed resolver thread adds the addresses it finds
+                self.seed_resolver.request()
 
             self.check_for_incoming_connections()
             self.check_for_dead_peers()
@@ -144,13 +228,31 @@ class Manager(threading.Thread):
             self.manage_inventory()
 
             with self.blockchain_sync_lock:
-                if self.headers_request is not None and \
-                       ((self.headers_request['peer'].inprogress_command != 'headers' and (now - self.headers_request['time']) >= Manager.HEADERS_REQUEST_TIMEOUT) or \
-                        (self.headers_request['peer'].inprogress_command == 'headers' and (now - self.headers_request['peer'].last_data_time) >= Manager.HEADERS_REQUEST_TIMEOUT)):
-
-                    # Misbehaving/dead peer?
-                    self.peer_is_bad(self.headers_request['peer'].peer_address)
-                    self.headers_request['peer'].state = 'dead'
+                if self.headers_request is not None and now >= self.headers_request['deadline']:
+                    peer = self.headers_request['peer']
+                    if peer.inprogress_command == 'headers' and (now - peer.last_data_time) < peer.request_timeout(0, Manager.HEADERS_REQUEST_TIMEOUT):
+                        # Still streaming the response, give it until the data stops
+                        self.headers_request['deadline'] = peer.last_data_time + peer.request_timeout(0, Manager.HEADERS_REQUEST_TIMEOUT)
+                    else:
+                        # Let another peer have the request right away. headers_request_last_peer keeps
+                        # this peer from being picked again immediately.
+                        if self.spv.logging_level <= INFO:
+                            print("[NETWORK] {} missed headers deadline, reassigning".format(peer.peer_address))
+                        self.headers_request = None
+                        peer.headers_request = None
+                        peer.missed_deadline()
+
+            with self.filter_lock:
+                if self.filter_request is not None and now >= self.filter_request['deadline']:
+                    peer = self.filter_request['peer']
+                    if peer.inprogress_command in ('cfheaders', 'cfilter') and (now - peer.last_data_time) < peer.request_timeout(0, Manager.FILTERS_REQUEST_TIMEOUT):
+                        self.filter_request['deadline'] = peer.last_data_time + peer.request_timeout(0, Manager.FILTERS_REQUEST_TIMEOUT)
+                    else:
+                        if self.spv.logging_level <= INFO:
+                            print("[NETWORK] {} missed {} deadline, reassigning".format(peer.peer_address, self.filter_request['command']))
+                        self.filter_request = None
+                        peer.filter_request = None
+                        peer.missed_deadline()
 
             time.sleep(0.01)
 
@@ -160,14 +262,6 @@ class Manager(threading.Thread):
         if self.listen_socket is not None:
             self.listen_socket.close()
 
-    def get_new_addresses_from_peer_sources(self):
-        for seed in self.spv.coin.SEEDS:
-            for _, _, _, _, ipport in socket.getaddrinfo(seed, None):
-                if len(ipport) != 2: # no IPv6 support yet
-                    continue
-                ip, _ = ipport
-                self.add_peer_address((ip, self.spv.coin.DEFAULT_PORT))
-
     def add_peer_address(self, peer_address):
         if peer_address in self.peer_addresses:
             return True
@@ -217,7 +311,8 @@ class Manager(threading.Thread):
             data = fp.read(Manager.PEER_RECORD_SIZE)
             fp.truncate(self.peer_index * Manager.PEER_RECORD_SIZE)
 
-            if old['index'] == (fp.tell() // Manager.PEER_RECORD_SIZE):
+            # The final record was the one deleted
+            if old['index'] == self.peer_index:
                 return
 
             port, _ = struct.unpack("<Hd", data[4:])
@@ -301,6 +396,9 @@ class Manager(threading.Thread):
                 if self.headers_request is not None and self.headers_request['peer'] is peer:
                     # We lost a peer who was requesting headers, so let someone else do it.
                     self.headers_request = None
+
+                if self.filter_request is not None and self.filter_request['peer'] is peer:
+                    self.filter_request = None
  
                 for inv in peer.inprogress_invs:
                     if inv in self.inprogress_invs:
@@ -316,6 +414,14 @@ class Manager(threading.Thread):
                 traceback.print_exc()
         
     def start_new_peer(self):
+        now = time.time()
+        for p in self.static_peers:
+            if p not in self.peers and now >= self.static_peer_retry_times.get(p, 0):
+                self.static_peer_retry_times[p] = now + Manager.STATIC_PEER_RETRY_TIME
+                self.peers[p] = Peer(self, p)
+                self.peers[p].start()
+                return
+
         peer_addresses = list(self.peer_addresses.keys())
         while len(peer_addresses) > 0:
             k = random.randrange(0, len(peer_addresses))
@@ -358,6 +464,9 @@ class Manager(threading.Thread):
         # makes it into a block.  Once we get a block, all transactions in the
         # block are examined.
 
+        with self.rescan_lock:
+            rescan = inv.hash in self.rescan_blocks
+
         with self.inv_lock:
             if inv in self.inprogress_invs:
                 return Manager.REQUEST_WAIT
@@ -369,12 +478,18 @@ class Manager(threading.Thread):
                 if self.tx_bloom_filter.has(inv.hash):
                     return Manager.REQUEST_DONT
 
-            elif inv.type == Inv.MSG_BLOCK:
-                if self.spv.blockchain.get_needs_headers():
-                    return Manager.REQUEST_WAIT
+            elif inv.type == Inv.MSG_BLOCK and not rescan:
+                # (Blocks a rescan wants are downloaded again even though we've seen them)
+                if self.compact_filters:
+                    # Blocks are only downloaded when their filter matches, new blocks come in as headers
+                    if inv.hash not in self.filter_matched_blocks:
+                        return Manager.REQUEST_DONT
+                else:
+                    if self.spv.blockchain.get_needs_headers():
+                        return Manager.REQUEST_WAIT
 
-                if inv.hash in self.spv.blockchain.blocks:
-                    return Manager.REQUEST_DONT
+                    if inv.hash in self.spv.blockchain.blocks:
+                        return Manager.REQUEST_DONT
 
             self.inprogress_invs[inv] = time.time()
             return Manager.REQUEST_GO
@@ -391,9 +506,15 @@ class Manager(threading.Thread):
             if peer is self.headers_request_last_peer:
                 return Manager.REQUEST_WAIT
 
+            if self.compact_filters and self.filter_height is not None and (self.spv.blockchain.get_best_chain_height() - self.filter_height) >= Manager.MAX_FILTER_LAG:
+                # Let filters catch up first
+                return Manager.REQUEST_WAIT
+
+            now = time.time()
             self.headers_request = {
-                'time': time.time(),
-                'peer': peer
+                'time'    : now,
+                'deadline': now + peer.request_timeout(Manager.MAX_HEADERS_MESSAGE_SIZE, Manager.HEADERS_REQUEST_TIMEOUT),
+                'peer'    : peer
             }
 
             self.headers_request_last_peer = peer
@@ -425,10 +546,381 @@ class Manager(threading.Thread):
             with self.blockchain_sync_lock:
                 self.headers_request = None
 
+    def received_announced_headers(self, headers):
+        '''headers were pushed to us by a peer (BIP130) rather than requested.  Returns False if they don't connect
+        to our blockchain.'''
+        # Another peer probably announced the same block already
+        headers = [header for header in headers if header.hash() not in self.spv.blockchain.blocks]
+        if len(headers) == 0:
+            return True
+
+        with self.blockchain_sync_lock:
+            # Don't interfere with a getheaders in progress, its response will include these headers
+            if self.headers_request is not None:
+                return True
+
+        return self.spv.blockchain.add_block_headers(headers)
+
+    def reassign_inv(self, inv, from_peer):
+        '''from_peer missed the deadline for inv. Hand the request to the connected peer with the best measured
+        throughput that isn't already busy, or back to from_peer if there's nobody else.'''
+        with self.inv_lock:
+            if inv in self.inprogress_invs:
+                self.inprogress_invs.pop(inv)
+
+        candidates = [peer for peer in list(self.peers.values()) if peer is not from_peer and peer.is_ready()]
+        if len(candidates) == 0:
+            from_peer.queue_inv(inv)
+            return
+
+        best = max(candidates, key=lambda peer: (peer.throughput or 0) / (1 + len(peer.inprogress_invs)))
+        best.queue_inv(inv)
+
+        if self.spv.logging_level <= INFO:
+            print("[NETWORK] reassigned {} from {} to {}".format(str(inv), from_peer.peer_address, best.peer_address))
+
+    def item_not_found(self, inv, from_peer):
+        '''from_peer replied notfound to our getdata for inv.  Blocks are asked of another peer if there is one,
+        otherwise the request is dropped and retried the next time the block is announced.'''
+        if inv.type == Inv.MSG_TX:
+            self.received_transaction(inv, None)
+            return
+
+        if any(peer is not from_peer and peer.is_ready() for peer in list(self.peers.values())):
+            self.reassign_inv(inv, from_peer)
+            return
+
+        with self.inv_lock:
+            if inv in self.inprogress_invs:
+                self.inprogress_invs.pop(inv)
+
+    def load_filter_state(self):
+        with closing(shelve.open(self.filters_db_file)) as db:
+            if 'filter_height' not in db or self.spv.args.resync:
+                db['filter_height'] = None
+                db['filter_header'] = None
+                db['matched_blocks'] = set()
+
+            # The type of the filters we're syncing, filter headers of another type don't continue the chain
+            if 'filter_type' not in db or self.spv.args.resync:
+                db['filter_type'] = GCSFilter.BASIC_FILTER_TYPE
+
+            # The next height we need a filter for, and the filter header before it
+            self.filter_type = db['filter_type']
+            self.filter_height = db['filter_height']
+            if db['filter_header'] is not None:
+                self.filter_headers[self.filter_height - 1] = db['filter_header']
+
+            # Blocks with matching filters that we haven't downloaded yet
+            self.filter_matched_blocks = dict((block_hash, 0) for block_hash in db['matched_blocks'])
+
+    def save_filter_state(self):
+        # call with filter_lock held
+        with closing(shelve.open(self.filters_db_file)) as db:
+            db['filter_type'] = self.filter_type
+            db['filter_height'] = self.filter_height
+            db['filter_header'] = self.filter_headers.get(self.filter_height - 1, None) if self.filter_height is not None else None
+            db['matched_blocks'] = set(self.filter_matched_blocks.keys())
+
+    def on_block_added(self, block_header, block_height):
+        if self.filterdb is not None:
+            self.filterdb.on_block_added(block_header, block_height)
+
+    def on_block_removed(self, block_header, block_height):
+        # Applied later by the thread that next looks at filters, since we're called with the blockchain locked
+        if self.compact_filters:
+            self.filter_reorgs.append(block_height)
+
+        if self.filterdb is not None:
+            self.filterdb.on_block_removed(block_header, block_height)
+
+    def __apply_filter_reorgs(self):
+        # call with filter_lock held
+        while len(self.filter_reorgs):
+            height = self.filter_reorgs.popleft()
+
+            for h in [h for h in self.filter_hashes.keys() if h >= height]:
+                self.filter_hashes.pop(h)
+
+            for h in [h for h in self.filter_headers.keys() if h >= height]:
+                self.filter_headers.pop(h)
+
+            if self.filter_height is not None and self.filter_height > height:
+                self.filter_height = height
+
+            check = self.filter_headers_check
+            if check is not None and check['start_height'] + len(check['block_hashes']) > height:
+                self.filter_headers_check = None
+
+            if self.filter_request is not None:
+                self.filter_request['peer'].filter_request = None
+                self.filter_request = None
+
+    def get_filter_type(self, peer):
+        '''Returns the type of filters to sync from peer, or None if it doesn't serve filters.  Our own filter type is
+        only asked of static peers, which are usually pyspv instances serving filters on the LAN.'''
+        if (peer.peer_services & Manager.NODE_LOCAL_FILTERS) != 0 and peer.peer_address in self.static_peers:
+            return GCSFilter.LOCAL_FILTER_TYPE
+        if (peer.peer_services & Manager.NODE_COMPACT_FILTERS) != 0:
+            return GCSFilter.BASIC_FILTER_TYPE
+        return None
+
+    def will_request_filters(self, peer, filter_type):
+        '''Returns the next getcfheaders or getcfilters request peer should make for filters of filter_type, or None if
+        there's nothing to do (or another peer is already on it).  Filter headers are always fetched before the filters
+        they cover.'''
+        with self.filter_lock:
+            self.__apply_filter_reorgs()
+
+            if self.filter_request is not None:
+                return None
+
+            if filter_type != self.filter_type:
+                # The filter hashes we have are for the other type.  Switch between batches, or when nobody is left to
+                # finish the batch.  The new type's filter headers can't be checked against the old ones.
+                if len(self.filter_hashes) and any(p is not peer and p.is_ready() and self.get_filter_type(p) == self.filter_type for p in list(self.peers.values())):
+                    return None
+                self.filter_type = filter_type
+                self.filter_hashes.clear()
+                self.filter_headers.clear()
+                self.filter_headers_check = None
+
+            if self.filter_height is None:
+                self.filter_height = self.spv.blockchain.get_filter_start_height()
+                if self.filter_height is None:
+                    # Haven't synced headers up to the wallet creation time yet
+                    return None
+
+            start_height = self.filter_height
+            best_height = self.spv.blockchain.get_best_chain_height()
+            if start_height > best_height:
+                return None
+
+            if start_height not in self.filter_hashes:
+                command = 'getcfheaders'
+                stop_height = min(best_height, start_height + Manager.MAX_CFHEADERS_PER_REQUEST - 1)
+
+                # A batch being checked is asked of peers that haven't sent it yet, for the same blocks
+                check = self.filter_headers_check
+                if check is not None and check['start_height'] == start_height and check['filter_type'] == filter_type:
+                    if peer.peer_address in check['answers']:
+                        return None
+                    stop_height = min(best_height, start_height + len(check['block_hashes']) - 1)
+            else:
+                command = 'getcfilters'
+                stop_height = start_height
+                while (stop_height + 1) in self.filter_hashes and (stop_height + 1 - start_height) < Manager.MAX_CFILTERS_PER_REQUEST:
+                    stop_height += 1
+
+        # The blockchain can't be locked while we hold filter_lock (see on_block_removed)
+        block_hashes = self.spv.blockchain.get_main_chain_hashes(start_height, stop_height)
+        if block_hashes is None:
+            return None
+
+        if command == 'getcfheaders':
+            expected_size = 32 * len(block_hashes)
+        else:
+            expected_size = self.expected_filter_size * len(block_hashes)
+
+        now = time.time()
+        with self.filter_lock:
+            if self.filter_request is not None or self.filter_height != start_height or self.filter_type != filter_type or len(self.filter_reorgs):
+                return None
+
+            self.filter_request = {
+                'command'     : command,
+                'filter_type' : filter_type,
+                'peer'        : peer,
+                'start_height': start_height,
+                'next_height' : start_height,
+                'block_hashes': block_hashes,
+                'deadline'    : now + peer.request_timeout(expected_size, Manager.FILTERS_REQUEST_TIMEOUT),
+            }
+
+            return self.filter_request
+
+    def received_cfheaders(self, peer, filter_type, stop_hash, previous_filter_header, filter_hashes):
+        '''Returns False if the peer sent headers that don't fit our request or the filter headers we already have'''
+        with self.filter_lock:
+            self.__apply_filter_reorgs()
+
+            request = self.filter_request
+            if request is None or request['peer'] is not peer or request['command'] != 'getcfheaders':
+                # We gave up waiting or a reorg canceled the request
+                return True
+
+            block_hashes = request['block_hashes']
+            if filter_type != request['filter_type'] or stop_hash != block_hashes[-1] or len(filter_hashes) != len(block_hashes):
+                return False
+
+            # Each batch of filter headers has to continue the chain of filter headers we got before. The very first
+            # batch we can only take on trust.
+            start_height = request['start_height']
+            expected_previous_filter_header = self.filter_headers.get(start_height - 1, None)
+            if expected_previous_filter_header is not None and previous_filter_header != expected_previous_filter_header:
+                return False
+
+            self.filter_request = None
+            peer.filter_request = None
+
+            # Any peer can make up a chain of filter headers that connects, so BIP157 filter headers are only used once
+            # CFHEADERS_AGREEMENT peers sent the same ones.  Our own filters come from static peers, which are trusted.
+            bad_peer_addresses = []
+            if filter_type == GCSFilter.BASIC_FILTER_TYPE:
+                check = self.filter_headers_check
+                if check is None or check['start_height'] != start_height or check['block_hashes'] != block_hashes or check['filter_type'] != filter_type:
+                    check = self.filter_headers_check = {
+                        'filter_type' : filter_type,
+                        'start_height': start_height,
+                        'block_hashes': block_hashes,
+                        'answers'     : {},
+                    }
+
+                answer = (previous_filter_header, tuple(filter_hashes))
+                check['answers'][peer.peer_address] = answer
+                if sum(1 for a in check['answers'].values() if a == answer) < Manager.CFHEADERS_AGREEMENT:
+                    if len(set(check['answers'].values())) > 1 and self.spv.logging_level <= WARNING:
+                        print("[NETWORK] peers disagree on the filter headers for blocks {} to {}".format(start_height, start_height + len(filter_hashes) - 1))
+                    return True
+
+                # The peers that sent something else lied about the filters
+                bad_peer_addresses = [peer_address for peer_address, a in check['answers'].items() if a != answer]
+                self.filter_headers_check = None
+
+            filter_header = previous_filter_header
+            for i, filter_hash in enumerate(filter_hashes):
+                filter_header = self.spv.coin.hash(filter_hash + filter_header)
+                self.filter_hashes[start_height + i] = filter_hash
+                self.filter_headers[start_height + i] = filter_header
+
+        for peer_address in bad_peer_addresses:
+            self.peer_is_bad(peer_address)
+
+        if self.spv.logging_level <= INFO:
+            print("[NETWORK] got filter headers for blocks {} to {}".format(start_height, start_height + len(filter_hashes) - 1))
+
+        return True
+
+    def received_cfilter(self, peer, filter_type, block_hash, filter_data, scripts, prevouts):
+        '''Check the filter for block_hash against scripts (the wallet's filter scripts), and prevouts (the wallet's
+        serialized prevouts) if it's one of our own filters.  Returns False if the filter isn't what we asked for or
+        doesn't match its filter header.'''
+        with self.filter_lock:
+            self.__apply_filter_reorgs()
+
+            request = self.filter_request
+            if request is None or request['peer'] is not peer or request['command'] != 'getcfilters':
+                return True
+
+            height = request['next_height']
+            if filter_type != request['filter_type'] or block_hash != request['block_hashes'][height - request['start_height']]:
+                return False
+
+            if self.spv.coin.hash(filter_data) != self.filter_hashes[height]:
+                return False
+
+            try:
+                gcs = GCSFilter.unserialize(filter_data, block_hash)
+                matched = self.__get_filter_query(scripts, prevouts if filter_type == GCSFilter.LOCAL_FILTER_TYPE else ()).matches(gcs)
+            except (InvalidFilter, SerializeDataTooShort):
+                return False
+
+            if matched:
+                self.filter_matched_blocks[block_hash] = 0
+                if self.spv.logging_level <= INFO:
+                    print("[NETWORK] filter matched block {} (height={})".format(bytes_to_hexstring(block_hash), height))
+
+            self.expected_filter_size = (self.expected_filter_size * 7 + len(filter_data)) // 8
+
+            # Keep the filter header at height, it's the previous header for the next getcfheaders
+            self.filter_height = height + 1
+            self.filter_hashes.pop(height)
+            self.filter_headers.pop(height - 1, None)
+
+            request['next_height'] = height + 1
+            request['deadline'] = max(request['deadline'], time.time() + peer.request_timeout(self.expected_filter_size, Manager.FILTERS_REQUEST_TIMEOUT))
+
+            if request['next_height'] == request['start_height'] + len(request['block_hashes']):
+                self.filter_request = None
+                peer.filter_request = None
+                self.save_filter_state()
+
+        return True
+
+    def __get_filter_query(self, scripts, prevouts):
+        # call with filter_lock held. The wallet's scripts rarely change, so the query is only rebuilt when they do.
+        # The wallet hands out the same frozensets until then, which frozenset() returns as is, and comparing the tuples
+        # checks identity first.
+        items = (frozenset(scripts), frozenset(prevouts))
+        if items != self.filter_query_items:
+            self.filter_query = FilterQuery(items[0] | items[1])
+            self.filter_query_items = items
+        return self.filter_query
+
+    def take_matched_blocks(self):
+        '''Returns the hashes of blocks that matched a filter which haven't been requested recently'''
+        now = time.time()
+        with self.filter_lock:
+            block_hashes = [block_hash for block_hash, when in self.filter_matched_blocks.items() if (now - when) >= Manager.MATCHED_BLOCK_RETRY_TIME]
+            for block_hash in block_hashes:
+                self.filter_matched_blocks[block_hash] = now
+            return block_hashes
+
+    def request_rescan_blocks(self, block_hashes, callback):
+        '''Downloads the blocks in block_hashes from any peers, in order, even though we've already seen them, and hands
+        each one to callback instead of the usual block processing.  Used by :py:class:`pyspv.rescan.Rescan`.'''
+        with self.rescan_lock:
+            for block_hash in block_hashes:
+                self.rescan_blocks[block_hash] = [callback, 0]
+
+    def cancel_rescan_blocks(self, block_hashes):
+        with self.rescan_lock:
+            for block_hash in block_hashes:
+                self.rescan_blocks.pop(block_hash, None)
+
+    def take_rescan_blocks(self, count):
+        '''Returns up to count of the rescan blocks which haven't been requested recently.  Each peer takes its own
+        window of blocks, so they're downloaded from several peers at once.'''
+        now = time.time()
+        block_hashes = []
+        with self.rescan_lock:
+            for block_hash, r in self.rescan_blocks.items():
+                if (now - r[1]) < Manager.RESCAN_BLOCK_RETRY_TIME:
+                    continue
+                r[1] = now
+                block_hashes.append(block_hash)
+                if len(block_hashes) == count:
+                    break
+        return block_hashes
+
     def received_block(self, inv, block, syncing_blockchain):
+        self.expected_block_size = (self.expected_block_size * 7 + block.serialize_size()) // 8
+
+        with self.rescan_lock:
+            r = self.rescan_blocks.pop(inv.hash, None)
+
+        if r is not None:
+            # An old block a rescan asked for, we've processed it already
+            r[0](block)
+            with self.inv_lock:
+                if inv in self.inprogress_invs:
+                    self.inprogress_invs.pop(inv)
+            return
+
+        if self.compact_filters:
+            with self.filter_lock:
+                if self.filter_matched_blocks.pop(inv.hash, None) is not None:
+                    # An old block we only wanted for the wallet, don't relay it
+                    syncing_blockchain = True
+                    self.save_filter_state()
+
         if not syncing_blockchain:
             self.add_to_inventory(inv, block)
         self.spv.on_block(block)
+
+        if self.filterdb is not None:
+            self.filterdb.on_block(block)
+
         self.spv.blockchain.add_block(block)
 
         with self.inv_lock:
@@ -535,16 +1027,139 @@ class Manager(threading.Thread):
 
             return Manager.REQUEST_GO
 
+################################################################################
+################################################################################
+class SeedResolver(threading.Thread):
+    '''Resolves the coin's DNS seeds in the background so the Manager loop never waits on DNS.
+
+    All seeds are looked up in parallel.  Each seed's result is cached for SEED_CACHE_TIME seconds (or
+    SEED_RETRY_TIME seconds if the lookup failed) and the seed isn't queried again while its entry is fresh.
+    Cached addresses are handed back to the Manager's peer address store on every request.  The TTL lives here
+    rather than in the peer address store, whose on-disk records only hold the address and the last successful
+    connection time.
+
+    :param manager: the network manager that receives addresses via :py:meth:`Manager.peer_found`
+    :param resolver: a function compatible with socket.getaddrinfo, replaceable for testing
+    '''
+    SEED_CACHE_TIME = 30*60
+    SEED_RETRY_TIME = 60
+    SEED_RESOLVE_TIMEOUT = 30
+
+    def __init__(self, manager, resolver=socket.getaddrinfo):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.manager = manager
+        self.resolver = resolver
+        self.seed_cache = {}
+        self.seed_cache_lock = threading.Lock()
+        self.request_event = threading.Event()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def shutdown(self):
+        self.running = False
+        self.request_event.set()
+
+    def request(self):
+        '''Ask for more peer addresses.  Returns immediately.'''
+        self.request_event.set()
+
+    def run(self):
+        while self.running:
+            self.request_event.wait(1)
+            if not self.running:
+                break
+            if not self.request_event.is_set():
+                continue
+            self.request_event.clear()
+
+            try:
+                self.resolve_seeds()
+            except:
+                traceback.print_exc()
+
+    def resolve_seeds(self):
+        '''Query every seed without a fresh cache entry (in parallel), then hand all cached addresses to the manager'''
+        now = time.time()
+
+        with self.seed_cache_lock:
+            stale_seeds = [seed for seed in self.manager.spv.coin.SEEDS if seed not in self.seed_cache or self.seed_cache[seed]['expires'] <= now]
+
+        threads = [threading.Thread(target=self.resolve_seed, args=(seed,)) for seed in stale_seeds]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        deadline = time.time() + SeedResolver.SEED_RESOLVE_TIMEOUT
+        for t in threads:
+            t.join(max(0, deadline - time.time()))
+
+        with self.seed_cache_lock:
+            peer_addresses = [peer_address for seed in self.manager.spv.coin.SEEDS if seed in self.seed_cache for peer_address in self.seed_cache[seed]['addresses']]
+
+        for peer_address in peer_addresses:
+            self.manager.peer_found(peer_address)
+
+    def resolve_seed(self, seed):
+        addresses = []
+        try:
+            for _, _, _, _, ipport in self.resolver(seed, None):
+                if len(ipport) != 2: # no IPv6 support yet
+                    continue
+                ip, _ = ipport
+                peer_address = (ip, self.manager.spv.coin.DEFAULT_PORT)
+                if peer_address not in addresses:
+                    addresses.append(peer_address)
+        except (socket.error, UnicodeError):
+            if self.manager.spv.logging_level <= WARNING:
+                print("[SEEDRESOLVER] couldn't resolve seed {}".format(seed))
+
+        cache_time = SeedResolver.SEED_CACHE_TIME if len(addresses) else SeedResolver.SEED_RETRY_TIME
+
+        with self.seed_cache_lock:
+            self.seed_cache[seed] = {
+                'expires'  : time.time() + cache_time,
+                'addresses': addresses,
+            }
+
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[SEEDRESOLVER] seed {} returned {} addresses".format(seed, len(addresses)))
+
 ################################################################################
 ################################################################################
 class Peer(threading.Thread):
     MAX_INVS_IN_PROGRESS = 10
 
+    PING_INTERVAL = 2*60
+
+    # Request deadline = LATENCY_FACTOR * latency + SIZE_FACTOR * expected bytes / throughput, never less than
+    # MIN_REQUEST_TIMEOUT and never more than the Manager's fixed timeout for that request type
+    LATENCY_FACTOR      = 4
+    SIZE_FACTOR         = 2
+    MIN_REQUEST_TIMEOUT = 5
+
+    # Messages smaller than this are dominated by latency and don't tell us much about throughput
+    MIN_THROUGHPUT_SAMPLE_SIZE = 16*1024
+
+    # Weight given to each new latency/throughput sample
+    ESTIMATE_WEIGHT = 0.25
+
+    MAX_MISSED_DEADLINES = 3
+
+    # Serving getheaders/getblocks: each request costs a token and tokens refill at SERVE_REQUEST_RATE per second
+    SERVE_REQUEST_RATE        = 10
+    SERVE_REQUEST_BURST       = 20
+    MAX_QUEUED_SERVE_REQUESTS = 10
+
     def __init__(self, manager, peer_address, sock=None):
         threading.Thread.__init__(self)
         self.manager = manager
         self.peer_address = peer_address
         self.socket = sock
+        self.incoming = sock is not None
 
     def shutdown(self):
         self.running = False
@@ -577,7 +1192,6 @@ class Peer(threading.Thread):
             self.bytes_sent = 0
             self.bytes_received = 0
             self.last_data_time = time.time()
-            self.last_block_inv_time = time.time()
             self.inprogress_command = ''
             self.outgoing_data_queue = collections.deque()
             self.peer_verack = 0
@@ -590,6 +1204,24 @@ class Peer(threading.Thread):
             self.next_sync_time = 0
             self.last_inventory_check_time = time.time()
             self.requested_invs = collections.deque()
+            self.reassigned_invs = collections.deque()
+            self.abandoned_invs = set()
+            self.inv_deadlines = {}
+            self.last_block_deadline = 0
+            self.latency = None
+            self.throughput = None
+            self.missed_deadlines = 0
+            self.message_start_time = time.time()
+            self.message_receive_time = 0
+            self.version_sent_time = None
+            self.sent_sendheaders = False
+            self.peer_wants_headers = False
+            self.ping_nonce = None
+            self.ping_time = 0
+            self.filter_request = None
+            self.serve_requests = collections.deque()
+            self.serve_tokens = Peer.SERVE_REQUEST_BURST
+            self.serve_tokens_time = time.time()
             if self.socket is None:
                 if self.make_connection():
                     self.send_version()
@@ -601,8 +1233,12 @@ class Peer(threading.Thread):
             self.handle_outgoing_data()
             self.handle_incoming_data()
             self.handle_initial_blockchain_sync()
+            self.handle_filter_sync()
+            self.handle_rescan()
             self.handle_invs()
             self.handle_inventory()
+            self.handle_serve_requests()
+            self.handle_ping()
         elif self.state == 'dead':
             self.close_connection()
             self.running = False
@@ -628,6 +1264,48 @@ class Peer(threading.Thread):
                 print("[PEER] {} could not connect.".format(self.peer_address))
             return False
 
+    def is_ready(self):
+        # Called from the manager thread, possibly before step() has initialized this peer
+        return self.running and getattr(self, 'state', None) == 'connected' and getattr(self, 'handshake_time', None) is not None
+
+    def queue_inv(self, inv):
+        '''Called from other threads to have this peer fetch inv as soon as possible'''
+        self.reassigned_invs.append(inv)
+
+    def update_latency(self, sample):
+        if self.latency is None:
+            self.latency = sample
+        else:
+            self.latency += (sample - self.latency) * Peer.ESTIMATE_WEIGHT
+
+    def update_throughput(self, size, duration):
+        if size < Peer.MIN_THROUGHPUT_SAMPLE_SIZE:
+            return
+        sample = size / max(duration, 0.001)
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput += (sample - self.throughput) * Peer.ESTIMATE_WEIGHT
+
+    def request_timeout(self, expected_size, max_timeout):
+        '''Returns how long we should wait for a response of roughly expected_size bytes. Until we have measurements
+        for this peer the manager's fixed timeout (max_timeout) is used.'''
+        if self.latency is None or (expected_size >= Peer.MIN_THROUGHPUT_SAMPLE_SIZE and self.throughput is None):
+            return max_timeout
+
+        timeout = Peer.LATENCY_FACTOR * self.latency
+        if expected_size >= Peer.MIN_THROUGHPUT_SAMPLE_SIZE:
+            timeout += Peer.SIZE_FACTOR * expected_size / self.throughput
+
+        return min(max(timeout, Peer.MIN_REQUEST_TIMEOUT), max_timeout)
+
+    def missed_deadline(self):
+        self.missed_deadlines += 1
+        if self.missed_deadlines >= Peer.MAX_MISSED_DEADLINES:
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} missed too many request deadlines'.format(self.peer_address))
+            self.state = 'dead'
+
     def close_connection(self):
         try:
             if self.socket is not None:
@@ -639,7 +1317,7 @@ class Peer(threading.Thread):
 
     def handle_incoming_data(self):
         try:
-            data = self.socket.recv(4096)
+            data = self.socket.recv(65536)
             self.bytes_received += len(data)
         except ConnectionResetError:
             data = b''
@@ -654,6 +1332,10 @@ class Peer(threading.Thread):
             self.state = 'dead'
             return
 
+        if len(self.data_buffer) == 0:
+            # A new message is starting
+            self.message_start_time = time.time()
+
         self.data_buffer = self.data_buffer + data
         self.last_data_time = time.time()
 
@@ -670,6 +1352,10 @@ class Peer(threading.Thread):
             if payload is None:
                 break
 
+            # Used by cmd_* handlers to estimate throughput. Any leftover data belongs to the next message.
+            self.message_receive_time = self.last_data_time - self.message_start_time
+            self.message_start_time = self.last_data_time
+
             self.handle_command(command, payload)
 
     def handle_outgoing_data(self):
@@ -778,31 +1464,73 @@ class Peer(threading.Thread):
             # Manager says so!
             pass
 
+    def handle_rescan(self):
+        if self.handshake_time is None or len(self.manager.rescan_blocks) == 0:
+            return
+
+        # Only take more once the blocks we have are in
+        if any(inv.type == Inv.MSG_BLOCK for inv in self.inprogress_invs.keys()) or len(self.reassigned_invs):
+            return
+
+        for block_hash in self.manager.take_rescan_blocks(Manager.RESCAN_BLOCKS_PER_PEER):
+            self.queue_inv(Inv(Inv.MSG_BLOCK, block_hash))
+
+    def handle_filter_sync(self):
+        if not self.manager.compact_filters or self.handshake_time is None:
+            return
+
+        # Blocks that matched a filter can come from any peer
+        for block_hash in self.manager.take_matched_blocks():
+            self.queue_inv(Inv(Inv.MSG_BLOCK, block_hash))
+
+        if self.filter_request is not None:
+            return
+
+        filter_type = self.manager.get_filter_type(self)
+        if filter_type is None:
+            return
+
+        request = self.manager.will_request_filters(self, filter_type)
+        if request is None:
+            return
+
+        self.filter_request = request
+        self.send_getcf(request['command'], filter_type, request['start_height'], request['block_hashes'][-1])
+
     def handle_invs(self):
         now = time.time()
 
+        # Requests handed to us by the manager when another peer missed its deadline
+        while len(self.reassigned_invs):
+            inv = self.reassigned_invs.popleft()
+            if inv not in self.inprogress_invs:
+                self.invs[inv] = now
+
         if len(self.inprogress_invs) > 0:
-            inprogress_block_invs = [inv for inv in self.inprogress_invs if inv.type == Inv.MSG_BLOCK]
-            if len(inprogress_block_invs):
-                if self.inprogress_command != 'block' and (now - self.last_block_inv_time) > Manager.BLOCK_REQUEST_TIMEOUT:
-                    # Peer is ignoring our request for blocks...
-                    if self.manager.spv.logging_level <= WARNING:
-                        print('[PEER] {} peer is ignoring our request for blocks'.format(self.peer_address))
-                    self.state = 'dead'
-                    return
+            overdue_invs = [inv for inv in self.inprogress_invs if now > self.inv_deadlines[inv]]
 
-            # TODO - should we consider the peer misbehaving if its ignoring our request for transactions?
-            inprogress_tx_invs = ((inv, when) for inv, when in self.inprogress_invs.items() if inv.type == Inv.MSG_TX)
-            timedout_invs = set()
-            for inv, when in inprogress_tx_invs:
-                if (now - when) > Manager.TX_REQUEST_TIMEOUT:
-                    # Tell manager (by passing None) that the tx request timed out
-                    self.manager.received_transaction(inv, None)
-                    timedout_invs.add(inv)
+            # If a block is streaming in right now it's most likely the oldest block request, so let it finish
+            if self.inprogress_command == 'block' and (now - self.last_data_time) < Peer.MIN_REQUEST_TIMEOUT:
+                inprogress_block_invs = [inv for inv in self.inprogress_invs if inv.type == Inv.MSG_BLOCK]
+                if len(inprogress_block_invs):
+                    oldest_block_inv = min(inprogress_block_invs, key=lambda inv: self.inprogress_invs[inv])
+                    overdue_invs = [inv for inv in overdue_invs if inv != oldest_block_inv]
 
             # Fix for #3 - don't pop items out of inprogress_invs during iteration
-            for inv in timedout_invs:
+            for inv in overdue_invs:
                 self.inprogress_invs.pop(inv)
+                self.inv_deadlines.pop(inv)
+                self.abandoned_invs.add(inv)
+
+                if inv.type == Inv.MSG_TX:
+                    # Tell manager (by passing None) that the tx request timed out. Other peers that know about it will retry.
+                    # TODO - should we consider the peer misbehaving if its ignoring our request for transactions?
+                    self.manager.received_transaction(inv, None)
+                else:
+                    if self.manager.spv.logging_level <= INFO:
+                        print('[PEER] {} missed deadline for {}'.format(self.peer_address, str(inv)))
+                    self.manager.reassign_inv(inv, self)
+                    self.missed_deadline()
 
             if len(self.inprogress_invs):
                 return
@@ -839,13 +1567,30 @@ class Peer(threading.Thread):
         if len(invs) != 0:
             now = time.time()
             for inv in invs:
-                # Requesting a new block, so allow time to timeout...
                 if inv.type == Inv.MSG_BLOCK:
-                    self.last_block_inv_time = time.time()
+                    # Blocks are delivered one after the other, so each deadline stacks onto the previous one
+                    timeout = self.request_timeout(self.manager.expected_block_size, Manager.BLOCK_REQUEST_TIMEOUT)
+                    self.last_block_deadline = max(self.last_block_deadline, now) + timeout
+                    self.inv_deadlines[inv] = self.last_block_deadline
+                else:
+                    self.inv_deadlines[inv] = now + self.request_timeout(0, Manager.TX_REQUEST_TIMEOUT)
+                self.abandoned_invs.discard(inv)
                 self.inprogress_invs[inv] = now
                 yield inv
             self.send_getdata(invs)
 
+    def handle_ping(self):
+        if self.handshake_time is None or self.peer_version <= 60000:
+            return
+
+        now = time.time()
+        if self.ping_nonce is not None or (now - self.ping_time) < Peer.PING_INTERVAL:
+            return
+
+        self.ping_nonce = random.randrange(0, 1 << 64)
+        self.ping_time = now
+        self.send_ping(struct.pack("<Q", self.ping_nonce))
+
     def handle_inventory(self):
         now = time.time()
 
@@ -854,23 +1599,43 @@ class Peer(threading.Thread):
             if len(self.outgoing_data_queue):
                 return
 
+            sent = False
+            notfound = []
             for _ in range(len(self.requested_invs)):
                 inv, when = self.requested_invs.popleft()
                 r = self.manager.will_send_inventory(self.peer_address, inv)
                 if r == Manager.REQUEST_GO:
                     data = self.manager.get_inventory_data(inv)
                     if data is None:
+                        notfound.append(inv)
                         continue
                     if inv.type == Inv.MSG_TX:
                         self.send_tx(inv, data)
                     elif inv.type == Inv.MSG_BLOCK:
                         self.send_block(inv, data)
-                    return
+                    sent = True
+                    break
                 elif r == Manager.REQUEST_WAIT:
                     self.requested_invs.append((inv, when + 3))
                     continue
                 elif r == Manager.REQUEST_DONT:
+                    # Blocks that aren't in the inventory anymore (such as ones a peer we served getblocks to asks
+                    # for) can still be in the block store
+                    if inv.type == Inv.MSG_BLOCK and self.manager.spv.blockstore is not None:
+                        data = self.manager.spv.blockstore.get_block_data(inv.hash)
+                        if data is not None:
+                            self.send_block(inv, data)
+                            sent = True
+                            break
+                    notfound.append(inv)
                     continue
+
+            # Let the peer ask someone else rather than wait for its request to time out
+            if len(notfound):
+                self.send_notfound(notfound)
+
+            if sent:
+                return
                 
         if now < (self.last_inventory_check_time + Manager.INVENTORY_CHECK_TIME):
             return
@@ -882,10 +1647,47 @@ class Peer(threading.Thread):
 
         self.last_inventory_check_time = now
 
+    def handle_serve_requests(self):
+        if len(self.serve_requests) == 0:
+            return
+
+        # One batch at a time, so a fast requester can't fill up our outgoing queue
+        if len(self.outgoing_data_queue):
+            return
+
+        now = time.time()
+        self.serve_tokens = min(Peer.SERVE_REQUEST_BURST, self.serve_tokens + (now - self.serve_tokens_time) * Peer.SERVE_REQUEST_RATE)
+        self.serve_tokens_time = now
+        if self.serve_tokens < 1:
+            return
+        self.serve_tokens -= 1
+
+        # For getcfheaders/getcfilters, start is the start height instead of a block locator
+        command, start, stop_hash = self.serve_requests.popleft()
+        if command == 'getheaders':
+            headers = self.manager.spv.blockchain.get_headers_after(start, stop_hash, Manager.MAX_HEADERS_PER_MESSAGE)
+            self.send_headers(headers)
+        elif command == 'getblocks':
+            headers = self.manager.spv.blockchain.get_headers_after(start, stop_hash, Manager.MAX_BLOCKS_PER_INV)
+            if len(headers):
+                self.send_inv([Inv(Inv.MSG_BLOCK, header.hash()) for header in headers])
+        elif command == 'getcfheaders':
+            r = self.manager.filterdb.get_filter_hashes(start, stop_hash, Manager.MAX_CFHEADERS_PER_REQUEST)
+            if r is not None:
+                self.send_cfheaders(stop_hash, *r)
+        elif command == 'getcfilters':
+            filters = self.manager.filterdb.get_filters(start, stop_hash, Manager.MAX_CFILTERS_PER_REQUEST)
+            if filters is not None:
+                for block_hash, filter_data in filters:
+                    self.send_cfilter(block_hash, filter_data)
+
     def send_version(self):
         assert not self.sent_version, "don't call this twice"
+        self.version_sent_time = time.time()
         version  = Manager.PROTOCOL_VERSION
         services = Manager.SERVICES
+        if self.manager.filterdb is not None:
+            services |= Manager.NODE_LOCAL_FILTERS
         now      = int(time.time())
 
         recipient_address = Serialize.serialize_network_address(self.peer_address, services, with_timestamp=False)
@@ -893,7 +1695,8 @@ class Peer(threading.Thread):
         
         nonce      = random.randrange(0, 1 << 64)
         user_agent = Serialize.serialize_string(self.manager.user_agent)
-        last_block = 0 # we aren't a full node...
+        # We aren't a full node, but when serving headers peers need to know how far our chain goes
+        last_block = self.manager.spv.blockchain.get_best_chain_height() if self.manager.serve_blockchain else 0
 
         payload = struct.pack("<LQQ", version, services, now) + recipient_address + sender_address + struct.pack("<Q", nonce) + user_agent + struct.pack("<L", last_block)
         self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "version", payload))
@@ -902,6 +1705,9 @@ class Peer(threading.Thread):
     def send_verack(self):
         self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "verack", b''))
 
+    def send_ping(self, payload):
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "ping", payload))
+
     def send_pong(self, payload):
         self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "pong", payload))
 
@@ -926,6 +1732,34 @@ class Peer(threading.Thread):
         if self.manager.spv.logging_level <= DEBUG:
             print("[PEER] {} sent getdata for {} items".format(self.peer_address, len(invs)))
 
+    def send_sendheaders(self):
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "sendheaders", b''))
+        self.sent_sendheaders = True
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[PEER] {} sent sendheaders".format(self.peer_address))
+
+    def send_notfound(self, invs):
+        data = []
+        for inv in invs:
+            data.append(inv.serialize())
+
+        payload = Serialize.serialize_variable_int(len(data)) + b''.join(data)
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "notfound", payload))
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[PEER] {} sent notfound for {} items".format(self.peer_address, len(invs)))
+
+    def send_headers(self, headers):
+        data = []
+        data.append(Serialize.serialize_variable_int(len(headers)))
+        for header in headers:
+            data.append(header.serialize())
+            data.append(b'\x00') # headers are sent as blocks with 0 transactions
+
+        payload = b''.join(data)
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "headers", payload))
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[PEER] {} sent {} headers".format(self.peer_address, len(headers)))
+
     def send_getheaders(self, block_locator):
         last_block = (b'\x00' * 32)
         payload = struct.pack("<L", Manager.PROTOCOL_VERSION) + block_locator.serialize() + last_block
@@ -942,6 +1776,23 @@ class Peer(threading.Thread):
         if self.manager.spv.logging_level <= DEBUG:
             print("[PEER] {} sent getblocks".format(self.peer_address))
 
+    def send_getcf(self, command, filter_type, start_height, stop_hash):
+        payload = struct.pack("<BL", filter_type, start_height) + stop_hash
+
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, command, payload))
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[PEER] {} sent {} (start_height={} stop_hash={})".format(self.peer_address, command, start_height, bytes_to_hexstring(stop_hash)))
+
+    def send_cfheaders(self, stop_hash, previous_filter_header, filter_hashes):
+        payload = bytes([GCSFilter.LOCAL_FILTER_TYPE]) + stop_hash + previous_filter_header + Serialize.serialize_variable_int(len(filter_hashes)) + b''.join(filter_hashes)
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "cfheaders", payload))
+        if self.manager.spv.logging_level <= DEBUG:
+            print("[PEER] {} sent {} filter headers".format(self.peer_address, len(filter_hashes)))
+
+    def send_cfilter(self, block_hash, filter_data):
+        payload = bytes([GCSFilter.LOCAL_FILTER_TYPE]) + block_hash + Serialize.serialize_variable_int(len(filter_data)) + filter_data
+        self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "cfilter", payload))
+
     def send_tx(self, inv, tx_data):
         self.queue_outgoing_data(Serialize.wrap_network_message(self.manager.spv.coin, "tx", tx_data))
         if self.manager.spv.logging_level <= DEBUG:
@@ -977,7 +1828,7 @@ class Peer(threading.Thread):
             _, _, payload = Serialize.unserialize_network_address(payload, with_timestamp=False)
             nonce = struct.unpack("<Q", payload[:8])[0]
             self.peer_user_agent, payload = Serialize.unserialize_string(payload[8:])
-            self.peer_last_block = struct.unpack("<L", payload)[0]
+            self.peer_last_block = struct.unpack("<L", payload[:4])[0] # version >= 70001 peers append a relay flag
         except struct.error:
             # Not enough data usually
             self.state = 'dead'
@@ -999,7 +1850,8 @@ class Peer(threading.Thread):
 
         # Let's only connect to peers that are fully synced.  If we connect to a syncing peer, it doesn't
         # really benefit us and it possibly harms them since we can't send them blocks.
-        if self.peer_last_block < self.manager.spv.blockchain.get_best_chain_height():
+        # The exception is when we're serving the blockchain, then peers connect to us to catch up.
+        if self.peer_last_block < self.manager.spv.blockchain.get_best_chain_height() and not (self.incoming and self.manager.serve_blockchain):
             if self.manager.spv.logging_level <= INFO:
                 print("[PEER] {} peer doesn't have a blockchain longer than ours".format(self.peer_address))
             self.state = 'dead'
@@ -1012,19 +1864,40 @@ class Peer(threading.Thread):
             self.send_version()
 
         if self.peer_verack == 2:
-            self.manager.spv.add_time_data(self.peer_time)
-            self.handshake_time = time.time()
+            self.handshake_complete()
 
     def cmd_verack(self, payload):
         self.peer_verack += 1
 
+        # version -> verack is our first round trip measurement
+        if self.version_sent_time is not None and self.latency is None:
+            self.update_latency(time.time() - self.version_sent_time)
+
         if self.peer_verack == 2:
-            self.manager.spv.add_time_data(self.peer_time)
-            self.handshake_time = time.time()
+            self.handshake_complete()
+
+    def handshake_complete(self):
+        self.manager.spv.add_time_data(self.peer_time)
+        self.handshake_time = time.time()
+
+        # Ask for new blocks to be announced with headers instead of inv (BIP130)
+        if self.peer_version >= Manager.SENDHEADERS_VERSION:
+            self.send_sendheaders()
+
+    def cmd_sendheaders(self, payload):
+        # We don't announce blocks to peers (yet), so just remember the preference
+        self.peer_wants_headers = True
 
     def cmd_ping(self, payload):
         self.send_pong(payload)
 
+    def cmd_pong(self, payload):
+        if self.ping_nonce is None or len(payload) < 8 or struct.unpack("<Q", payload[:8])[0] != self.ping_nonce:
+            return
+
+        self.update_latency(time.time() - self.ping_time)
+        self.ping_nonce = None
+
     def cmd_addr(self, payload):
         count, payload = Serialize.unserialize_variable_int(payload)
 
@@ -1047,6 +1920,10 @@ class Peer(threading.Thread):
                 # fetch it before calling getblocks again.
                 self.blocks_request = None
 
+                if self.manager.compact_filters and inv.hash not in self.manager.spv.blockchain.blocks:
+                    # We don't download new blocks, but the header sync will get its header from this peer
+                    self.peer_last_block = max(self.peer_last_block, self.manager.spv.blockchain.get_best_chain_height() + 1)
+
             if inv not in self.invs and inv not in self.inprogress_invs:
                 self.invs[inv] = time.time()
 
@@ -1058,13 +1935,25 @@ class Peer(threading.Thread):
         if self.manager.spv.logging_level <= INFO:
             print("[PEER] {} got tx {}".format(self.peer_address, bytes_to_hexstring(inv.hash)))
 
-        if inv in self.inprogress_invs:
+        if inv in self.abandoned_invs:
+            # Too late, the manager already gave up on this request
+            self.abandoned_invs.remove(inv)
+        elif inv in self.inprogress_invs:
             self.manager.received_transaction(inv, tx)
             self.inprogress_invs.pop(inv)
+            self.inv_deadlines.pop(inv)
         else:
             raise Exception("peer sent a tx without us asking it to")
 
     def cmd_headers(self, payload):
+        if self.headers_request is None and not self.sent_sendheaders:
+            # We didn't ask, or the manager gave our request to another peer because we were too slow
+            if self.manager.spv.logging_level <= DEBUG:
+                print("[PEER] {} ignoring unrequested headers".format(self.peer_address))
+            return
+
+        self.update_throughput(len(payload), self.message_receive_time)
+
         count, payload = Serialize.unserialize_variable_int(payload)
 
         headers = []
@@ -1083,6 +1972,11 @@ class Peer(threading.Thread):
                 self.state = 'dead'
                 return
 
+        if self.headers_request is None:
+            # Not a response to getheaders, so this is a new block announcement (BIP130)
+            self.handle_announced_headers(headers)
+            return
+
         if self.manager.spv.logging_level <= INFO:
             print("[PEER] {} got {} headers".format(self.peer_address, len(headers)))
         
@@ -1094,6 +1988,46 @@ class Peer(threading.Thread):
             
         self.headers_request = None
 
+    def handle_announced_headers(self, headers):
+        if len(headers) == 0:
+            return
+
+        if self.manager.spv.logging_level <= INFO:
+            print("[PEER] {} announced {} headers".format(self.peer_address, len(headers)))
+
+        # A block announcement also answers any outstanding getblocks
+        self.blocks_request = None
+
+        if self.manager.spv.blockchain.get_needs_headers():
+            # Still syncing headers, so the announced headers extend the header chain directly
+            if not self.manager.received_announced_headers(headers):
+                # They don't connect.  We're missing something in between, so sync normally with this peer.
+                self.syncing_blockchain = 1
+                self.next_sync_time = 0
+            return
+
+        # Syncing full blocks: fetch the blocks right now instead of waiting for an inv and the next step()
+        now = time.time()
+        requests = set()
+        for header in headers:
+            inv = Inv(Inv.MSG_BLOCK, header.hash())
+            if inv in self.inprogress_invs:
+                continue
+
+            r = self.manager.will_request_inv(inv)
+            if r == Manager.REQUEST_GO:
+                requests.add(inv)
+                self.invs.pop(inv, None)
+            elif r == Manager.REQUEST_WAIT:
+                # Someone else is fetching it. Remember it in case that request fails.
+                self.invs[inv] = now + 5
+
+        # If these don't connect, cmd_block notices the orphan and falls back to getblocks
+        for _ in self.request_invs(requests):
+            pass
+
+        self.handle_outgoing_data()
+
     def cmd_block(self, payload):
         block, payload = Block.unserialize(payload, self.manager.spv.coin)
 
@@ -1106,12 +2040,21 @@ class Peer(threading.Thread):
             return
 
         inv = Inv(Inv.MSG_BLOCK, block.header.hash())
-        if inv in self.inprogress_invs:
+        if inv in self.abandoned_invs:
+            # Arrived after its deadline and was requested from another peer. Not an error, just late.
+            self.abandoned_invs.remove(inv)
+            self.update_throughput(block.serialize_size(), self.message_receive_time)
+            return
+        elif inv in self.inprogress_invs:
             if self.manager.spv.logging_level <= INFO:
                 print("[PEER] {} got {}".format(self.peer_address, block))
  
+            self.update_throughput(block.serialize_size(), self.message_receive_time)
+            self.missed_deadlines = 0
+
             self.manager.received_block(inv, block, self.syncing_blockchain != 0)
             self.inprogress_invs.pop(inv)
+            self.inv_deadlines.pop(inv)
 
             # If we are not syncing from this peer and the peer sends us a block that doesn't connect,
             # we should try syncing again.  If the peer again doesn't send us blocks, we should disconnect.
@@ -1120,6 +2063,53 @@ class Peer(threading.Thread):
         else:
             raise Exception("peer sent a block without us asking it to")
 
+    def cmd_cfheaders(self, payload):
+        try:
+            filter_type = payload[0]
+            stop_hash = payload[1:33]
+            previous_filter_header = payload[33:65]
+            count, payload = Serialize.unserialize_variable_int(payload[65:])
+            if len(payload) != count * 32:
+                raise SerializeDataTooShort()
+        except (IndexError, SerializeDataTooShort):
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent badly formatted cfheaders command'.format(self.peer_address))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+            return
+
+        self.update_throughput(len(payload), self.message_receive_time)
+
+        filter_hashes = [payload[i*32:(i+1)*32] for i in range(count)]
+        if not self.manager.received_cfheaders(self, filter_type, stop_hash, previous_filter_header, filter_hashes):
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent bad filter headers'.format(self.peer_address))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+
+    def cmd_cfilter(self, payload):
+        try:
+            filter_type = payload[0]
+            block_hash = payload[1:33]
+            length, payload = Serialize.unserialize_variable_int(payload[33:])
+            if len(payload) != length:
+                raise SerializeDataTooShort()
+        except (IndexError, SerializeDataTooShort):
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent badly formatted cfilter command'.format(self.peer_address))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+            return
+
+        self.update_throughput(len(payload), self.message_receive_time)
+
+        wallet = self.manager.spv.wallet
+        if not self.manager.received_cfilter(self, filter_type, block_hash, payload, wallet.get_filter_scripts(), wallet.get_filter_prevouts()):
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent a bad filter for block {}'.format(self.peer_address, bytes_to_hexstring(block_hash)))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+
     def cmd_getdata(self, payload):
         count, payload = Serialize.unserialize_variable_int(payload)
         now = time.time()
@@ -1131,9 +2121,86 @@ class Peer(threading.Thread):
         if self.manager.spv.logging_level <= INFO:
             print('[PEER] {} requested {} items'.format(self.peer_address, count))
 
-    def cmd_getblocks(self, payload):
+    def cmd_notfound(self, payload):
+        count, payload = Serialize.unserialize_variable_int(payload)
+
+        for _ in range(count):
+            inv, payload = Inv.unserialize(payload)
+            if inv not in self.inprogress_invs:
+                continue
+
+            self.inprogress_invs.pop(inv)
+            self.inv_deadlines.pop(inv)
+            self.abandoned_invs.add(inv)
+            self.manager.item_not_found(inv, self)
+
         if self.manager.spv.logging_level <= DEBUG:
-            print('[PEER] {} ignoring getblocks command'.format(self.peer_address))
+            print('[PEER] {} doesn\'t have {} items'.format(self.peer_address, count))
+
+    def cmd_getheaders(self, payload):
+        self.queue_serve_request('getheaders', payload)
+
+    def cmd_getblocks(self, payload):
+        self.queue_serve_request('getblocks', payload)
+
+    def queue_serve_request(self, command, payload):
+        if not self.manager.serve_blockchain:
+            if self.manager.spv.logging_level <= DEBUG:
+                print('[PEER] {} ignoring {} command'.format(self.peer_address, command))
+            return
+
+        try:
+            count, payload = Serialize.unserialize_variable_int(payload[4:])
+            if count > Manager.MAX_LOCATOR_HASHES or len(payload) != (count + 1) * 32:
+                raise SerializeDataTooShort()
+            locator_hashes = [payload[i*32:(i+1)*32] for i in range(count)]
+            stop_hash = payload[count*32:]
+        except SerializeDataTooShort:
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent badly formatted {} command'.format(self.peer_address, command))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+            return
+
+        self.add_serve_request(command, locator_hashes, stop_hash)
+
+    def cmd_getcfheaders(self, payload):
+        self.queue_filter_request('getcfheaders', payload)
+
+    def cmd_getcfilters(self, payload):
+        self.queue_filter_request('getcfilters', payload)
+
+    def queue_filter_request(self, command, payload):
+        if self.manager.filterdb is None:
+            if self.manager.spv.logging_level <= DEBUG:
+                print('[PEER] {} ignoring {} command'.format(self.peer_address, command))
+            return
+
+        if len(payload) != 37:
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} sent badly formatted {} command'.format(self.peer_address, command))
+            self.manager.peer_is_bad(self.peer_address)
+            self.state = 'dead'
+            return
+
+        # We only have our own filters, so BIP157 clients (which don't know the type) aren't answered
+        filter_type, start_height = struct.unpack("<BL", payload[:5])
+        if filter_type != GCSFilter.LOCAL_FILTER_TYPE:
+            if self.manager.spv.logging_level <= DEBUG:
+                print('[PEER] {} asked for unknown filter type {}'.format(self.peer_address, filter_type))
+            return
+
+        self.add_serve_request(command, start_height, payload[5:37])
+
+    def add_serve_request(self, command, start, stop_hash):
+        # Well behaved peers wait for each batch before asking for the next one
+        if len(self.serve_requests) >= Peer.MAX_QUEUED_SERVE_REQUESTS:
+            if self.manager.spv.logging_level <= WARNING:
+                print('[PEER] {} is flooding us with {} requests'.format(self.peer_address, command))
+            self.state = 'dead'
+            return
+
+        self.serve_requests.append((command, start, stop_hash))
 
     def cmd_getaddr(self, payload):
         # Select random addresses and send them
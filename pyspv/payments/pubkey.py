@@ -1,4 +1,3 @@
-from ..keys import PrivateKey
 from ..transaction import TransactionOutput
 from ..wallet import InvalidAddress
 
@@ -38,8 +37,8 @@ class PubKeyChange:
         pass
 
     def create_one(self, spv):
-        change_private_key = PrivateKey.create_new()
-        change_address = change_private_key.get_public_key(True).as_hash160(spv.coin)
+        change_private_key = spv.new_private_key()
+        _, change_address, _ = spv.wallet.public_key_cache.get(change_private_key, True)
 
         script = Script()
         script.push_op(OP_DUP)
@@ -48,7 +47,6 @@ class PubKeyChange:
         script.push_op(OP_EQUALVERIFY)
         script.push_op(OP_CHECKSIG)
 
-        spv.wallet.add('private_key', change_private_key, {'label': ''})
         return TransactionOutput(amount=0, script=script)
 
 
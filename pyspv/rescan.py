@@ -0,0 +1,172 @@
+import threading
+
+from .block import Block
+from .blockscan import BlockScanner
+from .util import *
+
+class RescanRangeUnavailable(Exception):
+    pass
+
+class Rescan(threading.Thread):
+    '''
+    Scans past blocks of the main chain for payments to items added to the wallet after those blocks were processed,
+    without having to resync.  Matching transactions go through the wallet's monitors just like they would for a new
+    block, and the transaction database is told which blocks they're in so they're confirmed.
+
+    Blocks come from the block store when it has them.  The rest are downloaded again from peers: up to NETWORK_WINDOW
+    blocks past the one being scanned are requested at once, and the network manager hands each peer its own part of
+    them so they download in parallel.  Those blocks are found by their hashes, so they have to be in the part of the
+    blockchain kept in memory.
+
+    items is a list of (collection_name, item) pairs already in the wallet, and only transactions that pay to or spend
+    from those (or spend outputs the wallet is already watching) are run through the monitors.  With items=None every
+    monitor's full set of keys is used.
+
+    The rescan runs in its own thread, with its own block scanner, while the wallet and network carry on.  progress is
+    called with (height, from_height, to_height) after each block.
+    '''
+
+    # Blocks requested from peers ahead of the one being scanned
+    NETWORK_WINDOW = 64
+
+    # How often a rescan waiting on the network checks whether it was cancelled
+    WAIT_TIME = 1
+
+    def __init__(self, spv, from_height, to_height=None, items=None, progress=None, processes=1):
+        threading.Thread.__init__(self, daemon=True)
+        self.spv = spv
+        self.from_height = from_height
+        self.to_height = self.spv.blockchain.get_best_chain_height() if to_height is None else to_height
+        self.progress = progress
+        self.height = from_height
+        self.running = True
+        self.error = None
+
+        self.block_scanner = BlockScanner(processes=processes)
+        self.scan_keys = None if items is None else self.__get_item_scan_keys(items)
+
+        # height -> block_hash for blocks that have to come from the network, and the blocks that have arrived
+        self.network_block_hashes = {}
+        self.received_blocks = {}
+        self.received_blocks_condition = threading.Condition()
+        self.next_request_height = from_height
+
+        if self.from_height > self.to_height:
+            return
+
+        # Check up front that every block can be found
+        store_range = self.spv.blockstore.get_height_range() if self.spv.blockstore is not None else None
+        for start_height, stop_height in self.__ranges_outside_store(store_range):
+            block_hashes = self.spv.blockchain.get_main_chain_hashes(start_height, stop_height)
+            if block_hashes is None:
+                raise RescanRangeUnavailable("blocks {} to {} aren't in the block store or the blockchain in memory".format(start_height, stop_height))
+            for i, block_hash in enumerate(block_hashes):
+                self.network_block_hashes[start_height + i] = block_hash
+
+    def __ranges_outside_store(self, store_range):
+        if store_range is None:
+            return [(self.from_height, self.to_height)]
+
+        ranges = []
+        if self.from_height < store_range[0]:
+            ranges.append((self.from_height, min(self.to_height, store_range[0] - 1)))
+        if self.to_height >= store_range[1]:
+            ranges.append((max(self.from_height, store_range[1]), self.to_height))
+        return ranges
+
+    def __get_item_scan_keys(self, items):
+        metadatas = [self.spv.wallet.get(collection_name, item) for collection_name, item in items]
+
+        # Monitors can derive and save public keys for the items
+        with self.spv.wallet.batch(), self.spv.wallet.wallet_lock:
+            scan_keys = []
+            for m in self.spv.wallet.monitors:
+                for (collection_name, item), metadata in zip(items, metadatas):
+                    item_keys = m.get_item_scan_keys(collection_name, item, {} if metadata is None else metadata)
+                    if item_keys is None:
+                        # The monitor can't tell, so give it everything it watches
+                        scan_keys.append(m.get_scan_keys())
+                        break
+                    scan_keys.append(item_keys)
+            return scan_keys
+
+    def cancel(self):
+        '''Stops the rescan after the block being scanned'''
+        self.running = False
+        with self.received_blocks_condition:
+            self.received_blocks_condition.notify_all()
+
+    def get_progress(self):
+        '''Returns the fraction of blocks scanned so far'''
+        count = self.to_height - self.from_height + 1
+        return 1.0 if count <= 0 else (self.height - self.from_height) / count
+
+    def run(self):
+        if self.spv.logging_level <= INFO:
+            print('[RESCAN] scanning blocks {} to {}'.format(self.from_height, self.to_height))
+
+        try:
+            for height in range(self.from_height, self.to_height + 1):
+                self.__request_network_blocks(height)
+
+                block = self.__get_block(height)
+                if block is None:
+                    break
+
+                self.spv.wallet.rescan_block(block, self.block_scanner, self.scan_keys)
+                self.spv.txdb.on_block(block, block_height=height)
+                self.spv.wallet.reindex_block(block)
+
+                self.height = height + 1
+                if self.progress is not None:
+                    self.progress(height, self.from_height, self.to_height)
+        except RescanRangeUnavailable as e:
+            self.error = e
+            if self.spv.logging_level <= WARNING:
+                print('[RESCAN] stopped at height {}: {}'.format(self.height, str(e)))
+        finally:
+            self.running = False
+            self.spv.network_manager.cancel_rescan_blocks(list(self.network_block_hashes.values()))
+            self.block_scanner.close()
+
+        if self.spv.logging_level <= INFO:
+            print('[RESCAN] done at height {}'.format(self.height))
+
+    def __get_block(self, height):
+        if height not in self.network_block_hashes:
+            data = self.spv.blockstore.get_block_data_at_height(height)
+            if data is not None:
+                return Block.unserialize(data, self.spv.coin)[0]
+
+            # Pruned from the store since the rescan started
+            block_hashes = self.spv.blockchain.get_main_chain_hashes(height, height)
+            if block_hashes is None:
+                raise RescanRangeUnavailable("block {} was pruned from the block store".format(height))
+            self.network_block_hashes[height] = block_hashes[0]
+            self.spv.network_manager.request_rescan_blocks(block_hashes, self.__on_network_block)
+
+        block_hash = self.network_block_hashes[height]
+        with self.received_blocks_condition:
+            while self.running and block_hash not in self.received_blocks:
+                self.received_blocks_condition.wait(Rescan.WAIT_TIME)
+            if not self.running:
+                return None
+            self.network_block_hashes.pop(height)
+            return self.received_blocks.pop(block_hash)
+
+    def __request_network_blocks(self, height):
+        # Keep NETWORK_WINDOW blocks past height requested
+        block_hashes = []
+        while self.next_request_height <= min(height + Rescan.NETWORK_WINDOW, self.to_height):
+            if self.next_request_height in self.network_block_hashes:
+                block_hashes.append(self.network_block_hashes[self.next_request_height])
+            self.next_request_height += 1
+
+        if len(block_hashes):
+            self.spv.network_manager.request_rescan_blocks(block_hashes, self.__on_network_block)
+
+    def __on_network_block(self, block):
+        # Called from a peer thread
+        with self.received_blocks_condition:
+            self.received_blocks[block.header.hash()] = block
+            self.received_blocks_condition.notify_all()
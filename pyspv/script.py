@@ -64,3 +64,112 @@ class Script:
     def serialize_size(self):
         return len(self.program)
 
+# Script templates the payment monitors look for.  Classified scripts come with the key material extracted from them:
+TEMPLATE_P2PKH             = 'p2pkh'             # OP_DUP OP_HASH160 <hash160> OP_EQUALVERIFY OP_CHECKSIG -> hash160 of the public key
+TEMPLATE_P2PK              = 'p2pk'              # <public key> OP_CHECKSIG -> the public key
+TEMPLATE_P2SH              = 'p2sh'              # OP_HASH160 <hash160> OP_EQUAL -> hash160 of the redemption script
+TEMPLATE_STEALTH_EPHEMERAL = 'stealth_ephemeral' # OP_RETURN <33 byte public key> -> the ephemeral public key of a stealth payment
+TEMPLATE_PUBKEY_SPEND      = 'pubkey_spend'      # <signature> <public key> -> the public key
+TEMPLATE_MULTISIG_SPEND    = 'multisig_spend'    # OP_0 <signature> ... <redemption script> -> the redemption script
+
+def get_data_pushes(program, index=0):
+    '''Returns the list of data pushed by program starting at index, or None if program contains something other than
+    data pushes or is truncated'''
+    pushes = []
+    while index < len(program):
+        op = program[index]
+        if op < OP_PUSHDATA1:
+            size = op
+            index += 1
+        elif op == OP_PUSHDATA1 and (index+1) < len(program):
+            size = program[index+1]
+            index += 2
+        elif op == OP_PUSHDATA2 and (index+2) < len(program):
+            size = program[index+1] | (program[index+2] << 8)
+            index += 3
+        elif op == OP_PUSHDATA4 and (index+4) < len(program):
+            size = program[index+1] | (program[index+2] << 8) | (program[index+3] << 16) | (program[index+4] << 24)
+            index += 5
+        else:
+            return None
+
+        if index + size > len(program):
+            return None
+
+        pushes.append(program[index:index+size])
+        index += size
+
+    return pushes
+
+def classify_output_script(script):
+    '''Returns (template, key) for a scriptPubKey, or None if it doesn't fit any of the templates'''
+    if len(script) == 25 and script[0] == OP_DUP and script[1] == OP_HASH160 and script[2] == 20 \
+                         and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
+        return TEMPLATE_P2PKH, script[3:23]
+
+    if len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+        return TEMPLATE_P2SH, script[2:22]
+
+    if len(script) in (35, 67) and script[0] in (33, 65) and script[0] == (len(script) - 2) and script[-1] == OP_CHECKSIG:
+        return TEMPLATE_P2PK, script[1:-1]
+
+    if len(script) == 35 and script[0] == OP_RETURN and script[1] == 33 and script[2] in (0x02, 0x03):
+        return TEMPLATE_STEALTH_EPHEMERAL, script[2:]
+
+    return None
+
+def classify_input_script(script):
+    '''Returns (template, key) for a scriptSig, or None if it doesn't fit any of the templates'''
+    if len(script) == 0:
+        return None
+
+    if script[0] == OP_0:
+        # The last data push has to be the redemption script
+        pushes = get_data_pushes(script, 1)
+        if pushes is None or len(pushes) == 0:
+            return None
+        return TEMPLATE_MULTISIG_SPEND, pushes[-1]
+
+    if len(script) < 106:
+        return None
+
+    # The first data push must be a signature, and the second has to be a public key (though in the future we may
+    # need to extract the public key from the signature)
+    size = script[0]
+    if not (68 <= size <= 73):
+        return None
+
+    size2 = script[size+1]
+    if size2 not in (33, 65) or len(script) != size + 2 + size2:
+        return None
+
+    return TEMPLATE_PUBKEY_SPEND, script[size+2:]
+
+class ClassifiedTransaction:
+    '''A transaction with its scripts classified by template.  The wallet classifies each transaction once and hands
+    it to every monitor, so the monitors only look at the inputs and outputs with the templates they care about.'''
+
+    def __init__(self, tx, tx_hash=None):
+        self.tx = tx
+        self.tx_hash = tx.hash() if tx_hash is None else tx_hash
+
+        # template -> list of (index, input or output, key)
+        self.inputs = {}
+        self.outputs = {}
+
+        for i, input in enumerate(tx.inputs):
+            r = classify_input_script(input.script.program)
+            if r is not None:
+                self.inputs.setdefault(r[0], []).append((i, input, r[1]))
+
+        for i, output in enumerate(tx.outputs):
+            r = classify_output_script(output.script.program)
+            if r is not None:
+                self.outputs.setdefault(r[0], []).append((i, output, r[1]))
+
+    def get_inputs(self, template):
+        return self.inputs.get(template, [])
+
+    def get_outputs(self, template):
+        return self.outputs.get(template, [])
+
@@ -56,6 +56,20 @@ class Serialize:
                 raise SerializeDataTooShort()
             return struct.unpack("<Q", data[1:9])[0], data[9:]
 
+    @staticmethod
+    def read_variable_int(data, offset):
+        '''Like unserialize_variable_int, but reads at offset in data without copying it.  Returns the value and the
+        offset after it.'''
+        if offset >= len(data):
+            raise SerializeDataTooShort()
+        i = data[offset]
+        if i < 0xfd:
+            return i, offset + 1
+        size = {0xfd: 2, 0xfe: 4, 0xff: 8}[i]
+        if len(data) < offset + 1 + size:
+            raise SerializeDataTooShort()
+        return int.from_bytes(data[offset+1:offset+1+size], 'little'), offset + 1 + size
+
     @staticmethod
     def serialize_bytes(b):
         length = Serialize.serialize_variable_int(len(b))
@@ -0,0 +1,234 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class SpendTable:
+    '''
+    Keeps what the wallet needs to know about each of its spends in parallel arrays, one row per spend, instead of a
+    Spend object per spend.  A wallet with a million outputs would otherwise hold a million Spend objects, each with
+    its own dicts, sets and scripts.  The spends themselves stay serialized in the wallet database, and are only
+    built when one is actually needed (to be spent, or updated when it's spent).
+
+    Columns:
+
+    * spend_hashes, prevout_hashes: 32 bytes per row, in a bytearray
+    * prevout_ns: the prevout's output index
+    * amounts
+    * category_ids, class_ids: indexes into categories and class_names, which are interned
+    * heights: height of the block the prevout's transaction is in, 0 if it isn't in the main chain
+    * flags: FLAG_SPENT, FLAG_SPENDABLE, FLAG_MATURE (deep enough in the main chain) and FLAG_PREVOUT (the spend has
+      a prevout)
+
+    Each row is in one of four states, see :py:meth:`get_state`: STATE_UNCONFIRMED (not in a block), STATE_CONFIRMING
+    (in a block but not deep enough yet), STATE_MATURE (deep enough, or spendable) and STATE_SPENT.
+
+    Spends are never removed.  Balances and coin selection only look at the amount, category and flags columns, which
+    is done over whole arrays with NumPy when it's installed.
+
+    A SpendTable pickles as its columns, so a wallet can save it and load it back without going through every spend
+    (see :py:class:`pyspv.wallet.Wallet`).  The spend_hash -> row index is rebuilt from spend_hashes.
+    '''
+
+    FLAG_SPENT     = 0x01
+    FLAG_SPENDABLE = 0x02
+    FLAG_PREVOUT   = 0x04
+    FLAG_MATURE    = 0x08
+
+    STATE_UNCONFIRMED = 0
+    STATE_CONFIRMING  = 1
+    STATE_MATURE      = 2
+    STATE_SPENT       = 3
+
+    STATE_NAMES = ('unconfirmed', 'confirming', 'mature', 'spent')
+
+    def __init__(self):
+        self.spend_hashes = bytearray()
+        self.prevout_hashes = bytearray()
+        self.prevout_ns = array('I')
+        self.amounts = array('q')
+        self.category_ids = array('I')
+        self.class_ids = array('B')
+        self.heights = array('i')
+        self.flags = bytearray()
+
+        # spend_hash -> row, and the serialized prevouts once get_prevouts has been called
+        self.rows = {}
+        self.prevouts = None
+
+        self.categories = []
+        self.category_ids_by_name = {}
+        self.class_names = []
+        self.class_ids_by_name = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['rows']
+        state['prevouts'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rows = dict((bytes(self.spend_hashes[i:i+32]), row) for row, i in enumerate(range(0, len(self.spend_hashes), 32)))
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __contains__(self, spend_hash):
+        return spend_hash in self.rows
+
+    def get_row(self, spend_hash):
+        return self.rows.get(spend_hash, None)
+
+    def add(self, spend_hash, class_name, category, amount, prevout=None):
+        '''Adds a row for a new spend and returns it.  prevout is a :py:class:`pyspv.transaction.TransactionPrevOut`.'''
+        assert len(spend_hash) == 32 and spend_hash not in self.rows
+
+        row = len(self.flags)
+        self.rows[spend_hash] = row
+        self.spend_hashes += spend_hash
+
+        if prevout is not None:
+            self.prevout_hashes += prevout.tx_hash
+            self.prevout_ns.append(prevout.n)
+        else:
+            self.prevout_hashes += bytes(32)
+            self.prevout_ns.append(0)
+
+        self.amounts.append(amount)
+        self.category_ids.append(self.__intern(category, self.categories, self.category_ids_by_name))
+        self.class_ids.append(self.__intern(class_name, self.class_names, self.class_ids_by_name))
+        self.heights.append(0)
+        self.flags.append(0 if prevout is None else SpendTable.FLAG_PREVOUT)
+
+        if prevout is not None and self.prevouts is not None:
+            self.prevouts.add(prevout.serialize())
+        return row
+
+    def __intern(self, name, names, ids_by_name):
+        i = ids_by_name.get(name, None)
+        if i is None:
+            i = len(names)
+            names.append(name)
+            ids_by_name[name] = i
+        return i
+
+    def get_spend_hash(self, row):
+        return bytes(self.spend_hashes[row*32:(row+1)*32])
+
+    def get_class_name(self, row):
+        return self.class_names[self.class_ids[row]]
+
+    def get_category(self, row):
+        return self.categories[self.category_ids[row]]
+
+    def get_amount(self, row):
+        return self.amounts[row]
+
+    def get_height(self, row):
+        return self.heights[row]
+
+    def is_spent(self, row):
+        return bool(self.flags[row] & SpendTable.FLAG_SPENT)
+
+    def is_spendable(self, row):
+        return bool(self.flags[row] & SpendTable.FLAG_SPENDABLE)
+
+    def get_prevout(self, row):
+        '''Returns the row's serialized prevout, or None if the spend doesn't have one'''
+        if not (self.flags[row] & SpendTable.FLAG_PREVOUT):
+            return None
+        return bytes(self.prevout_hashes[row*32:(row+1)*32]) + self.prevout_ns[row].to_bytes(4, 'little')
+
+    def get_prevouts(self):
+        '''Returns the serialized prevouts of every spend, spent or not, for the block scanner to watch.  The set is
+        built the first time and kept up to date after that, don't change it.'''
+        if self.prevouts is None:
+            self.prevouts = set()
+            for row, flags in enumerate(self.flags):
+                if flags & SpendTable.FLAG_PREVOUT:
+                    self.prevouts.add(bytes(self.prevout_hashes[row*32:(row+1)*32]) + self.prevout_ns[row].to_bytes(4, 'little'))
+        return self.prevouts
+
+    def set_state(self, row, spent, spendable, height, mature=False):
+        flags = self.flags[row] & SpendTable.FLAG_PREVOUT
+        if spent:
+            flags |= SpendTable.FLAG_SPENT
+        if spendable:
+            flags |= SpendTable.FLAG_SPENDABLE
+        if mature:
+            flags |= SpendTable.FLAG_MATURE
+        self.flags[row] = flags
+        self.heights[row] = height
+
+    def get_state(self, row):
+        flags = self.flags[row]
+        if flags & SpendTable.FLAG_SPENT:
+            return SpendTable.STATE_SPENT
+        if flags & (SpendTable.FLAG_MATURE | SpendTable.FLAG_SPENDABLE):
+            return SpendTable.STATE_MATURE
+        if self.heights[row] > 0:
+            return SpendTable.STATE_CONFIRMING
+        return SpendTable.STATE_UNCONFIRMED
+
+    def get_balances(self):
+        '''Returns category -> the total amount of the spends that aren't spent'''
+        totals = [0] * len(self.categories)
+        for row in self.find_rows(None, 0, SpendTable.FLAG_SPENT):
+            totals[self.category_ids[row]] += self.amounts[row]
+        return dict(zip(self.categories, totals))
+
+    def get_state_balances(self):
+        '''Returns category -> a list of the total amount of the spends in each state'''
+        totals = [[0] * len(SpendTable.STATE_NAMES) for _ in self.categories]
+        for row in range(len(self.flags)):
+            totals[self.category_ids[row]][self.get_state(row)] += self.amounts[row]
+        return dict(zip(self.categories, totals))
+
+    def find_class_rows(self, class_names):
+        '''Returns the rows of spends of any of class_names, in order'''
+        class_ids = [self.class_ids_by_name[class_name] for class_name in class_names if class_name in self.class_ids_by_name]
+        if len(class_ids) == 0:
+            return []
+
+        if numpy is not None:
+            return numpy.nonzero(numpy.isin(numpy.frombuffer(self.class_ids, dtype=numpy.uint8), class_ids))[0].tolist()
+
+        class_ids = set(class_ids)
+        return [row for row, class_id in enumerate(self.class_ids) if class_id in class_ids]
+
+    def find_rows(self, categories, flags_set, flags_clear=0):
+        '''Returns the rows in any of categories (all of them if categories is None) that have all of flags_set and none
+        of flags_clear, in order'''
+        if categories is None:
+            category_ids = None
+        else:
+            category_ids = [self.category_ids_by_name[category] for category in categories if category in self.category_ids_by_name]
+            if len(category_ids) == 0:
+                return []
+
+        mask = flags_set | flags_clear
+        if numpy is not None and len(self.flags):
+            flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+            matches = (flags & mask) == flags_set
+            if category_ids is not None:
+                matches &= numpy.isin(numpy.frombuffer(self.category_ids, dtype=numpy.uint32), category_ids)
+            return numpy.nonzero(matches)[0].tolist()
+
+        category_ids = None if category_ids is None else set(category_ids)
+        return [row for row, flags in enumerate(self.flags) if (flags & mask) == flags_set and (category_ids is None or self.category_ids[row] in category_ids)]
+
+    def find_mature_rows(self, min_height):
+        '''Returns the rows that are mature and not spent, and are either at min_height or above, or not in a block, in
+        order.  These are the ones that can lose confirmations when the blocks from min_height on are taken away.'''
+        mask = SpendTable.FLAG_MATURE | SpendTable.FLAG_SPENDABLE
+        if numpy is not None and len(self.flags):
+            flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+            heights = numpy.frombuffer(self.heights, dtype=numpy.int32)
+            matches = ((flags & mask) != 0) & ((flags & SpendTable.FLAG_SPENT) == 0) & ((heights == 0) | (heights >= min_height))
+            return numpy.nonzero(matches)[0].tolist()
+
+        heights = self.heights
+        return [row for row, flags in enumerate(self.flags) if (flags & mask) and not (flags & SpendTable.FLAG_SPENT) and (heights[row] == 0 or heights[row] >= min_height)]
@@ -0,0 +1,164 @@
+import ctypes
+import hashlib
+import multiprocessing
+import threading
+
+from .keys import PrivateKey, ssl_library, NID_secp256k1
+from .util import *
+
+POINT_CONVERSION_COMPRESSED = 2
+
+def _prototype(name, restype, *argtypes):
+    # A separate function object from the one keys.py uses, declared with its real types so pointers aren't truncated
+    # to ints on 64-bit platforms
+    f = ssl_library[name]
+    f.restype = restype
+    f.argtypes = argtypes
+    return f
+
+_EC_GROUP_new_by_curve_name = _prototype('EC_GROUP_new_by_curve_name', ctypes.c_void_p, ctypes.c_int)
+_EC_GROUP_precompute_mult   = _prototype('EC_GROUP_precompute_mult', ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+_EC_GROUP_free              = _prototype('EC_GROUP_free', None, ctypes.c_void_p)
+_EC_POINT_new               = _prototype('EC_POINT_new', ctypes.c_void_p, ctypes.c_void_p)
+_EC_POINT_free              = _prototype('EC_POINT_free', None, ctypes.c_void_p)
+_EC_POINT_oct2point         = _prototype('EC_POINT_oct2point', ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p)
+_EC_POINT_point2oct         = _prototype('EC_POINT_point2oct', ctypes.c_size_t, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p)
+_EC_POINT_mul               = _prototype('EC_POINT_mul', ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p)
+_BN_CTX_new                 = _prototype('BN_CTX_new', ctypes.c_void_p)
+_BN_CTX_free                = _prototype('BN_CTX_free', None, ctypes.c_void_p)
+_BN_new                     = _prototype('BN_new', ctypes.c_void_p)
+_BN_free                    = _prototype('BN_free', None, ctypes.c_void_p)
+_BN_bin2bn                  = _prototype('BN_bin2bn', ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
+_BN_value_one               = _prototype('BN_value_one', ctypes.c_void_p)
+
+class StealthScanner:
+    '''Finds the payment addresses that stealth payments with a given set of ephemeral keys would go to, for every one of
+    our stealth keys.
+
+    For stealth key d (public key Q = dG) and ephemeral key E, the payment goes to Q + cG where c = SHA256(dE).  The
+    PublicKey/PrivateKey helpers set up and tear down a whole OpenSSL EC_KEY for each operation and go through the
+    payment private key (d + c) to get there.  A scanner keeps its curve group (with OpenSSL's precomputed table of
+    multiples of the generator), BN_CTX, scratch points and our keys loaded for its whole life, so each check costs
+    one variable point multiplication (dE) and one mostly precomputed one (cG + Q).
+
+    Large scans can be split across a pool of worker processes.  Each worker has its own scanner with the same keys.
+    '''
+
+    # Scans with fewer (ephemeral keys * stealth keys) than this stay in this process
+    PARALLEL_SCAN_THRESHOLD = 2000
+
+    def __init__(self, coin, processes=None):
+        self.coin = coin
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.lock = threading.Lock()
+        self.pool = None
+
+        self.group = _EC_GROUP_new_by_curve_name(NID_secp256k1)
+        self.bn_ctx = _BN_CTX_new()
+        _EC_GROUP_precompute_mult(self.group, self.bn_ctx)
+
+        self.ephemeral_point = _EC_POINT_new(self.group)
+        self.shared_point = _EC_POINT_new(self.group)
+        self.payment_point = _EC_POINT_new(self.group)
+        self.shared_secret = _BN_new()
+        self.point_buffer = ctypes.create_string_buffer(33)
+
+        # list of (private_key, bignum d, point Q)
+        self.keys = []
+
+    def __del__(self):
+        self.close()
+
+        for private_key, bignum, point in self.keys:
+            _BN_free(bignum)
+            _EC_POINT_free(point)
+
+        _BN_free(self.shared_secret)
+        _EC_POINT_free(self.payment_point)
+        _EC_POINT_free(self.shared_point)
+        _EC_POINT_free(self.ephemeral_point)
+        _BN_CTX_free(self.bn_ctx)
+        _EC_GROUP_free(self.group)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def add_key(self, private_key):
+        with self.lock:
+            bignum = _BN_bin2bn(private_key.secret, 32, None)
+            point = _EC_POINT_new(self.group)
+            _EC_POINT_mul(self.group, point, bignum, None, None, self.bn_ctx)
+            self.keys.append((private_key, bignum, point))
+
+            # The workers need to know about the new key
+            self.close()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def scan(self, ephemeral_keys):
+        '''ephemeral_keys is a sequence of serialized public keys.  Returns a dict of hash160 -> (private_key, c) for the
+        address each of our keys would be paid to for each ephemeral key.  The payment private key is private_key + c.'''
+        ephemeral_keys = list(set(ephemeral_keys))
+
+        with self.lock:
+            if self.processes > 1 and len(ephemeral_keys) * len(self.keys) >= StealthScanner.PARALLEL_SCAN_THRESHOLD:
+                return self.__scan_parallel(ephemeral_keys)
+
+            return dict((hash160, (self.keys[i][0], c)) for hash160, (i, c) in self.__scan(ephemeral_keys).items())
+
+    def scan_indexes(self, ephemeral_keys):
+        '''Same as scan, without the process pool, and with our keys given by their index in the order they were added'''
+        with self.lock:
+            return self.__scan(ephemeral_keys)
+
+    def __scan(self, ephemeral_keys):
+        # call with lock held
+        r = {}
+        for ephemeral_key in ephemeral_keys:
+            if _EC_POINT_oct2point(self.group, self.ephemeral_point, ephemeral_key, len(ephemeral_key), self.bn_ctx) != 1:
+                continue
+
+            for i, (private_key, bignum, point) in enumerate(self.keys):
+                # shared = dE
+                _EC_POINT_mul(self.group, self.shared_point, None, self.ephemeral_point, bignum, self.bn_ctx)
+                _EC_POINT_point2oct(self.group, self.shared_point, POINT_CONVERSION_COMPRESSED, self.point_buffer, 33, self.bn_ctx)
+                shared_secret = hashlib.sha256(self.point_buffer.raw).digest()
+
+                # payment = cG + Q
+                _BN_bin2bn(shared_secret, 32, self.shared_secret)
+                _EC_POINT_mul(self.group, self.payment_point, self.shared_secret, point, _BN_value_one(), self.bn_ctx)
+                _EC_POINT_point2oct(self.group, self.payment_point, POINT_CONVERSION_COMPRESSED, self.point_buffer, 33, self.bn_ctx)
+
+                r[self.coin.hash160(self.point_buffer.raw)] = (i, int.from_bytes(shared_secret, 'big'))
+
+        return r
+
+    def __scan_parallel(self, ephemeral_keys):
+        # call with lock held
+        if self.pool is None:
+            secrets = [private_key.secret for private_key, _, _ in self.keys]
+            self.pool = process_pool(self.processes, _init_worker, (self.coin, secrets))
+
+        chunk_size = (len(ephemeral_keys) + self.processes - 1) // self.processes
+        chunks = [ephemeral_keys[i:i+chunk_size] for i in range(0, len(ephemeral_keys), chunk_size)]
+
+        r = {}
+        for results in self.pool.map(_worker_scan, chunks):
+            for hash160, (i, c) in results.items():
+                r[hash160] = (self.keys[i][0], c)
+        return r
+
+# Each worker process has its own scanner
+_worker_scanner = None
+
+def _init_worker(coin, secrets):
+    global _worker_scanner
+    _worker_scanner = StealthScanner(coin, processes=1)
+    for secret in secrets:
+        _worker_scanner.add_key(PrivateKey(secret))
+
+def _worker_scan(ephemeral_keys):
+    return _worker_scanner.scan_indexes(ephemeral_keys)
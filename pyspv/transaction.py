@@ -1,7 +1,7 @@
 import struct
 
 from .script import Script
-from .serialize import Serialize
+from .serialize import Serialize, SerializeDataTooShort
 from .util import *
 
 class TransactionTooExpensive(Exception):
@@ -322,6 +322,26 @@ class Transaction:
 
         tx = Transaction(coin, version=version, inputs=inputs, outputs=outputs, lock_time=lock_time)
         return tx, data[4:]
+
+    @staticmethod
+    def unserialize_size(data, offset=0):
+        '''Returns the size of the serialized transaction at offset in data, without unserializing it'''
+        start = offset
+
+        num_inputs, offset = Serialize.read_variable_int(data, offset + 4)
+        for i in range(num_inputs):
+            script_size, offset = Serialize.read_variable_int(data, offset + 36)
+            offset += script_size + 4
+
+        num_outputs, offset = Serialize.read_variable_int(data, offset)
+        for i in range(num_outputs):
+            script_size, offset = Serialize.read_variable_int(data, offset + 8)
+            offset += script_size
+
+        if offset + 4 > len(data):
+            raise SerializeDataTooShort()
+
+        return offset + 4 - start
  
     def __str__(self):
         s = '<tx {}\n\t{}\n\t{}\n\tlock_time={}>'.format(bytes_to_hexstring(self.hash()), 
@@ -48,7 +48,7 @@ class TransactionBuilder:
         assert output_hash_type in (Transaction.SIGHASH_NONE, Transaction.SIGHASH_ALL)
         self.included_spends.append({
             'spend_hash': spend_hash, 
-            'spend'     : self.spv.wallet.spends[spend_hash]['spend'],
+            'spend'     : self.spv.wallet.get_spend(spend_hash),
             'hash_flags': output_hash_type | (Transaction.SIGHASH_ANYONECANPAY if anyone_can_pay else 0)
         })
 
@@ -62,7 +62,10 @@ class TransactionBuilder:
         # TODO
         pass
 
-    def finish(self, shuffle_inputs, shuffle_outputs, allow_unpaid=False, force_fee=None):
+    def finish(self, shuffle_inputs, shuffle_outputs, allow_unpaid=False, force_fee=None, coin_selection='approximate'):
+        '''coin_selection is the strategy used to pick spends from the wallet (see :py:meth:`pyspv.wallet.Wallet.select_spends`).
+        With 'bnb', spends that come to less than DUST_LIMIT over what's needed are spent without change, and the
+        difference goes to the fee.'''
         # TODO allow_unpaid
         # TODO force_fee
         if shuffle_outputs:
@@ -105,12 +108,12 @@ class TransactionBuilder:
 
             # if selected inputs are smaller than output + new recommended fee, try selecting inputs again with new recommended fee
             if total_input < total_output + recommended_fee:
-                spends = included_spends + self.spv.wallet.select_spends(set(['default']), total_output + recommended_fee - included_spend_amount, dont_select=included_spend_hashes)
+                spends = included_spends + self.spv.wallet.select_spends(set(['default']), total_output + recommended_fee - included_spend_amount, dont_select=included_spend_hashes, strategy=coin_selection)
                 if len(spends) == 0:
                     raise InsufficientInputs()
                 continue
-            # if selected inputs cover output + new recommended fee exactly, remove change outputs and break
-            elif total_input == total_output + recommended_fee:
+            # if selected inputs cover output + new recommended fee exactly (or close enough with bnb), remove change outputs and break
+            elif total_input == total_output + recommended_fee or (coin_selection == 'bnb' and total_input < total_output + recommended_fee + self.spv.coin.DUST_LIMIT):
                 # drop change outputs
                 outputs = list(filter(lambda t: t not in change_outputs, outputs))
                 tx = Transaction(self.spv.coin, inputs=tx.inputs, outputs=outputs, lock_time=self.lock_time)
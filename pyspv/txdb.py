@@ -81,14 +81,18 @@ class TransactionDatabase:
 
     def bind_tx(self, tx_hash, block_hash):
         '''associate a block with a transaction; i.e., tx was found in this block. bind_tx needs to be called on each relevent transaction
-        before any calls to on_block_added'''
+        before any calls to on_block_added, unless the block is already in the blockchain'''
+        block_height = self.spv.blockchain.get_block_height(block_hash)
+
         with self.db_lock:
             if tx_hash not in self.transaction_cache:
                 return
 
-            return self.__bind_txns([tx_hash], block_hash)
+            return self.__bind_txns([tx_hash], block_hash, block_height)
 
-    def __bind_txns(self, tx_hashes, block_hash):
+    def __bind_txns(self, tx_hashes, block_hash, block_height):
+        # block_height is None unless the block was already added to the blockchain (i.e., it was fetched after syncing
+        # its header because its compact filter matched), in which case on_block_added won't be called for it again
         with closing(shelve.open(self.transaction_database_file)) as txdb:
             for tx_hash in tx_hashes:
                 self.transaction_cache[tx_hash]['in_blocks'].add(block_hash)
@@ -99,7 +103,7 @@ class TransactionDatabase:
                 txdb[tx_hash_str] = tx_dict
 
                 if block_hash not in self.watched_block_height:
-                    self.watched_block_height[block_hash] = 0
+                    self.watched_block_height[block_hash] = 0 if block_height is None else block_height
                     txdb['watched_block_height'] = self.watched_block_height
 
                 if self.spv.logging_level <= DEBUG:
@@ -115,7 +119,18 @@ class TransactionDatabase:
                 h = self.watched_block_height[block_hash]
                 if h != 0:
                     return self.blockchain_height - h + 1
-            return 0 
+            return 0
+
+    def get_tx_height(self, tx_hash):
+        '''Returns the height of the block in the main chain that tx_hash is in, or 0 if it isn't in one'''
+        with self.db_lock:
+            if tx_hash not in self.transaction_cache:
+                return 0
+            for block_hash in self.transaction_cache[tx_hash]['in_blocks']:
+                h = self.watched_block_height[block_hash]
+                if h != 0:
+                    return h
+            return 0
 
     def is_conflicted(self, tx_hash):
         with self.db_lock:
@@ -156,8 +171,13 @@ class TransactionDatabase:
         # Don't care.
         pass
     
-    def on_block(self, block):
+    def on_block(self, block, block_height=None):
+        # block_height is given by rescans, for blocks too old to be in the blockchain in memory
+        block_hash = block.header.hash()
+        if block_height is None:
+            block_height = self.spv.blockchain.get_block_height(block_hash)
+
         with self.db_lock:
-            tx_hashes = [ tx.hash() for tx in block.transactions ]
-            self.__bind_txns((tx_hash for tx_hash in tx_hashes if tx_hash in self.transaction_cache), block.header.hash())
+            tx_hashes = block.get_transaction_hashes()
+            self.__bind_txns((tx_hash for tx_hash in tx_hashes if tx_hash in self.transaction_cache), block_hash, block_height)
 
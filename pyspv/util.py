@@ -1,4 +1,5 @@
 import fractions
+import multiprocessing
 import random
 import os
 from . import base58
@@ -101,6 +102,13 @@ def target_to_bits(target):
 
     return (m << 24) | (v[-1] << 16) | (v[-2] << 8) | v[-3]
 
+def process_pool(processes, initializer, initargs):
+    '''Starts a pool of worker processes.  pyspv runs lots of threads, and a fork() while another thread holds a lock
+    leaves the lock held forever in the child, so the workers are started from the forkserver (or spawned where there
+    isn't one) instead of being forked from this process.'''
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method).Pool(processes, initializer, initargs)
+
 def random_coprime(n):
     assert n < (1<<32)
     p = random.randrange(n+1, 1<<32)
@@ -1,13 +1,18 @@
 from collections import defaultdict
+import bisect
+import heapq
 import random
-import shelve
 import threading
 import time
 
-from contextlib import closing
-
-from .keys import PrivateKey
+from . import coinselect
+from .blockscan import BlockScanner
+from .keycache import PublicKeyCache
+from .monitors.basemonitor import BaseMonitor
+from .script import ClassifiedTransaction
+from .spendtable import SpendTable
 from .util import *
+from .walletdb import WalletDatabase
 
 class InvalidAddress(Exception):
     pass
@@ -16,12 +21,30 @@ class DuplicateWalletItem(Exception):
     pass
 
 class Wallet:
-    '''The Wallet is responsible for managing private keys and spendable inputs'''
-    def __init__(self, spv, monitors=None):
+    '''The Wallet is responsible for managing private keys and spendable inputs.
+
+    A :py:class:`pyspv.blockscan.BlockScanner` picks out the transactions in each block that the monitors could care
+    about from the serialized block, so only those are unserialized and looked at.  block_scan_processes is the number
+    of worker processes it uses (None for one per CPU, 1 to scan in this process).
+
+    With snapshot=True, the wallet's spend table and balances are saved when pyspv shuts down (see
+    :py:meth:`save_snapshot`), and loaded back the next time instead of unserializing and checking every spend.  Only
+    the spends that aren't spendable yet, and the spends of monitors that keep something for each of their spends, are
+    built at load.  The rest are built the first time they're needed.  A snapshot is only used if no spend was saved
+    after it and the blockchain hasn't gotten shorter.
+
+    Balances are kept for each category and each spend state (see :py:class:`pyspv.spendtable.SpendTable`), and moved
+    between states as spends change and as blocks are added and removed, so :py:meth:`get_balance` doesn't look at
+    any spends.  A spend in a block becomes mature TRANSACTION_CONFIRMATION_DEPTH blocks later, and those maturity
+    heights are kept in a heap, so each new block only looks at the spends that mature in it.  The spends that aren't
+    in a block yet are checked again on every block, and the ones that are deep enough but can't be signed for when an
+    item that signs with one of the keys they need is added to the wallet or updated.
+    '''
+    def __init__(self, spv, monitors=None, block_scan_processes=1, snapshot=False):
         self.spv = spv
+        self.snapshot = snapshot
         self.payment_types = set()
         self.payment_types_by_name = {}
-        self.wallet_file = self.spv.config.get_file("wallet")
         self.wallet_lock = threading.Lock()
         self.tx_lock = threading.Lock()
         self.temp_collections_lock = threading.Lock()
@@ -30,58 +53,67 @@ class Wallet:
         self.collection_sizes = {}
         self.temp_collections = {}
         self.temp_collection_sizes = {}
+        self.block_scanner = BlockScanner(block_scan_processes)
+
+        # Built by get_filter_scripts and get_filter_prevouts, and dropped whenever the monitors might be watching
+        # something new or a spend is added
+        self.filter_scripts = None
+        self.filter_prevouts = None
 
         for m in monitors:
             for sc in m.spend_classes:
                 self.spend_classes[sc.__name__] = sc
 
     def load(self):
-        with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                if 'creation_time' not in d:
-                    d['creation_time'] = time.time()
-
-                if 'spends' not in d or isinstance(d['spends'], list) or self.spv.args.resync:
-                    d['spends'] = {}
-
-                # TODO - delete this code after saving old keys
-                if 'keys' in d:
-                    print("!!!!!!!!!! OLD KEYS !!!!!!!!!!!!")
-                    for key in d['keys']:
-                        print(PrivateKey.unserialize(key['key'])[0].as_wif(self.spv.coin, False))
-                        print(PrivateKey.unserialize(key['key'])[0].as_wif(self.spv.coin, True))
-                    print("!!!!!!!!!! OLD KEYS !!!!!!!!!!!!")
-                        
-                if 'wallet' not in d:
-                    d['wallet'] = {}
-
-                self.creation_time = d['creation_time']
-                self.__load_wallet(d)
-
-    def __load_wallet(self, d):
-        collections = d['wallet']
-        for collection_name in collections.keys():
-            self.collection_sizes[collection_name] = len(collections[collection_name])
-            for item, metadata in collections[collection_name].items():
+        self.walletdb = WalletDatabase(self.spv)
+
+        with self.batch(), self.wallet_lock:
+            self.creation_time = self.walletdb.get_setting('creation_time')
+            if self.creation_time is None:
+                self.creation_time = time.time()
+                self.walletdb.set_setting('creation_time', self.creation_time)
+
+            if self.spv.args.resync:
+                self.walletdb.clear_spends()
+
+            self.best_height = self.spv.blockchain.get_best_chain_height()
+
+            # Monitors get the public keys of private keys from here instead of deriving them every time
+            self.public_key_cache = PublicKeyCache(self.spv, self.walletdb)
+
+            self.__load_wallet()
+
+    def __load_wallet(self):
+        # collection_name -> {item: (item_id, birthday)}.  Items from before birthdays were kept are as old as the wallet.
+        self.items = {}
+        self.earliest_birthday = None
+        with self.batch():
+            for item_id, collection_name, item, metadata, birthday in self.walletdb.get_items():
+                self.items.setdefault(collection_name, {})[item] = (item_id, birthday)
+                self.earliest_birthday = self.__earlier(self.earliest_birthday, self.creation_time if birthday is None else birthday)
                 for m in self.monitors:
                     if hasattr(m, 'on_new_' + collection_name):
                         getattr(m, 'on_new_' + collection_name)(item, metadata)
 
-        self.spends = {}
-        self.spends_by_index = []
+        for collection_name, collection in self.items.items():
+            self.collection_sizes[collection_name] = len(collection)
+
+        if self.snapshot and self.__load_snapshot():
+            if self.spv.logging_level <= INFO:
+                print('[WALLET] loaded {} spends from snapshot with balance of {} BTC'.format(len(self.spend_table), dict(self.balance)))
+            return
+
+        # Spends are kept in a SpendTable and only built from the wallet database when they're needed
+        self.spend_table = SpendTable()
         self.balance = defaultdict(int)
-        self.balance_spends = set()
-        for _, spend_dict in d['spends'].items():
-            spend_class = self.spend_classes[spend_dict['class']]
-            spend, _ = spend_class.unserialize(spend_dict['data'], self.spv.coin)
-            spend_hash = spend.hash()
-            self.spends[spend.hash()] = {
-                'spend'   : spend,
-            }
-            self.spends_by_index.append(spend_hash)
-            if not spend.is_spent(self.spv):
-                self.balance[spend.category] += spend.amount
-                self.balance_spends.add(spend_hash)
+        self.balances = {}
+        self.__reset_indexes()
+
+        for spend_class_name, spend_data in self.walletdb.get_spends():
+            spend_class = self.spend_classes[spend_class_name]
+            spend, _ = spend_class.unserialize(spend_data, self.spv.coin)
+            row = self.spend_table.add(spend.hash(), spend_class_name, spend.category, spend.amount, getattr(spend, 'prevout', None))
+            self.__index_spend(row, spend, new=True)
             for m in self.monitors:
                 if hasattr(m, 'on_new_spend'):
                     getattr(m, 'on_new_spend')(spend)
@@ -89,30 +121,109 @@ class Wallet:
         if self.spv.logging_level <= INFO:
             print('[WALLET] loaded with balance of {} BTC'.format(dict(self.balance)))
 
+    def __load_snapshot(self):
+        # call with wallet_lock held. Returns False if there's no snapshot or it's out of date
+        snapshot = self.walletdb.get_setting('spend_snapshot')
+        if snapshot is None:
+            return False
+
+        if snapshot['spends_version'] != self.walletdb.get_spends_version() or snapshot['height'] > self.best_height or 'balances' not in snapshot:
+            if self.spv.logging_level <= INFO:
+                print('[WALLET] spend snapshot is out of date, loading every spend')
+            return False
+
+        self.spend_table = snapshot['spend_table']
+        self.balance = defaultdict(int, snapshot['balance'])
+        self.balances = snapshot['balances']
+        self.__reset_indexes()
+
+        # The rows that aren't spendable yet go back in the maturity heap, and blocks may have come in since the snapshot
+        for row in self.spend_table.find_rows(None, 0, SpendTable.FLAG_SPENT | SpendTable.FLAG_SPENDABLE):
+            self.__index_spend(row, self.__build_spend(row))
+
+        for m in self.monitors:
+            if hasattr(m, 'on_new_spend'):
+                for row in self.spend_table.find_class_rows([sc.__name__ for sc in m.spend_classes]):
+                    m.on_new_spend(self.__build_spend(row))
+
+        return True
+
+    def save_snapshot(self):
+        '''Saves the spend table and balances for the next time the wallet is loaded with
+        snapshot=True.  Called by :py:meth:`pyspv.pyspv.join` once the network has stopped.'''
+        if not self.snapshot:
+            return
+
+        with self.batch(), self.wallet_lock:
+            self.walletdb.set_setting('spend_snapshot', {
+                'spends_version': self.walletdb.get_spends_version(),
+                'height'        : self.spv.blockchain.get_best_chain_height(),
+                'spend_table'   : self.spend_table,
+                'balance'       : dict(self.balance),
+                'balances'      : self.balances,
+            })
+
+            if self.spv.logging_level <= INFO:
+                print('[WALLET] saved snapshot of {} spends'.format(len(self.spend_table)))
+
     def len(self, collection_name):
         with self.wallet_lock:
             return self.collection_sizes.get(collection_name, 0)
 
-    def add(self, collection_name, item, metadata):
-        '''item must be pickle serializable and implement __hash__ and __eq__'''
+    def get_filter_scripts(self):
+        '''Returns a frozenset of all of the scriptPubKeys the monitors are watching for, for matching compact block
+        filters.  The same set is returned until items or spends are added or updated, so callers can tell it hasn't
+        changed by identity.'''
+        with self.wallet_lock:
+            if self.filter_scripts is None:
+                self.filter_scripts = frozenset(script for m in self.monitors for script in m.get_filter_scripts())
+            return self.filter_scripts
+
+    def get_filter_prevouts(self):
+        '''Returns a frozenset of the serialized prevouts of every spend, for matching our own compact block filters
+        (see :py:func:`pyspv.cfilter.local_filter_items`), which have the prevouts a block spends instead of their
+        scripts.  Like :py:meth:`get_filter_scripts`, the same set is returned until a spend is added.'''
+        with self.wallet_lock:
+            if self.filter_prevouts is None:
+                self.filter_prevouts = frozenset(self.spend_table.get_prevouts())
+            return self.filter_prevouts
+
+    def get_birthday(self, collection_name, item):
+        '''Returns the time item was added to the wallet, or the time given to :py:meth:`add` for it'''
+        with self.wallet_lock:
+            _, birthday = self.items.get(collection_name, {}).get(item, (None, None))
+            return self.creation_time if birthday is None else birthday
+
+    def get_earliest_birthday(self, items=None):
+        '''Returns the earliest birthday of items (a list of (collection_name, item)) or of everything in the wallet.  No
+        payments to them can be in blocks from before then, so only headers are synced up to about that time.  An empty
+        wallet counts from its creation time.'''
+        if items is None:
+            earliest_birthday = self.earliest_birthday
+            return self.creation_time if earliest_birthday is None else earliest_birthday
+
+        return min(self.get_birthday(collection_name, item) for collection_name, item in items)
+
+    def __earlier(self, a, b):
+        return b if a is None or b < a else a
+
+    def add(self, collection_name, item, metadata, birthday=None):
+        '''item must be pickle serializable and implement __hash__ and __eq__.  birthday is the time item could first
+        have been paid, defaulting to now.  Give it for an imported key, and then rescan the blocks since
+        (see :py:meth:`pyspv.rescan`) to find its payments.'''
         assert isinstance(collection_name, str)
         assert isinstance(metadata, dict)
 
-        with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                wallet = d['wallet']
-                if collection_name not in wallet:
-                    collection = {}
-                else:
-                    collection = wallet[collection_name]
+        if birthday is None:
+            birthday = time.time()
 
-                if item in collection:
-                    raise DuplicateWalletItem()
+        with self.batch(), self.wallet_lock:
+            collection = self.items.setdefault(collection_name, {})
+            if item in collection:
+                raise DuplicateWalletItem()
 
-                # TODO maybe this is going to get slow with large wallets.
-                collection[item] = metadata
-                wallet[collection_name] = collection
-                d['wallet'] = wallet
+            collection[item] = (self.walletdb.add_item(collection_name, item, metadata, birthday), birthday)
+            self.earliest_birthday = self.__earlier(self.earliest_birthday, birthday)
 
             if collection_name not in self.collection_sizes:
                 self.collection_sizes[collection_name] = 0
@@ -121,41 +232,37 @@ class Wallet:
             for m in self.monitors:
                 if hasattr(m, 'on_new_' + collection_name):
                     getattr(m, 'on_new_' + collection_name)(item, metadata)
+            self.filter_scripts = None
+            self.__recheck_unsignable(collection_name, item, metadata)
 
     def update(self, collection_name, item, metadata):
         '''item must be pickle serializable and implement __hash__ and __eq__'''
         assert isinstance(collection_name, str)
         assert isinstance(metadata, dict)
 
-        with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                wallet = d['wallet']
-                if collection_name not in wallet:
-                    collection = {}
-                else:
-                    collection = wallet[collection_name]
-
-                if item not in collection:
-                    raise AttributeError("item {} not in collection {}".format(str(item), collection_name))
+        with self.batch(), self.wallet_lock:
+            if item not in self.items.get(collection_name, {}):
+                raise AttributeError("item {} not in collection {}".format(str(item), collection_name))
 
-                # TODO maybe this is going to get slow with large wallets.
-                collection[item] = metadata
-                wallet[collection_name] = collection
-                d['wallet'] = wallet
+            item_id, _ = self.items[collection_name][item]
+            old_metadata = self.walletdb.get_item_metadata(item_id) if len(self.unsignable_rows) else None
+            self.walletdb.update_item(item_id, metadata)
 
             for m in self.monitors:
                 if hasattr(m, 'on_' + collection_name):
                     getattr(m, 'on_' + collection_name)(self, item, metadata)
+            self.filter_scripts = None
+            self.__recheck_unsignable(collection_name, item, metadata, old_metadata)
 
     def get(self, collection_name, item):
         '''item must be implement __hash__ and __eq__. Returns metadata bound to the item or None if not found'''
         assert isinstance(collection_name, str)
         with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                wallet = d['wallet']
-                if collection_name not in wallet:
-                    return None
-                return wallet[collection_name][item]
+            if item not in self.items.get(collection_name, {}):
+                return None
+
+            item_id, _ = self.items[collection_name][item]
+            return self.walletdb.get_item_metadata(item_id)
 
     def add_temp(self, collection_name, item, metadata):
         '''item must be implement __hash__ and __eq__'''
@@ -186,167 +293,175 @@ class Wallet:
 
             return collection[item]
 
-    def add_spend(self, spend):
+    def get_spend(self, spend_hash):
+        '''Returns the spend with hash spend_hash, or None if it isn't in the wallet.  Each call builds a new Spend from
+        the wallet database.'''
         with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                spend_hash = spend.hash()
+            row = self.spend_table.get_row(spend_hash)
+            return None if row is None else self.__build_spend(row)
 
-                spends = d['spends']
-                spends[spend_hash] = {
-                    'class'   : spend.__class__.__name__,
-                    'data'    : spend.serialize(),
-                }
+    def get_spend_by_prevout(self, prevout):
+        '''Returns the spend of prevout (a :py:class:`pyspv.transaction.TransactionPrevOut`), or None if it isn't one of
+        ours.  The spends of prevouts are hashed from the serialized prevout, so this is a single lookup.'''
+        serialized_prevout = prevout.serialize()
+        with self.wallet_lock:
+            row = self.spend_table.get_row(self.spv.coin.hash(serialized_prevout))
+            if row is None or self.spend_table.get_prevout(row) != serialized_prevout:
+                return None
+            return self.__build_spend(row)
 
-                d['spends'] = spends
+    def get_spends(self):
+        '''Yields every spend in the wallet, spent or not, built one at a time'''
+        with self.wallet_lock:
+            spend_hashes = [self.spend_table.get_spend_hash(row) for row in range(len(self.spend_table))]
 
-                self.spends[spend_hash] = {
-                    'spend'   : spend,
-                }
+        for spend_hash in spend_hashes:
+            spend = self.get_spend(spend_hash)
+            if spend is not None:
+                yield spend
 
-                self.spends_by_index.append(spend_hash)
+    def __build_spend(self, row):
+        # call with wallet_lock held
+        spend_class_name, spend_data = self.walletdb.get_spend(self.spend_table.get_spend_hash(row))
+        spend, _ = self.spend_classes[spend_class_name].unserialize(spend_data, self.spv.coin)
+        return spend
 
-                if spend.category not in self.balance:
-                    self.balance[spend.category] = 0
+    def add_spend(self, spend):
+        with self.batch(), self.wallet_lock:
+            spend_hash = spend.hash()
+            if spend_hash in self.spend_table:
+                return self.__update_spend(spend_hash, spend)
 
-                if spend.is_spent(self.spv) and spend_hash in self.balance_spends:
-                    self.balance[spend.category] -= spend.amount
-                    self.balance_spends.remove(spend_hash)
+            self.walletdb.save_spend(spend_hash, spend.__class__.__name__, spend.serialize())
 
-                if not spend.is_spent(self.spv) and spend_hash not in self.balance_spends:
-                    self.balance[spend.category] += spend.amount
-                    self.balance_spends.add(spend_hash)
+            row = self.spend_table.add(spend_hash, spend.__class__.__name__, spend.category, spend.amount, getattr(spend, 'prevout', None))
+            self.__index_spend(row, spend, new=True)
 
-                for m in self.monitors:
-                    if hasattr(m, 'on_new_spend'):
-                        getattr(m, 'on_new_spend')(spend)
+            for m in self.monitors:
+                if hasattr(m, 'on_new_spend'):
+                    getattr(m, 'on_new_spend')(spend)
+            self.filter_scripts = None
+            self.filter_prevouts = None
 
-                if self.spv.logging_level <= INFO:
-                    print('[WALLET] added {} to wallet category {} (new balance={})'.format(spend.amount, spend.category, self.balance[spend.category]))
+            if self.spv.logging_level <= INFO:
+                print('[WALLET] added {} to wallet category {} (new balance={})'.format(spend.amount, spend.category, self.balance[spend.category]))
 
-                return True
+            return True
 
     def update_spend(self, spend):
-        with self.wallet_lock:
-            with closing(shelve.open(self.wallet_file)) as d:
-                spend_hash = spend.hash()
-
-                spends = d['spends']
-                if spend_hash not in spends:
-                    raise AttributeError("spend does not exist")
-
-                spends.pop(spend_hash)
-                spends[spend_hash] = {
-                    'class'   : spend.__class__.__name__,
-                    'data'    : spend.serialize(),
-                }
-
-                d['spends'] = spends
+        with self.batch(), self.wallet_lock:
+            spend_hash = spend.hash()
+            if spend_hash not in self.spend_table:
+                raise AttributeError("spend does not exist")
 
-                old_spend = self.spends.pop(spend_hash)
-                self.spends[spend_hash] = {
-                    'spend'   : spend,
-                }
+            return self.__update_spend(spend_hash, spend)
 
-                if spend.category not in self.balance:
-                    self.balance[spend.category] = 0
+    def __update_spend(self, spend_hash, spend):
+        # call with wallet_lock held. The category and amount of a spend don't change, only whether it's spent
+        self.walletdb.save_spend(spend_hash, spend.__class__.__name__, spend.serialize())
 
-                if spend.is_spent(self.spv) and spend_hash in self.balance_spends:
-                    self.balance[spend.category] -= old_spend['spend'].amount
-                    self.balance_spends.remove(spend_hash)
+        row = self.spend_table.get_row(spend_hash)
+        category = self.spend_table.get_category(row)
+        amount = self.spend_table.get_amount(row)
+        self.__index_spend(row, spend)
 
-                if not spend.is_spent(self.spv) and spend_hash not in self.balance_spends:
-                    self.balance[spend.category] += spend.amount
-                    self.balance_spends.add(spend_hash)
+        if self.spv.logging_level <= INFO:
+            print('[WALLET] updated {} in wallet category {} (new balance={})'.format(amount, category, self.balance[category]))
 
-                if self.spv.logging_level <= INFO:
-                    print('[WALLET] updated {} in wallet category {} (new balance={})'.format(spend.amount, spend.category, self.balance[spend.category]))
+        return True
 
-                return True
 
+    def select_spends(self, categories, amount, dont_select=None, strategy='approximate'):
+        '''Picks spendable spends from categories that add up to at least amount.  strategy is how a subset of the
+        smaller spends is found: 'approximate' makes random passes over them looking for amount, or amount plus enough
+        change to not be dust.  'bnb' uses :py:func:`pyspv.coinselect.select_subset`, which also accepts a total less
+        than DUST_LIMIT over amount, for a transaction without change.'''
+        assert strategy in coinselect.STRATEGIES
 
-    def select_spends(self, categories, amount, dont_select=None):
         if dont_select is None:
             dont_select = set()
 
         with self.wallet_lock:
-            coins_ret = []
-
             if self.spv.logging_level <= DEBUG:
                 print("[WALLET] select_spends: start for {} (categories={})".format(self.spv.coin.format_money(amount), ', '.join(categories)))
 
             # build a list of spends where all spends are leq than the target
-            # and keep track of the spellest spend over the target
-            spend_smallest_over_amount = None
-            spends_below = []
-
-            # use a random coprime generator to iterate over spends
-            # instead of creating a copy of the wallet's unspent outputs
-            p = random_coprime(len(self.spends_by_index))
-
-            for i in range(len(self.spends_by_index)):
-                spend_hash = self.spends_by_index[(i * p) % len(self.spends_by_index)]
-                spend_dict = self.spends[spend_hash]
-
-                spend = spend_dict['spend']
-
-                if spend.hash() in dont_select:
-                    continue
-
-                if not spend.is_spendable(self.spv):
-                    continue
-                
-                # Only allow inputs from approved wallet categories
-                if spend.category not in categories:
-                    continue
-
-                if spend.amount == amount:
-                    if self.spv.logging_level <= DEBUG:
-                        print("[WALLET] select_spends: found perfect match")
-                    return [spend]
-                elif spend.amount < (amount + self.spv.coin.DUST_LIMIT):
-                    if self.spv.logging_level <= DEBUG:
-                        print("[WALLET] select_spends: selecting {}".format(self.spv.coin.format_money(spend.amount)))
-                    spends_below.append(spend)
-                elif spend_smallest_over_amount is None or spend.amount < spend_smallest_over_amount.amount:
-                    spend_smallest_over_amount = spend
-
-            if self.spv.logging_level <= DEBUG and spend_smallest_over_amount is not None:
-                print("[WALLET] select_spends: smallest over target is {}".format(self.spv.coin.format_money(spend_smallest_over_amount.amount)))
-                    
-            total_below = sum(spend.amount for spend in spends_below)
+            # and keep track of the spellest spend over the target.  The spendable
+            # amounts of each category are kept sorted, so the perfect match and
+            # the smallest spend over the target are found by binary search, and
+            # Spends are only built for the ones that are picked
+            def selectable(row):
+                return len(dont_select) == 0 or self.spend_table.get_spend_hash(row) not in dont_select
+
+            amounts = self.spend_table.amounts
+            rows_below = []
+            row_smallest_over_amount = None
+            for category in categories:
+                index = self.spendable_amounts.get(category, [])
+
+                i = bisect.bisect_left(index, (amount,))
+                while i < len(index) and index[i][0] == amount:
+                    if selectable(index[i][1]):
+                        if self.spv.logging_level <= DEBUG:
+                            print("[WALLET] select_spends: found perfect match")
+                        return [self.__build_spend(index[i][1])]
+                    i += 1
+
+                end = bisect.bisect_left(index, (amount + self.spv.coin.DUST_LIMIT,))
+                rows_below.extend(row for _, row in index[:end] if selectable(row))
+
+                for i in range(end, len(index)):
+                    row = index[i][1]
+                    if selectable(row):
+                        if row_smallest_over_amount is None or amounts[row] < amounts[row_smallest_over_amount]:
+                            row_smallest_over_amount = row
+                        break
+
+            smallest_over_amount = None if row_smallest_over_amount is None else amounts[row_smallest_over_amount]
+            if self.spv.logging_level <= DEBUG and smallest_over_amount is not None:
+                print("[WALLET] select_spends: smallest over target is {}".format(self.spv.coin.format_money(smallest_over_amount)))
+
+            total_below = sum(amounts[row] for row in rows_below)
             if total_below == amount:
                 if self.spv.logging_level <= DEBUG:
                     print("[WALLET] select_spends: sum of spends_below was a perfect match")
-                return spends_below
+                return [self.__build_spend(row) for row in rows_below]
 
             if total_below < amount:
-                if spend_smallest_over_amount is None:
+                if smallest_over_amount is None:
                     if self.spv.logging_level <= WARNING:
                         print("[WALLET] select_spends: couldn't find enough inputs (total_below is {})".format(total_below))
                     return []
                 else:
                     if self.spv.logging_level <= DEBUG:
-                        print("[WALLET] select_spends: spends_below don't supply enough value... using a single spend of {} instead".format(self.spv.coin.format_money(spend_smallest_over_amount.amount)))
-                    return [spend_smallest_over_amount]
-
-            # this can be slow if there are lots of dusty inputs
-            spends_below.sort(key=lambda spend: spend.amount)
-
-            # solve subset sum by stochastic approximation
-            best_spends = self.approximate_best_subset(spends_below, amount, 1000)
-            best_total = sum(spend.amount for spend in best_spends)
-            if best_total != amount and total_below >= amount + self.spv.coin.DUST_LIMIT:
-                best_spends = self.approximate_best_subset(spends_below, amount + self.spv.coin.DUST_LIMIT, 1000)
-                best_total = sum(spend.amount for spend in best_spends)
-                
+                        print("[WALLET] select_spends: spends_below don't supply enough value... using a single spend of {} instead".format(self.spv.coin.format_money(smallest_over_amount)))
+                    return [self.__build_spend(row_smallest_over_amount)]
+
+            rows_below.sort(key=lambda row: amounts[row])
+            amounts_below = [amounts[row] for row in rows_below]
+
+            if strategy == 'bnb':
+                # branch and bound, then random subsets over arrays of the amounts
+                best_rows = [rows_below[i] for i in coinselect.select_subset(amounts_below, amount, self.spv.coin.DUST_LIMIT)]
+                best_total = sum(amounts[row] for row in best_rows)
+                dust_change = False
+            else:
+                # solve subset sum by stochastic approximation
+                best_rows = [rows_below[i] for i in self.approximate_best_subset(amounts_below, amount, 1000)]
+                best_total = sum(amounts[row] for row in best_rows)
+                if best_total != amount and total_below >= amount + self.spv.coin.DUST_LIMIT:
+                    best_rows = [rows_below[i] for i in self.approximate_best_subset(amounts_below, amount + self.spv.coin.DUST_LIMIT, 1000)]
+                    best_total = sum(amounts[row] for row in best_rows)
+                dust_change = best_total != amount and best_total < (amount + self.spv.coin.DUST_LIMIT)
+
             # if we have a bigger coin and either the stochastic approximation didn't find a good solution,
             # or the next bigger coin is closer, return the bigger coin
-            if spend_smallest_over_amount is not None and ((best_total != amount and best_total < (amount + self.spv.coin.DUST_LIMIT)) or (spend_smallest_over_amount.amount <= best_total)):
-                coins_ret.append(spend_smallest_over_amount)
+            if smallest_over_amount is not None and (dust_change or (smallest_over_amount <= best_total)):
                 if self.spv.logging_level <= DEBUG:
-                    print("[WALLET] stochastic approximation failed to find a good subset (best was {}).. using a single larger input of {}!".format(best_total, spend_smallest_over_amount.amount))
-                return [spend_smallest_over_amount]
+                    print("[WALLET] stochastic approximation failed to find a good subset (best was {}).. using a single larger input of {}!".format(best_total, smallest_over_amount))
+                return [self.__build_spend(row_smallest_over_amount)]
             else:
+                best_spends = [self.__build_spend(row) for row in best_rows]
                 if self.spv.logging_level <= DEBUG:
                     print("[WALLET] stochastic approximation returned these coins:")
                     for spend in best_spends:
@@ -355,20 +470,20 @@ class Wallet:
 
                 return best_spends
 
-    def approximate_best_subset(self, spends, amount, iterations):
-        '''returns a list of coins that are cloest to the target amount'''
+    def approximate_best_subset(self, amounts, amount, iterations):
+        '''returns the indexes of the amounts that add up cloest to the target amount'''
         if self.spv.logging_level <= DEBUG:
             print("[WALLET] approximate_best_subset: start for {} ({} iterations)".format(self.spv.coin.format_money(amount), iterations))
 
         # initially start with all spends used
-        best_spends = [True] * len(spends)
-        best_value = sum(spend.amount for spend in spends)
+        best_spends = [True] * len(amounts)
+        best_value = sum(amounts)
 
         for _ in range(iterations):
             if best_value == amount:
                 break
 
-            included = [False] * len(spends)
+            included = [False] * len(amounts)
             total = 0
 
             reached_target = False
@@ -376,7 +491,7 @@ class Wallet:
                 if reached_target:
                     break
 
-                for i in range(len(spends)): 
+                for i in range(len(amounts)):
                     if k == 0:
                         include_this = bool(random.getrandbits(1))
                     else:
@@ -385,7 +500,7 @@ class Wallet:
                     if not include_this:
                         continue
 
-                    total += spends[i].amount
+                    total += amounts[i]
                     included[i] = True
 
                     if total < amount:
@@ -396,26 +511,266 @@ class Wallet:
                         best_value = total
                         best_spends = included.copy()
 
-                    total -= spends[i].amount
+                    total -= amounts[i]
                     included[i] = False
 
-        result = []
-        for i, include in enumerate(best_spends):
-            if include:
-                result.append(spends[i])
+        return [i for i, include in enumerate(best_spends) if include]
+
+    def __reset_indexes(self):
+        # call with wallet_lock held. maturity_heap holds (maturity height, row) for the confirming rows, and
+        # maturity_heights the row's current entry, so entries that are out of date are skipped when they come up.
+        # recheck_rows are the unconfirmed rows, which have to be looked at on every block, and unsignable_rows the
+        # mature rows the wallet can't sign for, with the keys they need (see Spend.get_signing_keys), which are looked
+        # at when an item that signs with one of those keys is added or updated.
+        # spendable_amounts is category -> [(amount, row)] sorted, of the spendable rows, for select_spends.
+        self.maturity_heap = []
+        self.maturity_heights = {}
+        self.recheck_rows = set()
+        self.unsignable_rows = {}
+
+        self.spendable_amounts = {}
+        for row in self.spend_table.find_rows(None, SpendTable.FLAG_SPENDABLE):
+            self.spendable_amounts.setdefault(self.spend_table.get_category(row), []).append((self.spend_table.get_amount(row), row))
+        for index in self.spendable_amounts.values():
+            index.sort()
+
+    def __index_spend(self, row, spend, new=False):
+        # call with wallet_lock held. Updates the row's state from spend, moves its amount to the balance of that
+        # state, and tracks when it has to be looked at again
+        prevout = getattr(spend, 'prevout', None)
+        height = 0 if prevout is None else self.spv.txdb.get_tx_height(prevout.tx_hash)
+        maturity_height = height + self.spv.coin.TRANSACTION_CONFIRMATION_DEPTH - 1
+
+        spent = spend.is_spent(self.spv)
+        spendable = not spent and spend.is_spendable(self.spv)
+        mature = not spent and (spendable or (height > 0 and maturity_height <= self.best_height))
+
+        old_state = None if new else self.spend_table.get_state(row)
+        was_spendable = not new and self.spend_table.is_spendable(row)
+        self.spend_table.set_state(row, spent, spendable, height, mature)
+        if spendable != was_spendable:
+            self.__index_amount(row, spendable)
+        state = self.spend_table.get_state(row)
+        if state != old_state:
+            self.__move_balance(row, old_state, state)
+
+        if state == SpendTable.STATE_CONFIRMING:
+            if self.maturity_heights.get(row, None) != maturity_height:
+                self.maturity_heights[row] = maturity_height
+                heapq.heappush(self.maturity_heap, (maturity_height, row))
+        else:
+            self.maturity_heights.pop(row, None)
+
+        if state == SpendTable.STATE_UNCONFIRMED:
+            self.recheck_rows.add(row)
+        else:
+            self.recheck_rows.discard(row)
+
+        if state == SpendTable.STATE_MATURE and not spendable:
+            signing_keys = spend.get_signing_keys()
+            self.unsignable_rows[row] = None if signing_keys is None else frozenset(signing_keys)
+        else:
+            self.unsignable_rows.pop(row, None)
+
+    def __recheck_unsignable(self, collection_name, item, metadata, old_metadata=None):
+        # call with wallet_lock held. More blocks don't help a mature row the wallet can't sign for, but a new key in
+        # the wallet might.  Only the rows that need one of the keys item signs with are looked at again, and nothing
+        # is when only the label of an updated item changed.
+        if len(self.unsignable_rows) == 0:
+            return
+
+        if old_metadata is not None and dict(old_metadata, label=None) == dict(metadata, label=None):
+            return
+
+        signing_keys = set()
+        for m in self.monitors:
+            keys = m.get_item_signing_keys(collection_name, item, metadata)
+            if keys is None:
+                signing_keys = None
+                break
+            signing_keys.update(keys)
+
+        if signing_keys is not None and len(signing_keys) == 0:
+            return
+
+        rows = [row for row, keys in self.unsignable_rows.items() if signing_keys is None or keys is None or not keys.isdisjoint(signing_keys)]
+        for row in rows:
+            self.__index_spend(row, self.__build_spend(row))
+
+    def __index_amount(self, row, spendable):
+        # call with wallet_lock held. Puts the row in or takes it out of spendable_amounts
+        key = (self.spend_table.get_amount(row), row)
+        index = self.spendable_amounts.setdefault(self.spend_table.get_category(row), [])
+        if spendable:
+            bisect.insort(index, key)
+        else:
+            index.pop(bisect.bisect_left(index, key))
+
+    def __move_balance(self, row, old_state, state):
+        # call with wallet_lock held
+        category = self.spend_table.get_category(row)
+        amount = self.spend_table.get_amount(row)
+        balances = self.balances.setdefault(category, [0] * len(SpendTable.STATE_NAMES))
+
+        if old_state is not None:
+            balances[old_state] -= amount
+            if old_state != SpendTable.STATE_SPENT:
+                self.balance[category] -= amount
+
+        balances[state] += amount
+        if state != SpendTable.STATE_SPENT:
+            self.balance[category] += amount
+
+    def get_balance(self, category, state=None):
+        '''Returns the total amount of the spends in category that are in state (one of
+        :py:attr:`pyspv.spendtable.SpendTable.STATE_NAMES`), or that aren't spent if state is None'''
+        with self.wallet_lock:
+            if state is None:
+                return self.balance.get(category, 0)
+            balances = self.balances.get(category, None)
+            return 0 if balances is None else balances[SpendTable.STATE_NAMES.index(state)]
+
+    def get_balances(self):
+        '''Returns category -> state -> the total amount of the spends in that state'''
+        with self.wallet_lock:
+            return dict((category, dict(zip(SpendTable.STATE_NAMES, balances))) for category, balances in self.balances.items())
+
+    def get_spend_state(self, spend_hash):
+        '''Returns (state, confirmations, spendable) for the spend with hash spend_hash, where state is one of
+        :py:attr:`pyspv.spendtable.SpendTable.STATE_NAMES`, or None if it isn't in the wallet.  A mature spend isn't
+        spendable if the wallet can't sign for it.'''
+        with self.wallet_lock:
+            row = self.spend_table.get_row(spend_hash)
+            if row is None:
+                return None
+            height = self.spend_table.get_height(row)
+            confirmations = 0 if height == 0 else self.best_height - height + 1
+            return SpendTable.STATE_NAMES[self.spend_table.get_state(row)], confirmations, self.spend_table.is_spendable(row)
+
+    def on_block_added(self, block_header, block_height):
+        # Only the rows that mature at block_height come off the heap, plus the ones that are rechecked every block
+        with self.wallet_lock:
+            self.best_height = block_height
+
+            rows = set(self.recheck_rows)
+            while len(self.maturity_heap) and self.maturity_heap[0][0] <= block_height:
+                maturity_height, row = heapq.heappop(self.maturity_heap)
+                if self.maturity_heights.get(row, None) == maturity_height:
+                    del self.maturity_heights[row]
+                    rows.add(row)
+
+            for row in rows:
+                self.__index_spend(row, self.__build_spend(row))
+
+    def on_block_removed(self, block_header, block_height):
+        # Rewinds what on_block_added did for block_height: the confirming rows in block_height or above go back to
+        # unconfirmed, and the mature rows that aren't deep enough without it go back on the heap
+        with self.wallet_lock:
+            self.best_height = block_height - 1
 
-        return result
+            depth = self.spv.coin.TRANSACTION_CONFIRMATION_DEPTH
+            rows = set(row for row, maturity_height in self.maturity_heights.items() if maturity_height - depth + 1 >= block_height)
+            rows.update(self.spend_table.find_mature_rows(block_height - depth + 1))
+
+            for row in rows:
+                self.__index_spend(row, self.__build_spend(row))
+
+    def batch(self):
+        '''Wallet changes made inside ``with wallet.batch():`` are written out together, with one sync, when the batch
+        ends.  Each block is processed in a batch, since the monitors can add and update many items and spends for one.
+        Other threads' changes wait for the batch to end.  Open it before taking any other lock.'''
+        return self.walletdb.batch()
 
     def on_block(self, block):
         with self.tx_lock:
+            self.__process_block(block, self.block_scanner, None)
+
+    def rescan_block(self, block, block_scanner, scan_keys):
+        '''Runs the transactions in a block we've seen before through the monitors again, but only the ones matching
+        scan_keys (a list of scan keys, see :py:meth:`pyspv.monitors.basemonitor.BaseMonitor.get_scan_keys`) or
+        spending a prevout the monitors are watching.  Used by :py:class:`pyspv.rescan.Rescan`.'''
+        with self.tx_lock:
+            self.__process_block(block, block_scanner, scan_keys)
+
+    def reindex_block(self, block):
+        '''Indexes the unconfirmed spends paid by the transactions in block again.  The transaction database only knows
+        the height of a transaction after the monitors have saved it, so :py:class:`pyspv.rescan.Rescan` calls this once
+        a rescanned block is in the transaction database, and the payments it found aren't left unconfirmed.'''
+        tx_hashes = set(block.get_transaction_hashes())
+        with self.wallet_lock:
+            for row in list(self.recheck_rows):
+                prevout = self.spend_table.get_prevout(row)
+                if prevout is not None and prevout[:32] in tx_hashes:
+                    self.__index_spend(row, self.__build_spend(row))
+
+    def __process_block(self, block, block_scanner, scan_keys):
+        # call with tx_lock held
+        # Each transaction's scripts are only classified once, no matter how many monitors look at them
+        classified_txs = self.__scan_block(block, block_scanner, scan_keys)
+
+        with self.batch():
             for m in self.monitors:
-                if hasattr(m, 'on_block'):
+                if self.__overrides_on_block(m):
+                    m.on_block(block)
+                elif hasattr(m, 'on_classified_block'):
+                    m.on_classified_block(classified_txs)
+                elif hasattr(m, 'on_classified_tx'):
+                    for classified_tx in classified_txs:
+                        m.on_classified_tx(classified_tx)
+                elif hasattr(m, 'on_block'):
                     getattr(m, 'on_block')(block)
 
+    def __overrides_on_block(self, m):
+        # BaseMonitor defines every handler, so a monitor that overrides on_block (written before transactions were
+        # classified) would never be called with the block otherwise
+        on_block = getattr(type(m), 'on_block', None)
+        return on_block is not None and on_block is not BaseMonitor.on_block and hasattr(m, 'on_classified_block')
+
+    def __scan_block(self, block, block_scanner, scan_keys):
+        # call with tx_lock held. Returns the classified transactions in block that the monitors could care about
+        with self.wallet_lock:
+            if scan_keys is None:
+                scan_keys = [m.get_scan_keys() for m in self.monitors]
+
+            if any(keys is None for keys in scan_keys):
+                # Some monitor has to see everything
+                return [ClassifiedTransaction(tx) for tx in block.transactions]
+
+            block_scanner.update_scan_keys(scan_keys)
+            prevouts = self.spend_table.get_prevouts()
+            monitor_prevouts = set(prevout.serialize() for m in self.monitors for prevout in m.get_scan_prevouts())
+            if len(monitor_prevouts):
+                prevouts = prevouts | monitor_prevouts
+
+        raw_transactions = block.raw_transactions if block.raw_transactions is not None else [tx.serialize() for tx in block.transactions]
+        matches = set(block_scanner.scan(raw_transactions, prevouts))
+
+        # A transaction that spends an output of a matching transaction might be spending a payment to us that the
+        # monitors haven't seen yet, so it has to be looked at too.  Looking for the hash in the raw transaction is
+        # enough to rule out the rest, a false match only costs unserializing it.
+        tx_hashes = block.get_transaction_hashes()
+        classified_txs = []
+        matched_tx_hashes = []
+        for i, data in enumerate(raw_transactions):
+            if i in matches or any(tx_hash in data for tx_hash in matched_tx_hashes):
+                tx = block.get_transaction(i)
+                if i not in matches and not any(input.prevout.tx_hash in matched_tx_hashes for input in tx.inputs):
+                    continue
+                classified_txs.append(ClassifiedTransaction(tx, tx_hashes[i]))
+                matched_tx_hashes.append(tx_hashes[i])
+
+        if self.spv.logging_level <= DEBUG:
+            print('[WALLET] {} of {} transactions in block {} matched'.format(len(classified_txs), len(raw_transactions), bytes_to_hexstring(block.header.hash())))
+
+        return classified_txs
+
     def on_tx(self, tx):
+        classified_tx = ClassifiedTransaction(tx)
         with self.tx_lock:
             for m in self.monitors:
-                if hasattr(m, 'on_tx'):
+                if hasattr(m, 'on_classified_tx'):
+                    m.on_classified_tx(classified_tx)
+                elif hasattr(m, 'on_tx'):
                     getattr(m, 'on_tx')(tx)
 
 class Spend:
@@ -433,6 +788,13 @@ class Spend:
     def hash(self):
         return self.coin.hash(self.serialize())
 
+    def get_signing_keys(self):
+        '''Returns the public keys (serialized) this spend needs private keys for, so that once it's deep enough and the
+        wallet still can't sign for it, it's only looked at again when an item with one of those keys is added (see
+        :py:meth:`pyspv.monitors.basemonitor.BaseMonitor.get_item_signing_keys`).  None (the default) if it can't tell,
+        and it's looked at again for every new item that signs anything.'''
+        return None
+
     def serialize(self):
         raise NotImplementedError("must implement in derived class")
 
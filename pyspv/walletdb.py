@@ -0,0 +1,208 @@
+import dbm
+import pickle
+import shelve
+import sqlite3
+import threading
+
+from contextlib import closing, contextmanager
+
+from .keys import PrivateKey
+from .util import *
+
+class WalletDatabase:
+    '''
+    Stores the wallet in an SQLite database ("wallet.sqlite") with one row per item and one row per spend, so adding
+    or updating one is a single small write no matter how big the wallet gets.  The database is opened in WAL mode and
+    kept open.
+
+    * settings: name -> pickled value, such as the wallet's creation time
+    * items: one row per item of each wallet collection, with the pickled item and metadata and the item's birthday.
+      Items are found by their rowid, which the wallet keeps in memory, since equal items don't always pickle the same.
+    * spends: spend hash -> spend class name and serialized spend
+    * public_keys: the pickled public keys derived from each private key, see :py:class:`pyspv.keycache.PublicKeyCache`
+    * key_pool: the serialized private keys that are in the wallet but haven't been handed out yet, see
+      :py:class:`pyspv.keypool.KeyPool`
+
+    The wallet can also save a snapshot of its spend table as a setting, see :py:meth:`pyspv.wallet.Wallet.save_snapshot`.
+
+    Each write is committed on its own, except inside a batch (see :py:meth:`batch`), where they're all committed
+    together at the end.  WAL mode appends commits to the write-ahead log and SQLite checkpoints it back into the
+    database every so often, so a commit is one append and one sync.
+
+    There's only the one connection, so a batch holds batch_lock from start to end, and writes from other threads wait
+    for it instead of ending up in the batch.  batch_lock is taken before any other lock: the wallet opens a batch
+    before taking its wallet_lock for anything that writes.  Reads don't wait, and see the open batch's writes.
+
+    Wallets from before this were one shelve file ("wallet") holding everything in a few big pickled dicts.  Those are
+    copied into the database in the transaction that creates it, and the shelve file is left alone.
+    '''
+
+    def __init__(self, spv):
+        self.spv = spv
+        self.database_file = self.spv.config.get_file("wallet.sqlite")
+        self.shelve_file = self.spv.config.get_file("wallet")
+        self.db_lock = threading.Lock()
+        self.batch_lock = threading.RLock()
+        self.batch_depth = 0
+
+        with self.db_lock:
+            self.db = sqlite3.connect(self.database_file, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=FULL')
+
+            with self.db:
+                # sqlite3 commits table changes right away unless a transaction is already open, so one is begun here.
+                # The tables are then created in the same transaction that copies the shelve file, and a wallet
+                # that's interrupted while it's copied is copied again the next time instead of being left empty.
+                self.db.execute('BEGIN')
+                created = self.db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='settings'").fetchone() is None
+                self.db.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value BLOB)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS items (collection TEXT, item BLOB, metadata BLOB, birthday REAL)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS spends (hash BLOB PRIMARY KEY, class TEXT, data BLOB)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS public_keys (key_id BLOB PRIMARY KEY, data BLOB)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS key_pool (private_key BLOB PRIMARY KEY)')
+
+                if created and dbm.whichdb(self.shelve_file) is not None:
+                    self.__migrate_shelve()
+
+    @contextmanager
+    def batch(self):
+        '''Writes made inside ``with walletdb.batch():`` are committed together when the outermost batch ends, or rolled
+        back if it ends with an exception.  Batches in the same thread nest.'''
+        with self.batch_lock:
+            self.batch_depth += 1
+            try:
+                yield
+            except:
+                with self.db_lock:
+                    self.batch_depth -= 1
+                    if self.batch_depth == 0:
+                        self.db.rollback()
+                raise
+
+            with self.db_lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.db.commit()
+
+    def close(self):
+        with self.db_lock:
+            self.db.close()
+
+    def get_setting(self, name, default=None):
+        with self.db_lock:
+            row = self.db.execute('SELECT value FROM settings WHERE name=?', (name,)).fetchone()
+            return default if row is None else pickle.loads(row[0])
+
+    def set_setting(self, name, value):
+        with self.batch_lock, self.db_lock:
+            self.__execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, pickle.dumps(value)))
+
+    def get_items(self):
+        '''Yields (item_id, collection_name, item, metadata, birthday) for every item.  birthday is None for items that
+        came from a wallet that didn't keep birthdays.'''
+        with self.db_lock:
+            rows = self.db.execute('SELECT rowid, collection, item, metadata, birthday FROM items ORDER BY rowid').fetchall()
+
+        for item_id, collection_name, item, metadata, birthday in rows:
+            yield item_id, collection_name, pickle.loads(item), pickle.loads(metadata), birthday
+
+    def add_item(self, collection_name, item, metadata, birthday):
+        '''Returns the new item's id'''
+        with self.batch_lock, self.db_lock:
+            return self.__execute('INSERT INTO items (collection, item, metadata, birthday) VALUES (?, ?, ?, ?)', (collection_name, pickle.dumps(item), pickle.dumps(metadata), birthday)).lastrowid
+
+    def get_item_metadata(self, item_id):
+        with self.db_lock:
+            row = self.db.execute('SELECT metadata FROM items WHERE rowid=?', (item_id,)).fetchone()
+            return None if row is None else pickle.loads(row[0])
+
+    def update_item(self, item_id, metadata):
+        with self.batch_lock, self.db_lock:
+            self.__execute('UPDATE items SET metadata=? WHERE rowid=?', (pickle.dumps(metadata), item_id))
+
+    def get_spends(self):
+        '''Returns a list of (spend_class_name, spend_data) in the order the spends were saved'''
+        with self.db_lock:
+            return self.db.execute('SELECT class, data FROM spends ORDER BY rowid').fetchall()
+
+    def get_spend(self, spend_hash):
+        '''Returns (spend_class_name, spend_data) or None'''
+        with self.db_lock:
+            return self.db.execute('SELECT class, data FROM spends WHERE hash=?', (spend_hash,)).fetchone()
+
+    def save_spend(self, spend_hash, spend_class_name, spend_data):
+        '''Adds or replaces a spend.  A replaced spend moves to the end of the order.'''
+        with self.batch_lock, self.db_lock:
+            # The new rowid is picked before the old row is replaced, so it's always past every other rowid, even the
+            # replaced one's
+            self.__execute('INSERT OR REPLACE INTO spends (rowid, hash, class, data) VALUES ((SELECT IFNULL(MAX(rowid), 0) + 1 FROM spends), ?, ?, ?)', (spend_hash, spend_class_name, spend_data))
+
+    def get_spends_version(self):
+        '''Returns a number that changes whenever a spend is saved (the last rowid in spends), or 0 if there are none'''
+        with self.db_lock:
+            return self.db.execute('SELECT IFNULL(MAX(rowid), 0) FROM spends').fetchone()[0]
+
+    def clear_spends(self):
+        with self.batch_lock, self.db_lock:
+            self.__execute('DELETE FROM spends')
+            self.__execute("DELETE FROM settings WHERE name='spend_snapshot'")
+
+    def get_public_keys(self):
+        '''Returns a list of (key_id, derived public keys)'''
+        with self.db_lock:
+            rows = self.db.execute('SELECT key_id, data FROM public_keys').fetchall()
+        return [(key_id, pickle.loads(data)) for key_id, data in rows]
+
+    def save_public_keys(self, key_id, public_keys):
+        with self.batch_lock, self.db_lock:
+            self.__execute('INSERT OR REPLACE INTO public_keys (key_id, data) VALUES (?, ?)', (key_id, pickle.dumps(public_keys)))
+
+    def get_pool_keys(self):
+        '''Returns the private keys in the key pool, oldest first'''
+        with self.db_lock:
+            rows = self.db.execute('SELECT private_key FROM key_pool ORDER BY rowid').fetchall()
+        return [PrivateKey.unserialize(private_key)[0] for private_key, in rows]
+
+    def add_pool_key(self, private_key):
+        with self.batch_lock, self.db_lock:
+            self.__execute('INSERT OR IGNORE INTO key_pool (private_key) VALUES (?)', (private_key.serialize(),))
+
+    def remove_pool_key(self, private_key):
+        with self.batch_lock, self.db_lock:
+            self.__execute('DELETE FROM key_pool WHERE private_key=?', (private_key.serialize(),))
+
+    def __execute(self, sql, parameters=()):
+        # call with batch_lock and db_lock held. Commits right away unless a batch is open
+        cursor = self.db.execute(sql, parameters)
+        if self.batch_depth == 0:
+            self.db.commit()
+        return cursor
+
+    def __migrate_shelve(self):
+        # call with db_lock held, inside a transaction
+        with closing(shelve.open(self.shelve_file, 'r')) as d:
+            # TODO - delete this code after saving old keys
+            if 'keys' in d:
+                print("!!!!!!!!!! OLD KEYS !!!!!!!!!!!!")
+                for key in d['keys']:
+                    print(PrivateKey.unserialize(key['key'])[0].as_wif(self.spv.coin, False))
+                    print(PrivateKey.unserialize(key['key'])[0].as_wif(self.spv.coin, True))
+                print("!!!!!!!!!! OLD KEYS !!!!!!!!!!!!")
+
+            if 'creation_time' in d:
+                self.db.execute('INSERT INTO settings (name, value) VALUES (?, ?)', ('creation_time', pickle.dumps(d['creation_time'])))
+
+            birthdays = d['birthdays'] if 'birthdays' in d else {}
+            collections = d['wallet'] if 'wallet' in d else {}
+            for collection_name, collection in collections.items():
+                collection_birthdays = birthdays.get(collection_name, {})
+                for item, metadata in collection.items():
+                    self.db.execute('INSERT INTO items (collection, item, metadata, birthday) VALUES (?, ?, ?, ?)', (collection_name, pickle.dumps(item), pickle.dumps(metadata), collection_birthdays.get(item, None)))
+
+            spends = d['spends'] if 'spends' in d and isinstance(d['spends'], dict) else {}
+            for spend_hash, spend_dict in spends.items():
+                self.db.execute('INSERT INTO spends (hash, class, data) VALUES (?, ?, ?)', (spend_hash, spend_dict['class'], spend_dict['data']))
+
+        if self.spv.logging_level <= INFO:
+            print('[WALLETDB] copied {} items and {} spends from the old wallet file'.format(sum(len(collection) for collection in collections.values()), len(spends)))
@@ -0,0 +1,64 @@
+'''Stand-ins for the parts of pyspv that a test doesn't exercise.  Tests that need more keep their own subclasses.'''
+
+import os
+
+from pyspv import Bitcoin, WARNING
+
+class StubConfig:
+    def __init__(self, path):
+        self.path = path
+
+    def get_file(self, name):
+        return os.path.join(self.path, name)
+
+class StubArgs:
+    resync = False
+
+class StubTransactionDatabase:
+    def __init__(self):
+        self.txs = {}
+        self.depths = {}
+        self.heights = {}
+
+    def save_tx(self, tx):
+        self.txs[tx.hash()] = tx
+
+    def get_tx_depth(self, tx_hash):
+        return self.depths.get(tx_hash, 0)
+
+    def get_tx_height(self, tx_hash):
+        return self.heights.get(tx_hash, 0)
+
+    def is_conflicted(self, tx_hash):
+        return False
+
+class StubBlockchain:
+    def __init__(self, height=100):
+        self.height = height
+
+    def get_best_chain_height(self):
+        return self.height
+
+class StubHeader:
+    def __init__(self, block_hash=None):
+        self.block_hash = block_hash if block_hash is not None else os.urandom(32)
+
+    def hash(self):
+        return self.block_hash
+
+    def work(self):
+        return 1
+
+class StubSPV:
+    coin = Bitcoin
+    logging_level = WARNING + 1
+    args = StubArgs()
+    sync_block_start = None
+    compact_filters = False
+    block_scan_processes = 1
+
+    def __init__(self, path=None, blockchain=None):
+        if path is not None:
+            self.config = StubConfig(path)
+        self.blockchain = blockchain if blockchain is not None else StubBlockchain()
+        self.txdb = StubTransactionDatabase()
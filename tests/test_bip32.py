@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.bip32 import ExtendedPublicKey, InvalidChildIndex, InvalidExtendedKey
+from pyspv.monitors.pubkey import PubKeySpend
+from pyspv.monitors.xpub import ExtendedPublicKeyPaymentMonitor, ExtendedPublicKeySpend
+from pyspv.script import *
+from pyspv.transaction import Transaction, TransactionInput, TransactionOutput, TransactionPrevOut
+from pyspv.wallet import Wallet
+
+from stubs import StubSPV
+
+# From the BIP32 test vectors: m/0H, m/0H/1, m/0H/1/2H and m/0H/1/2H/2 of test vector 1
+XPUB_0H = 'xpub68Gmy5EdvgibQVfPdqkBBCHxA5htiqg55crXYuXoQRKfDBFA1WEjWgP6LHhwBZeNK1VTsfTFUHCdrfp1bgwQ9xv5ski8PX9rL2dZXvgGDnw'
+XPUB_0H_1 = 'xpub6ASuArnXKPbfEwhqN6e3mwBcDTgzisQN1wXN9BJcM47sSikHjJf3UFHKkNAWbWMiGj7Wf5uMash7SyYq527Hqck2AxYysAA7xmALppuCkwQ'
+XPUB_0H_1_2H = 'xpub6D4BDPcP2GT577Vvch3R8wDkScZWzQzMMUm3PWbmWvVJrZwQY4VUNgqFJPMM3No2dFDFGTsxxpG5uJh7n7epu4trkrX7x7DogT5Uv6fcLW5'
+XPUB_0H_1_2H_2 = 'xpub6FHa3pjLCk84BayeJxFW2SP4XRrFd1JYnxeLeU8EqN3vDfZmbqBqaGJAyiLjTAwm6ZLRQUMv1ZACTj37sR62cfN7fe5JnJ7dh8zL4fiyLHV'
+
+class TestExtendedPublicKey(unittest.TestCase):
+    def test_serialize(self):
+        xpub = ExtendedPublicKey.from_string(XPUB_0H_1, Bitcoin)
+        self.assertEqual(xpub.depth, 2)
+        self.assertEqual(xpub.child_number, 1)
+        self.assertEqual(xpub.as_string(Bitcoin), XPUB_0H_1)
+        self.assertEqual(ExtendedPublicKey.from_string(XPUB_0H_1, Bitcoin), xpub)
+
+        with self.assertRaises(InvalidExtendedKey):
+            ExtendedPublicKey.from_string(XPUB_0H_1[:-1] + ('1' if XPUB_0H_1[-1] != '1' else '2'), Bitcoin)
+
+    def test_derive(self):
+        xpub = ExtendedPublicKey.from_string(XPUB_0H, Bitcoin)
+        self.assertEqual(xpub.derive_child(1, Bitcoin).as_string(Bitcoin), XPUB_0H_1)
+
+        xpub = ExtendedPublicKey.from_string(XPUB_0H_1_2H, Bitcoin)
+        self.assertEqual(xpub.derive_child(2, Bitcoin).as_string(Bitcoin), XPUB_0H_1_2H_2)
+        self.assertEqual([i for i, _ in xpub.derive_public_keys(0, 3)], [0, 1, 2])
+        self.assertEqual(xpub.derive_public_keys(0, 3)[2][1], xpub.derive_child(2, Bitcoin).public_key)
+
+        with self.assertRaises(InvalidChildIndex):
+            xpub.derive_child(ExtendedPublicKey.HARDENED, Bitcoin)
+
+class TestExtendedPublicKeyPaymentMonitor(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+        self.xpub = ExtendedPublicKey.from_string(XPUB_0H_1_2H, Bitcoin)
+
+    def tearDown(self):
+        self.spv.wallet.walletdb.close()
+        shutil.rmtree(self.path)
+
+    def load_wallet(self):
+        self.spv.wallet = Wallet(self.spv, monitors=[ExtendedPublicKeyPaymentMonitor])
+        self.spv.wallet.load()
+        return self.spv.wallet
+
+    def pay(self, i, amount):
+        public_key, _ = self.xpub.derive_child_public_key(i)
+        script = Script(bytes([OP_DUP, OP_HASH160, 20]) + public_key.as_hash160(Bitcoin) + bytes([OP_EQUALVERIFY, OP_CHECKSIG]))
+        prevout = TransactionPrevOut(os.urandom(32), 0)
+        tx = Transaction(Bitcoin, inputs=[TransactionInput(prevout=prevout, script=Script())], outputs=[TransactionOutput(amount=amount, script=script)])
+        self.spv.wallet.on_tx(tx)
+        return tx
+
+    def test_monitor(self):
+        wallet = self.load_wallet()
+        monitor = wallet.monitors[0]
+        wallet.add('xpub', self.xpub, {'label': 'cold storage', 'used_index': -1})
+        self.assertEqual(len(monitor.pubkey_hash_addresses), ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+        filter_scripts = wallet.get_filter_scripts()
+        self.assertEqual(len(filter_scripts), 2 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+        self.assertIs(wallet.get_filter_scripts(), filter_scripts)
+
+        # A payment to the last child in the lookahead extends it
+        self.pay(ExtendedPublicKeyPaymentMonitor.GAP_LIMIT - 1, 5000)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 5000)
+        self.assertEqual(wallet.get('xpub', self.xpub)['used_index'], ExtendedPublicKeyPaymentMonitor.GAP_LIMIT - 1)
+        self.assertEqual(len(monitor.pubkey_hash_addresses), 2 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+        self.assertEqual(len(wallet.get_filter_scripts()), 4 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+
+        # Children past the lookahead aren't watched
+        self.pay(3 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT, 1000)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 5000)
+
+        # Spending the coin is noticed through its prevout
+        spend = next(wallet.get_spends())
+        self.assertIsInstance(spend, ExtendedPublicKeySpend)
+        spending_tx = Transaction(Bitcoin, inputs=[TransactionInput(prevout=spend.prevout, script=Script())], outputs=[])
+        wallet.on_tx(spending_tx)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 0)
+
+        # Only GAP_LIMIT children on either side of the highest used child are derived after loading
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        monitor = wallet.monitors[0]
+        self.assertEqual(wallet.len('xpub'), 1)
+        self.assertEqual(len(monitor.pubkey_hash_addresses), 2 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT)
+        self.pay(2 * ExtendedPublicKeyPaymentMonitor.GAP_LIMIT - 1, 2000)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 2000)
+
+    def test_watch_only(self):
+        wallet = self.load_wallet()
+        wallet.add('xpub', self.xpub, {'label': 'cold storage', 'used_index': -1})
+        self.spv.txdb.get_tx_depth = lambda tx_hash: 100
+        self.spv.txdb.get_tx_height = lambda tx_hash: 1
+        self.pay(3, 5000)
+
+        # Confirmed, but never spendable or selected, and the pubkey monitor doesn't take it for one of its own
+        spend = next(wallet.get_spends())
+        self.assertNotIsInstance(spend, PubKeySpend)
+        self.assertEqual(wallet.get_spend_state(spend.hash()), ('mature', 100, False))
+        self.assertEqual(wallet.select_spends([ExtendedPublicKeyPaymentMonitor.CATEGORY], 1000), [])
+        self.assertEqual(spend.get_signing_keys(), [])
+        with self.assertRaises(Exception):
+            spend.create_input_creators(self.spv, 1)
+
+        # Loaded the same way it was saved
+        loaded, data = ExtendedPublicKeySpend.unserialize(spend.serialize(), Bitcoin)
+        self.assertEqual(data, b'')
+        self.assertEqual(loaded, spend)
+        self.assertEqual((loaded.amount, loaded.address, loaded.address_info), (5000, spend.address, spend.address_info))
+
+    def test_out_of_order_payment_after_restart(self):
+        wallet = self.load_wallet()
+        wallet.add('xpub', self.xpub, {'label': 'cold storage', 'used_index': -1})
+
+        # Child 10 is paid before child 5, which was handed out first, and pyspv restarts in between
+        self.pay(10, 5000)
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        self.assertEqual(wallet.get('xpub', self.xpub)['used_index'], 10)
+
+        self.pay(5, 1000)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 6000)
+        self.assertEqual(wallet.get('xpub', self.xpub)['used_index'], 10)
+
+        # Children more than GAP_LIMIT below the highest used one aren't watched after a restart
+        self.pay(30, 2000)
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        self.pay(30 - ExtendedPublicKeyPaymentMonitor.GAP_LIMIT, 100)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 8000)
+        self.pay(31 - ExtendedPublicKeyPaymentMonitor.GAP_LIMIT, 100)
+        self.assertEqual(wallet.balance[ExtendedPublicKeyPaymentMonitor.CATEGORY], 8100)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv.blockchain import Blockchain, BlockLocator
+from pyspv.network import Manager
+
+from stubs import StubHeader, StubSPV
+
+class TestMainChainIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blockchain = Blockchain(StubSPV(self.path))
+        self.start = self.blockchain.best_chain
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def extend(self, block_link, count):
+        # Headers aren't validated here, only linked up the way add_block_headers would
+        links = []
+        for _ in range(count):
+            block_hash = os.urandom(32)
+            block_link = self.blockchain.create_block_link(block_hash, height=block_link['height'] + 1, main=True, connected=True, prev=block_link, header=StubHeader(block_hash))
+            self.blockchain.blocks[block_hash] = block_link
+            links.append(block_link)
+        return links
+
+    def set_best_chain(self, block_link):
+        self.blockchain.best_chain = block_link
+        self.blockchain._Blockchain__index_main_chain()
+
+    def test_get_headers_after(self):
+        links = self.extend(self.start, 50)
+        self.set_best_chain(links[-1])
+
+        # The locator of a block on our chain gets everything after it
+        headers = self.blockchain.get_headers_after(BlockLocator(links[9]).hashes, b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(headers, [link['header'] for link in links[10:]])
+
+        # Up to date, nothing to send
+        self.assertEqual(self.blockchain.get_headers_after(self.blockchain.get_best_chain_locator().hashes, b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE), [])
+
+        # Unknown hashes are skipped, and nothing is sent if none are known
+        self.assertEqual(self.blockchain.get_headers_after([os.urandom(32), links[39]['hash']], b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE), [link['header'] for link in links[40:]])
+        self.assertEqual(self.blockchain.get_headers_after([os.urandom(32)], b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE), [])
+
+        # Ends at the stop hash, which is included, or after max_count headers
+        self.assertEqual(self.blockchain.get_headers_after([self.start['hash']], links[4]['hash'], Manager.MAX_HEADERS_PER_MESSAGE), [link['header'] for link in links[:5]])
+        self.assertEqual(self.blockchain.get_headers_after([self.start['hash']], b'\x00' * 32, 7), [link['header'] for link in links[:7]])
+
+    def test_header_cap(self):
+        links = self.extend(self.start, Manager.MAX_HEADERS_PER_MESSAGE + 10)
+        self.set_best_chain(links[-1])
+
+        headers = self.blockchain.get_headers_after([self.start['hash']], b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(len(headers), Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(headers[-1], links[Manager.MAX_HEADERS_PER_MESSAGE - 1]['header'])
+
+        # The next batch picks up from the last header sent
+        headers = self.blockchain.get_headers_after([headers[-1].hash()], b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(headers, [link['header'] for link in links[Manager.MAX_HEADERS_PER_MESSAGE:]])
+
+    def test_reorg(self):
+        links = self.extend(self.start, 20)
+        self.set_best_chain(links[-1])
+
+        # A longer fork from height start + 10 becomes the main chain
+        for link in links[10:]:
+            link['main'] = False
+        fork = self.extend(links[9], 15)
+        self.set_best_chain(fork[-1])
+        self.assertEqual(self.blockchain.main_chain_height, self.start['height'] + 25)
+
+        # A peer still on the old chain is sent the new chain from the last locator hash on ours.  The locator skips
+        # the fork point itself, so one header the peer already has comes along.
+        headers = self.blockchain.get_headers_after(BlockLocator(links[-1]).hashes, b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(headers, [link['header'] for link in [links[9]] + fork])
+        headers = self.blockchain.get_headers_after([links[-1]['hash'], links[9]['hash']], b'\x00' * 32, Manager.MAX_HEADERS_PER_MESSAGE)
+        self.assertEqual(headers, [link['header'] for link in fork])
+
+        self.assertEqual(self.blockchain.get_main_chain_hashes(self.start['height'] + 9, self.start['height'] + 12), [links[8]['hash'], links[9]['hash'], fork[0]['hash'], fork[1]['hash']])
+
+        # Back to a shorter chain, the heights above it are forgotten
+        self.set_best_chain(links[-1])
+        self.assertIsNone(self.blockchain.get_main_chain_hashes(self.start['height'] + 19, self.start['height'] + 21))
+        self.assertEqual(self.blockchain.get_main_chain_hashes(self.start['height'] + 20, self.start['height'] + 20), [links[-1]['hash']])
+
+    def test_get_main_chain_hashes(self):
+        links = self.extend(self.start, 5)
+        self.set_best_chain(links[-1])
+
+        self.assertEqual(self.blockchain.get_main_chain_hashes(self.start['height'], self.start['height'] + 5), [self.start['hash']] + [link['hash'] for link in links])
+        self.assertEqual(self.blockchain.get_main_chain_hashes(self.start['height'] + 2, self.start['height'] + 1), [])
+
+        # Not all in memory
+        self.assertIsNone(self.blockchain.get_main_chain_hashes(self.start['height'] - 1, self.start['height'] + 1))
+        self.assertIsNone(self.blockchain.get_main_chain_hashes(self.start['height'] + 5, self.start['height'] + 6))
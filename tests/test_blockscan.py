@@ -0,0 +1,88 @@
+import os
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.block import BadSerializedBlock, Block, BlockHeader
+from pyspv.blockscan import BlockScanner, match_raw_transaction
+from pyspv.script import *
+from pyspv.transaction import Transaction, TransactionInput, TransactionOutput, TransactionPrevOut
+
+def p2pkh_output(hash160):
+    return TransactionOutput(amount=1, script=Script(bytes([OP_DUP, OP_HASH160, 20]) + hash160 + bytes([OP_EQUALVERIFY, OP_CHECKSIG])))
+
+def pubkey_spend_input(public_key, prevout=None):
+    script = Script()
+    script.push_bytes(b'\x30' * 71)
+    script.push_bytes(public_key)
+    return TransactionInput(prevout=TransactionPrevOut(os.urandom(32), 0) if prevout is None else prevout, script=script)
+
+class TestBlockScanner(unittest.TestCase):
+    def setUp(self):
+        self.hash160 = os.urandom(20)
+        self.public_key = b'\x02' + os.urandom(32)
+        self.prevout = TransactionPrevOut(os.urandom(32), 3)
+
+        self.scan_keys = [{TEMPLATE_P2PKH: set([self.hash160])}, {TEMPLATE_PUBKEY_SPEND: set([self.public_key])}]
+        self.prevouts = set([self.prevout.serialize()])
+
+        # Transactions that match are at 7 (output), 150 (input script) and 300 (prevout)
+        self.transactions = []
+        for i in range(400):
+            inputs = [pubkey_spend_input(b'\x03' + os.urandom(32)) for _ in range(2)]
+            outputs = [p2pkh_output(os.urandom(20)) for _ in range(2)]
+            if i == 7:
+                outputs.append(p2pkh_output(self.hash160))
+            elif i == 150:
+                inputs.append(pubkey_spend_input(self.public_key))
+            elif i == 300:
+                inputs.append(pubkey_spend_input(b'\x03' + os.urandom(32), prevout=self.prevout))
+            self.transactions.append(Transaction(Bitcoin, inputs=inputs, outputs=outputs))
+
+    def test_match_raw_transaction(self):
+        scan_keys = {TEMPLATE_P2PKH: set([self.hash160]), TEMPLATE_STEALTH_EPHEMERAL: None}
+        self.assertTrue(match_raw_transaction(self.transactions[7].serialize(), scan_keys, set()))
+        self.assertFalse(match_raw_transaction(self.transactions[8].serialize(), scan_keys, set()))
+
+        # A template mapped to None matches every script of that template
+        tx = Transaction(Bitcoin, outputs=[TransactionOutput(amount=0, script=Script(bytes([OP_RETURN, 33]) + self.public_key))])
+        self.assertTrue(match_raw_transaction(tx.serialize(), scan_keys, set()))
+
+    def test_raw_transactions(self):
+        block = Block(Bitcoin, header=BlockHeader(Bitcoin), transactions=self.transactions[:10])
+        data = block.serialize()
+        block, remaining = Block.unserialize(data + b'extra', Bitcoin)
+        self.assertEqual(remaining, b'extra')
+        self.assertEqual(block.raw_transactions, [tx.serialize() for tx in self.transactions[:10]])
+        self.assertEqual(block.get_transaction_hashes(), [tx.hash() for tx in self.transactions[:10]])
+
+        # Transactions are only unserialized when they're asked for
+        self.assertEqual(block.get_transaction(7).outputs[2].script.program, self.transactions[7].outputs[2].script.program)
+        self.assertEqual(block.serialize(), data)
+        self.assertEqual(block.serialize_size(), len(data))
+        self.assertEqual([tx.hash() for tx in block.transactions], block.get_transaction_hashes())
+
+        with self.assertRaises(BadSerializedBlock):
+            Block.unserialize(data[:-1], Bitcoin)
+
+    def test_scan(self):
+        scanner = BlockScanner(processes=1)
+        scanner.update_scan_keys(self.scan_keys)
+        raw_transactions = [tx.serialize() for tx in self.transactions]
+        self.assertEqual(scanner.scan(raw_transactions, self.prevouts), [7, 150, 300])
+        self.assertEqual(scanner.scan(raw_transactions, set()), [7, 150])
+
+    def test_parallel_scan(self):
+        scanner = BlockScanner(processes=2)
+        try:
+            scanner.update_scan_keys(self.scan_keys)
+            raw_transactions = [tx.serialize() for tx in self.transactions]
+            self.assertEqual(scanner.scan(raw_transactions, self.prevouts), [7, 150, 300])
+
+            # New keys restart the workers
+            new_hash160 = os.urandom(20)
+            raw_transactions.append(Transaction(Bitcoin, outputs=[p2pkh_output(new_hash160)]).serialize())
+            self.scan_keys[0][TEMPLATE_P2PKH].add(new_hash160)
+            scanner.update_scan_keys(self.scan_keys)
+            self.assertEqual(scanner.scan(raw_transactions, self.prevouts), [7, 150, 300, 400])
+        finally:
+            scanner.close()
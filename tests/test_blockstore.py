@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.block import Block, BlockHeader
+from pyspv.blockstore import BlockStore
+from pyspv.script import Script
+from pyspv.transaction import Transaction, TransactionOutput
+
+from stubs import StubSPV
+
+def make_blocks(count, prev_block_hash=b'\x00' * 32, timestamp=0):
+    blocks = []
+    for i in range(count):
+        header = BlockHeader(Bitcoin, prev_block_hash=prev_block_hash, timestamp=timestamp + i * 600, nonce=int.from_bytes(os.urandom(4), 'little'))
+        outputs = [TransactionOutput(amount=1, script=Script(os.urandom(25))) for _ in range(20)]
+        blocks.append(Block(Bitcoin, header=header, transactions=[Transaction(Bitcoin, outputs=outputs)]))
+        prev_block_hash = header.hash()
+    return blocks
+
+class TestBlockStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+        self.blocks = make_blocks(50)
+
+        # Small segments so the tests cover more than one
+        self.segment_size = BlockStore.SEGMENT_SIZE
+        BlockStore.SEGMENT_SIZE = len(self.blocks[0].serialize()) * 10
+
+    def tearDown(self):
+        BlockStore.SEGMENT_SIZE = self.segment_size
+        shutil.rmtree(self.path)
+
+    def add_blocks(self, blockstore, blocks, start_height):
+        for i, block in enumerate(blocks):
+            blockstore.on_block(block)
+            blockstore.on_block_added(block.header, start_height + i)
+
+    def test_blocks(self):
+        blockstore = BlockStore(self.spv)
+        self.add_blocks(blockstore, self.blocks, 100)
+        self.assertEqual(blockstore.get_height_range(), (100, 150))
+
+        for i, block in enumerate(self.blocks):
+            self.assertEqual(blockstore.get_block_data(block.header.hash()), block.serialize())
+            self.assertEqual(blockstore.get_block_data_at_height(100 + i), block.serialize())
+
+        self.assertIsNone(blockstore.get_block_data(os.urandom(32)))
+        self.assertIsNone(blockstore.get_block_data_at_height(99))
+        self.assertIsNone(blockstore.get_block_data_at_height(150))
+        self.assertEqual(blockstore.get_block(self.blocks[5].header.hash()).get_transaction_hashes(), self.blocks[5].get_transaction_hashes())
+
+        # Headers without a block, and a block that doesn't follow the last one
+        blockstore.on_block_added(make_blocks(1)[0].header, 150)
+        self.assertEqual(blockstore.get_height_range(), (100, 150))
+        self.add_blocks(blockstore, make_blocks(1), 200)
+        self.assertEqual(blockstore.get_height_range(), (200, 201))
+
+    def test_reorg_and_reload(self):
+        blockstore = BlockStore(self.spv)
+        self.add_blocks(blockstore, self.blocks, 100)
+
+        # Read from the last segment so it's mapped while it's truncated
+        self.assertIsNotNone(blockstore.get_block_data(self.blocks[45].header.hash()))
+
+        for height in range(149, 124, -1):
+            blockstore.on_block_removed(self.blocks[height - 100].header, height)
+
+        side_blocks = make_blocks(3, self.blocks[24].header.hash())
+        self.add_blocks(blockstore, side_blocks, 125)
+        self.assertIsNone(blockstore.get_block_data(self.blocks[25].header.hash()))
+        blockstore.close()
+
+        blockstore = BlockStore(self.spv)
+        self.assertEqual(blockstore.get_height_range(), (100, 128))
+        for i, block in enumerate(self.blocks[:25] + side_blocks):
+            self.assertEqual(blockstore.get_block_data_at_height(100 + i), block.serialize())
+
+    def test_prune(self):
+        blockstore = BlockStore(self.spv, max_depth=15)
+        self.add_blocks(blockstore, self.blocks, 100)
+
+        # Whole segments of 10 blocks are pruned
+        start_height, next_height = blockstore.get_height_range()
+        self.assertEqual(next_height, 150)
+        self.assertTrue(135 - 10 < start_height <= 135)
+        self.assertIsNone(blockstore.get_block_data(self.blocks[0].header.hash()))
+        self.assertEqual(blockstore.get_block_data_at_height(start_height), self.blocks[start_height - 100].serialize())
+        blockstore.close()
+
+        blockstore = BlockStore(self.spv, max_size=BlockStore.SEGMENT_SIZE * 2)
+        self.assertEqual(blockstore.get_height_range(), (start_height, 150))
+        self.add_blocks(blockstore, make_blocks(20, self.blocks[-1].header.hash()), 150)
+        start_height, next_height = blockstore.get_height_range()
+        self.assertEqual(next_height, 170)
+        self.assertTrue(next_height - start_height <= 30)
+
+    def test_height_at_time(self):
+        blockstore = BlockStore(self.spv)
+        self.assertIsNone(blockstore.get_height_at_time(0))
+
+        self.add_blocks(blockstore, make_blocks(50, timestamp=100000), 100)
+        self.assertIsNone(blockstore.get_height_at_time(100000))
+        self.assertEqual(blockstore.get_height_at_time(100001), 101)
+        self.assertEqual(blockstore.get_height_at_time(100000 + 20 * 600), 120)
+        self.assertEqual(blockstore.get_height_at_time(100000 + 20 * 600 + 1), 121)
+        self.assertEqual(blockstore.get_height_at_time(200000), 150)
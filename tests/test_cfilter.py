@@ -0,0 +1,418 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv import Bitcoin, cfilter
+from pyspv.block import Block, BlockHeader
+from pyspv.cfilter import FilterQuery, GCSFilter, InvalidFilter, basic_filter_items, filter_header, local_filter_items, siphash
+from pyspv.filterdb import FilterDatabase
+from pyspv.network import Manager
+from pyspv.script import Script, OP_CHECKSIG, OP_DUP, OP_EQUALVERIFY, OP_HASH160, OP_RETURN
+from pyspv.transaction import Transaction, TransactionInput, TransactionOutput, TransactionPrevOut
+
+from stubs import StubSPV
+
+def p2pkh_script():
+    # Random scripts that start with 0x6a look like OP_RETURN outputs, which filters leave out
+    return bytes([OP_DUP, OP_HASH160, 20]) + os.urandom(20) + bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+
+# From BIP158 test vectors: testnet genesis block
+GENESIS_FILTER = bytes.fromhex('019dfca8')
+GENESIS_FILTER_HEADER = '21584579b7eb08997773e5aeff3a7f932700042d0ed2a6129012b7d7ae81b750'
+GENESIS_COINBASE_SCRIPT = bytes.fromhex('4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac')
+
+class TestSipHash(unittest.TestCase):
+    def test_vectors(self):
+        # From the SipHash paper (key 00 01 02 ... 0f, messages 00 01 02 ...)
+        k0 = int.from_bytes(bytes(range(0, 8)), 'little')
+        k1 = int.from_bytes(bytes(range(8, 16)), 'little')
+        self.assertEqual(siphash(k0, k1, b''), 0x726fdb47dd0e0e31)
+        self.assertEqual(siphash(k0, k1, bytes(range(1))), 0x74f839c593dc67fd)
+        self.assertEqual(siphash(k0, k1, bytes(range(8))), 0x93f5f5799a932462)
+        self.assertEqual(siphash(k0, k1, bytes(range(15))), 0xa129ca6149be45e5)
+
+    def test_query_hashes_match_siphash(self):
+        items = [os.urandom(n) for n in (0, 7, 8, 20, 23, 25, 25, 35, 67)]
+        query = FilterQuery(items)
+        self.assertEqual(sorted(query.hashes(123, 456)), sorted(siphash(123, 456, item) for item in query.items))
+
+class TestGCSFilter(unittest.TestCase):
+    def test_genesis_vector(self):
+        block_hash = Bitcoin.Testnet.GENESIS_BLOCK_HASH
+        self.assertEqual(GCSFilter.build([GENESIS_COINBASE_SCRIPT], block_hash).serialize(), GENESIS_FILTER)
+
+        gcs = GCSFilter.unserialize(GENESIS_FILTER, block_hash)
+        self.assertTrue(gcs.match_any([GENESIS_COINBASE_SCRIPT]))
+        self.assertFalse(gcs.match_any([b'not in the filter']))
+
+        self.assertEqual(filter_header(Bitcoin, GENESIS_FILTER, b'\x00' * 32), bytes.fromhex(GENESIS_FILTER_HEADER)[::-1])
+
+    def test_round_trip(self):
+        block_hash = os.urandom(32)
+        items = [os.urandom(25) for _ in range(500)]
+        gcs = GCSFilter.unserialize(GCSFilter.build(items, block_hash).serialize(), block_hash)
+
+        self.assertEqual(gcs.n, 500)
+        self.assertEqual(list(gcs.decode()), sorted(gcs.hash_to_range(item) for item in items))
+        self.assertTrue(all(gcs.match_any([item]) for item in items[::50]))
+        self.assertFalse(gcs.match_any([os.urandom(25) for _ in range(10)]))
+
+    def test_empty_filter(self):
+        gcs = GCSFilter.build([], os.urandom(32))
+        self.assertEqual(gcs.serialize(), b'\x00')
+        self.assertFalse(gcs.match_any([b'anything']))
+
+    def test_basic_filter_items(self):
+        scripts = [p2pkh_script() for _ in range(3)]
+        outputs = [TransactionOutput(amount=1, script=Script(script)) for script in scripts]
+        outputs.append(TransactionOutput(amount=0, script=Script(bytes([OP_RETURN]) + os.urandom(20))))
+        outputs.append(TransactionOutput(amount=0, script=Script()))
+        block = Block(Bitcoin, transactions=[Transaction(Bitcoin, outputs=outputs), Transaction(Bitcoin, outputs=outputs[:1])])
+        self.assertEqual(basic_filter_items(block), set(scripts))
+
+    def test_local_filter_items(self):
+        script = p2pkh_script()
+        prevout = TransactionPrevOut(os.urandom(32), 1)
+        coinbase = Transaction(Bitcoin, inputs=[TransactionInput(prevout=TransactionPrevOut(b'\x00' * 32, 0xffffffff), script=Script())], outputs=[TransactionOutput(amount=1, script=Script(script))])
+        spending_tx = Transaction(Bitcoin, inputs=[TransactionInput(prevout=prevout, script=Script())], outputs=[])
+        block = Block(Bitcoin, transactions=[coinbase, spending_tx])
+        self.assertEqual(local_filter_items(block), set([script, prevout.serialize()]))
+
+    def test_truncated_filter(self):
+        block_hash = os.urandom(32)
+        data = GCSFilter.build([os.urandom(25) for _ in range(100)], block_hash).serialize()
+        gcs = GCSFilter.unserialize(data[:len(data) // 2], block_hash)
+        with self.assertRaises(InvalidFilter):
+            list(gcs.decode())
+
+    def test_without_numpy(self):
+        block_hash = os.urandom(32)
+        items = [os.urandom(25) for _ in range(500)]
+        gcs = GCSFilter.build(items, block_hash)
+        others = [os.urandom(25) for _ in range(10)]
+        truncated = GCSFilter.unserialize(gcs.serialize()[:len(gcs.serialize()) // 2], block_hash)
+
+        numpy = cfilter.numpy
+        results = []
+        try:
+            for cfilter.numpy in (numpy, None):
+                results.append((list(gcs.decode()), gcs.match_any(items[:1]), gcs.match_any(items[-1:]), gcs.match_any(others)))
+                with self.assertRaises(InvalidFilter):
+                    list(truncated.decode())
+                with self.assertRaises(InvalidFilter):
+                    truncated.match_any([max(items, key=gcs.hash_to_range)])
+        finally:
+            cfilter.numpy = numpy
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1], (sorted(gcs.hash_to_range(item) for item in items), True, True, False))
+
+################################################################################
+
+class StubBlockchain:
+    def __init__(self, block_hashes, filter_start_height):
+        self.block_hashes = block_hashes
+        self.blocks = set(block_hashes)
+        self.filter_start_height = filter_start_height
+
+    def get_best_chain_height(self):
+        return len(self.block_hashes) - 1
+
+    def get_filter_start_height(self):
+        return self.filter_start_height
+
+    def get_main_chain_hashes(self, start_height, stop_height):
+        return self.block_hashes[start_height:stop_height+1]
+
+class StandInPeer:
+    '''Serves precomputed filters the way a BIP157 peer would, by calling into the Manager directly'''
+    def __init__(self, filters, previous_filter_header=b'\x00' * 32, filter_type=GCSFilter.BASIC_FILTER_TYPE, peer_address=('127.0.0.1', 18333)):
+        self.filters = filters
+        self.previous_filter_header = previous_filter_header
+        self.filter_type = filter_type
+        self.peer_address = peer_address
+        self.peer_services = Manager.NODE_LOCAL_FILTERS if filter_type == GCSFilter.LOCAL_FILTER_TYPE else Manager.NODE_COMPACT_FILTERS
+        self.filter_request = None
+
+    def is_ready(self):
+        return True
+
+    def request_timeout(self, expected_size, max_timeout):
+        return max_timeout
+
+    def missed_deadline(self):
+        pass
+
+    def filter_headers(self, start_height):
+        previous_filter_header = self.previous_filter_header
+        for block_hash, data in self.filters[:start_height]:
+            previous_filter_header = filter_header(Bitcoin, data, previous_filter_header)
+        return previous_filter_header
+
+    def serve(self, manager, scripts, prevouts=()):
+        '''Answers the manager's next request.  Returns False when there's nothing left to do.'''
+        request = manager.will_request_filters(self, self.filter_type)
+        if request is None:
+            return False
+
+        self.filter_request = request
+        start_height = request['start_height']
+        count = len(request['block_hashes'])
+
+        if request['command'] == 'getcfheaders':
+            filter_hashes = [Bitcoin.hash(data) for _, data in self.filters[start_height:start_height+count]]
+            self.accepted = manager.received_cfheaders(self, self.filter_type, request['block_hashes'][-1], self.filter_headers(start_height), filter_hashes)
+        else:
+            for block_hash, data in self.filters[start_height:start_height+count]:
+                self.accepted = manager.received_cfilter(self, self.filter_type, block_hash, data, scripts, prevouts)
+                if not self.accepted:
+                    break
+
+        return self.accepted
+
+def serve_all(manager, peers, scripts, prevouts=()):
+    # Filter headers are only used once two peers agree on them, so take turns until nobody has anything left to do
+    while any([peer.serve(manager, scripts, prevouts) for peer in peers]):
+        pass
+
+def build_unmatched_filter(items, unmatched):
+    # A filter for a random block hash that doesn't falsely match any of unmatched, so tests see no false positives
+    while True:
+        block_hash = os.urandom(32)
+        gcs = GCSFilter.build(items, block_hash)
+        if any(item in items for item in unmatched) or not gcs.match_any(unmatched):
+            return block_hash, gcs.serialize()
+
+class TestFilterSync(unittest.TestCase):
+    BLOCK_COUNT = 2500
+
+    @classmethod
+    def setUpClass(cls):
+        cls.wallet_script = os.urandom(25)
+        cls.matching_heights = set([40, 1234, 2100, 2499])
+
+        cls.filters = []
+        for height in range(cls.BLOCK_COUNT):
+            items = [os.urandom(25) for _ in range(10)]
+            if height in cls.matching_heights:
+                items.append(cls.wallet_script)
+            cls.filters.append(build_unmatched_filter(items, [cls.wallet_script]))
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blockchain = StubBlockchain([block_hash for block_hash, _ in self.filters], 10)
+        self.manager = Manager(spv=StubSPV(self.path, self.blockchain), compact_filters=True)
+        self.peers = [StandInPeer(self.filters), StandInPeer(self.filters, peer_address=('127.0.0.2', 18333))]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sync_matches_wallet_blocks(self):
+        serve_all(self.manager, self.peers, [self.wallet_script])
+
+        self.assertEqual(self.manager.filter_height, self.BLOCK_COUNT)
+        self.assertEqual(set(self.manager.take_matched_blocks()), set(self.filters[h][0] for h in self.matching_heights))
+
+        # Already handed out, so they aren't returned again until the retry time is up
+        self.assertEqual(self.manager.take_matched_blocks(), [])
+
+    def test_progress_is_saved(self):
+        serve_all(self.manager, self.peers, [self.wallet_script])
+
+        manager = Manager(spv=StubSPV(self.path, self.blockchain), compact_filters=True)
+        self.assertEqual(manager.filter_height, self.BLOCK_COUNT)
+        self.assertEqual(len(manager.take_matched_blocks()), len(self.matching_heights))
+
+    def test_bad_filter_is_rejected(self):
+        # Filter headers come from honest peers
+        for peer in self.peers:
+            self.assertTrue(peer.serve(self.manager, [self.wallet_script]))
+
+        filters = list(self.filters)
+        block_hash, _ = filters[20]
+        filters[20] = (block_hash, GCSFilter.build([self.wallet_script], block_hash).serialize())
+
+        # But the filters come from one that lies about block 20, which doesn't match its filter header
+        peer = StandInPeer(filters, peer_address=('127.0.0.3', 18333))
+        while peer.serve(self.manager, [self.wallet_script]):
+            pass
+
+        self.assertFalse(peer.accepted)
+        self.assertEqual(self.manager.filter_height, 20)
+        self.assertEqual(self.manager.take_matched_blocks(), [])
+
+    def test_filter_headers_must_connect(self):
+        for peer in self.peers:
+            self.assertTrue(peer.serve(self.manager, [self.wallet_script]))
+
+        # Another peer with a different filter header history can't continue our chain
+        other_peer = StandInPeer(self.filters, previous_filter_header=os.urandom(32), peer_address=('127.0.0.3', 18333))
+        while self.manager.filter_height < 10 + Manager.MAX_CFHEADERS_PER_REQUEST:
+            self.assertTrue(self.peers[0].serve(self.manager, [self.wallet_script]))
+
+        self.assertFalse(other_peer.serve(self.manager, [self.wallet_script]))
+
+    def test_filter_headers_need_agreement(self):
+        # A peer that makes up its own filters has to get another peer to agree with it
+        filters = list(self.filters)
+        block_hash, _ = filters[20]
+        filters[20] = (block_hash, GCSFilter.build([self.wallet_script], block_hash).serialize())
+        liar = StandInPeer(filters, peer_address=('127.0.0.3', 18333))
+        self.assertTrue(self.manager.add_peer_address(liar.peer_address))
+
+        self.assertTrue(liar.serve(self.manager, [self.wallet_script]))
+        self.assertFalse(liar.serve(self.manager, [self.wallet_script]))
+        self.assertEqual(self.manager.filter_hashes, {})
+
+        # An honest peer disagrees, so nothing is used until a third peer settles it
+        self.assertTrue(self.peers[0].serve(self.manager, [self.wallet_script]))
+        self.assertEqual(self.manager.filter_hashes, {})
+        self.assertTrue(self.peers[1].serve(self.manager, [self.wallet_script]))
+        self.assertEqual(self.manager.filter_hashes[20], Bitcoin.hash(self.filters[20][1]))
+        self.assertNotIn(liar.peer_address, self.manager.peer_addresses)
+
+        serve_all(self.manager, self.peers, [self.wallet_script])
+        self.assertEqual(self.manager.filter_height, self.BLOCK_COUNT)
+
+    def test_filter_type(self):
+        local_peer = StandInPeer(self.filters, filter_type=GCSFilter.LOCAL_FILTER_TYPE, peer_address=('10.0.0.2', 8333))
+        self.assertIsNone(self.manager.get_filter_type(local_peer))
+        local_peer.peer_services |= Manager.NODE_COMPACT_FILTERS
+        self.assertEqual(self.manager.get_filter_type(local_peer), GCSFilter.BASIC_FILTER_TYPE)
+
+        # Our own filters are only asked of static peers
+        self.manager.static_peers.append(local_peer.peer_address)
+        self.assertEqual(self.manager.get_filter_type(local_peer), GCSFilter.LOCAL_FILTER_TYPE)
+
+    def test_filter_type_switch(self):
+        local_peer = StandInPeer(self.filters, filter_type=GCSFilter.LOCAL_FILTER_TYPE, peer_address=('10.0.0.2', 8333))
+        self.manager.static_peers.append(local_peer.peer_address)
+        self.manager.peers = {peer.peer_address: peer for peer in self.peers + [local_peer]}
+
+        # Not in the middle of a batch of the other type
+        for peer in self.peers:
+            self.assertTrue(peer.serve(self.manager, [self.wallet_script]))
+        self.assertIsNone(self.manager.will_request_filters(local_peer, GCSFilter.LOCAL_FILTER_TYPE))
+
+        # Unless the peers serving it are gone.  The local peer's filter headers start a new chain, and are used
+        # without a second peer since static peers are trusted.
+        for peer in self.peers:
+            self.manager.peers.pop(peer.peer_address)
+        while local_peer.serve(self.manager, [self.wallet_script]):
+            pass
+        self.assertTrue(local_peer.accepted)
+        self.assertEqual(self.manager.filter_type, GCSFilter.LOCAL_FILTER_TYPE)
+        self.assertEqual(self.manager.filter_height, self.BLOCK_COUNT)
+
+        # The filter type is saved with the progress
+        manager = Manager(spv=StubSPV(self.path, self.blockchain), compact_filters=True)
+        self.assertEqual(manager.filter_type, GCSFilter.LOCAL_FILTER_TYPE)
+
+    def test_local_filters_match_prevouts(self):
+        # A prevout that none of the shared filters falsely match
+        while True:
+            prevout = TransactionPrevOut(os.urandom(32), 0).serialize()
+            query = FilterQuery([prevout])
+            if not any(query.matches(GCSFilter.unserialize(data, block_hash)) for block_hash, data in self.filters):
+                break
+
+        filters = list(self.filters)
+        for height in (50, 60):
+            block_hash, _ = filters[height]
+            filters[height] = (block_hash, GCSFilter.build([os.urandom(25), prevout], block_hash).serialize())
+
+        local_peer = StandInPeer(filters, filter_type=GCSFilter.LOCAL_FILTER_TYPE)
+        while local_peer.serve(self.manager, [self.wallet_script], [prevout]):
+            pass
+        self.assertEqual(set(self.manager.take_matched_blocks()), set(filters[h][0] for h in self.matching_heights | set([50, 60])))
+
+        # BIP158 filters have the spent scripts instead, so the prevouts aren't matched against them
+        manager = Manager(spv=StubSPV(tempfile.mkdtemp(dir=self.path), self.blockchain), compact_filters=True)
+        serve_all(manager, [StandInPeer(filters), StandInPeer(filters, peer_address=('127.0.0.2', 18333))], [self.wallet_script], [prevout])
+        self.assertEqual(set(manager.take_matched_blocks()), set(filters[h][0] for h in self.matching_heights))
+
+def make_block(coin, prev_block_hash, scripts):
+    header = BlockHeader(coin, prev_block_hash=prev_block_hash, nonce=int.from_bytes(os.urandom(4), 'little'))
+    spending_tx = Transaction(coin, inputs=[TransactionInput(prevout=TransactionPrevOut(os.urandom(32), 0), script=Script())], outputs=[])
+    return Block(coin, header=header, transactions=[Transaction(coin, outputs=[TransactionOutput(amount=1, script=Script(script)) for script in scripts]), spending_tx])
+
+class TestFilterDatabase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+        self.filterdb = FilterDatabase(self.spv)
+
+        self.blocks = []
+        prev_block_hash = b'\x00' * 32
+        for _ in range(50):
+            block = make_block(Bitcoin, prev_block_hash, [p2pkh_script() for _ in range(5)])
+            self.blocks.append(block)
+            prev_block_hash = block.header.hash()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def add_blocks(self, blocks, start_height):
+        for i, block in enumerate(blocks):
+            self.filterdb.on_block(block)
+            self.filterdb.on_block_added(block.header, start_height + i)
+
+    def test_filters_and_headers(self):
+        self.add_blocks(self.blocks, 100)
+        self.assertEqual(self.filterdb.get_next_height(), 150)
+
+        filters = self.filterdb.get_filters(110, self.blocks[19].header.hash(), 1000)
+        self.assertEqual([block_hash for block_hash, _ in filters], [block.header.hash() for block in self.blocks[10:20]])
+        for block, (block_hash, filter_data) in zip(self.blocks[10:20], filters):
+            gcs = GCSFilter.unserialize(filter_data, block_hash)
+            self.assertTrue(gcs.match_any([block.transactions[0].outputs[0].script.program]))
+            self.assertTrue(gcs.match_any([block.transactions[1].inputs[0].prevout.serialize()]))
+
+        # The headers chain from all 0s at the first block we have a filter for
+        previous_filter_header, filter_hashes = self.filterdb.get_filter_hashes(100, self.blocks[-1].header.hash(), 2000)
+        self.assertEqual(previous_filter_header, b'\x00' * 32)
+        self.assertEqual(len(filter_hashes), 50)
+
+        previous_filter_header, filter_hashes = self.filterdb.get_filter_hashes(120, self.blocks[29].header.hash(), 2000)
+        expected = b'\x00' * 32
+        for _, filter_data in self.filterdb.get_filters(100, self.blocks[19].header.hash(), 1000):
+            expected = filter_header(Bitcoin, filter_data, expected)
+        self.assertEqual(previous_filter_header, expected)
+        self.assertEqual(filter_hashes, [Bitcoin.hash(filter_data) for _, filter_data in self.filterdb.get_filters(120, self.blocks[29].header.hash(), 1000)])
+
+    def test_bad_requests(self):
+        self.add_blocks(self.blocks, 100)
+        self.assertIsNone(self.filterdb.get_filters(99, self.blocks[5].header.hash(), 1000))
+        self.assertIsNone(self.filterdb.get_filters(120, self.blocks[5].header.hash(), 1000))
+        self.assertIsNone(self.filterdb.get_filters(100, os.urandom(32), 1000))
+        self.assertIsNone(self.filterdb.get_filters(100, self.blocks[20].header.hash(), 20))
+        self.assertIsNone(self.filterdb.get_filter_hashes(100, self.blocks[20].header.hash(), 20))
+
+    def test_reorg_and_reload(self):
+        self.add_blocks(self.blocks, 100)
+
+        for height in range(149, 139, -1):
+            self.filterdb.on_block_removed(self.blocks[height - 100].header, height)
+
+        side_blocks = [make_block(Bitcoin, self.blocks[39].header.hash(), [p2pkh_script()])]
+        self.add_blocks(side_blocks, 140)
+        self.assertIsNone(self.filterdb.get_filters(140, self.blocks[40].header.hash(), 1000))
+
+        filters = self.filterdb.get_filters(100, side_blocks[0].header.hash(), 1000)
+        headers = self.filterdb.get_filter_hashes(100, side_blocks[0].header.hash(), 2000)
+
+        filterdb = FilterDatabase(self.spv)
+        self.assertEqual(filterdb.get_next_height(), 141)
+        self.assertEqual(filterdb.get_filters(100, side_blocks[0].header.hash(), 1000), filters)
+        self.assertEqual(filterdb.get_filter_hashes(100, side_blocks[0].header.hash(), 2000), headers)
+
+    def test_gap_restarts_filters(self):
+        self.add_blocks(self.blocks[:10], 100)
+        self.add_blocks(self.blocks[20:], 120)
+        self.assertIsNone(self.filterdb.get_filters(100, self.blocks[5].header.hash(), 1000))
+        self.assertEqual(len(self.filterdb.get_filters(120, self.blocks[-1].header.hash(), 1000)), 30)
+
+    def test_headers_only_blocks_are_skipped(self):
+        self.filterdb.on_block_added(self.blocks[0].header, 100)
+        self.assertIsNone(self.filterdb.get_next_height())
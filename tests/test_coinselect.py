@@ -0,0 +1,54 @@
+import itertools
+import random
+import unittest
+
+from pyspv import coinselect
+
+class TestCoinSelect(unittest.TestCase):
+    def test_branch_and_bound(self):
+        # Against every subset
+        for _ in range(100):
+            amounts = [random.randint(1, 50) for _ in range(10)]
+            target = random.randint(1, sum(amounts))
+            window = random.randint(0, 3)
+
+            best_total = None
+            for k in range(1, len(amounts) + 1):
+                for subset in itertools.combinations(amounts, k):
+                    if target <= sum(subset) <= target + window and (best_total is None or sum(subset) < best_total):
+                        best_total = sum(subset)
+
+            r = coinselect.branch_and_bound(amounts, target, window)
+            if best_total is None:
+                self.assertIsNone(r)
+            else:
+                self.assertEqual(len(set(r)), len(r))
+                self.assertEqual(sum(amounts[i] for i in r), best_total)
+
+    def test_random_subsets(self):
+        amounts = sorted(random.randint(1000, 100000) for _ in range(1000))
+        target = sum(amounts) // 2
+        for r in (coinselect.random_subsets(amounts, target), coinselect._random_subsets_python(amounts, target, 100, None)):
+            self.assertEqual(len(set(r)), len(r))
+            self.assertTrue(target <= sum(amounts[i] for i in r) < target + 100000)
+
+        self.assertIsNone(coinselect.random_subsets(amounts, sum(amounts) + 1))
+
+    def test_select_subset(self):
+        # No subset within the window, so it falls back to leaving change
+        amounts = [100] * 10
+        r = coinselect.select_subset(amounts, 250, 10)
+        self.assertTrue(sum(amounts[i] for i in r) >= 260)
+
+        self.assertEqual(sum(amounts[i] for i in coinselect.select_subset(amounts, 300, 10)), 300)
+        self.assertIsNone(coinselect.select_subset(amounts, 1001, 10))
+
+        # Random subsets don't reach a target that needs all but a few of the coins, the largest coins do
+        amounts = [1000000 + random.randint(0, 1000) for _ in range(60)]
+        target = sum(amounts) - 300000
+        self.assertIsNone(coinselect.random_subsets(amounts, target))
+        r = coinselect.select_subset(amounts, target, 546)
+        self.assertEqual(len(set(r)), len(r))
+        self.assertTrue(sum(amounts[i] for i in r) >= target + 546)
+        self.assertEqual(coinselect.largest_first([5, 1, 3], 7), [0, 2])
+        self.assertIsNone(coinselect.largest_first([5, 1, 3], 10))
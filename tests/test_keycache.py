@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.keycache import PublicKeyCache
+from pyspv.keys import PrivateKey
+from pyspv.walletdb import WalletDatabase
+
+from stubs import StubSPV
+
+class CountingPrivateKey(PrivateKey):
+    derived = 0
+
+    def get_public_key(self, compressed):
+        CountingPrivateKey.derived += 1
+        return PrivateKey.get_public_key(self, compressed)
+
+class TestPublicKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cache(self):
+        private_keys = [CountingPrivateKey(os.urandom(32)) for _ in range(5)]
+
+        walletdb = WalletDatabase(self.spv)
+        cache = PublicKeyCache(self.spv, walletdb)
+        CountingPrivateKey.derived = 0
+        for private_key in private_keys:
+            for compressed in (False, True):
+                public_key, hash160, address = cache.get(private_key, compressed)
+                expected = PrivateKey.get_public_key(private_key, compressed)
+                self.assertEqual(public_key, expected)
+                self.assertEqual(hash160, expected.as_hash160(Bitcoin))
+                self.assertEqual(address, expected.as_address(Bitcoin))
+
+        # One derivation per key, the compressed key comes from the uncompressed one
+        self.assertEqual(CountingPrivateKey.derived, len(private_keys))
+        walletdb.close()
+
+        # Nothing is derived again after loading
+        walletdb = WalletDatabase(self.spv)
+        cache = PublicKeyCache(self.spv, walletdb)
+        self.assertEqual(len(cache), len(private_keys))
+        CountingPrivateKey.derived = 0
+        self.assertEqual(cache.get(private_keys[2], True)[0], PrivateKey.get_public_key(private_keys[2], True))
+        self.assertEqual(CountingPrivateKey.derived, 0)
+        walletdb.close()
@@ -0,0 +1,66 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+from pyspv.keypool import KeyPool
+from pyspv.monitors.pubkey import PubKeyPaymentMonitor
+from pyspv.wallet import Wallet
+
+from stubs import StubSPV
+
+class TestKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+
+    def tearDown(self):
+        self.spv.wallet.walletdb.close()
+        shutil.rmtree(self.path)
+
+    def load_wallet(self):
+        self.spv.wallet = Wallet(self.spv, monitors=[PubKeyPaymentMonitor])
+        self.spv.wallet.load()
+        return self.spv.wallet
+
+    def wait_for(self, key_pool, count):
+        for _ in range(100):
+            if len(key_pool) == count:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(key_pool), count)
+
+    def test_key_pool(self):
+        wallet = self.load_wallet()
+        key_pool = KeyPool(self.spv, size=20, low_water_mark=15)
+        key_pool.start()
+        self.wait_for(key_pool, 20)
+
+        # Pooled keys are already in the wallet and watched
+        self.assertEqual(wallet.len('private_key'), 20)
+        monitor = wallet.monitors[0]
+        self.assertEqual(len(monitor.pubkey_hash_addresses), 40)
+
+        private_key = key_pool.take(label='customer 1')
+        self.assertEqual(wallet.get('private_key', private_key), {'label': 'customer 1'})
+        taken = [key_pool.take() for _ in range(5)]
+        self.assertNotIn(private_key, taken)
+
+        # Refilled once it went under the low water mark
+        self.wait_for(key_pool, 20)
+        self.assertEqual(wallet.len('private_key'), 26)
+        key_pool.shutdown()
+        key_pool.join()
+
+        # The pool is the same after loading, minus what was handed out
+        pooled = list(key_pool.keys)
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        key_pool = KeyPool(self.spv, size=20)
+        self.assertEqual(list(key_pool.keys), pooled)
+
+        # An empty pool still hands out keys
+        key_pool.keys.clear()
+        private_key = key_pool.take(label='customer 2')
+        self.assertEqual(wallet.get('private_key', private_key), {'label': 'customer 2'})
+        self.assertEqual(wallet.len('private_key'), 27)
@@ -0,0 +1,408 @@
+import os
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.inv import Inv
+from pyspv.network import Manager, Peer, SeedResolver
+from pyspv.serialize import Serialize
+
+from stubs import StubHeader, StubSPV
+
+class StubManager:
+    def __init__(self):
+        self.spv = StubSPV()
+        self.found = []
+
+    def peer_found(self, peer_address):
+        if peer_address not in self.found:
+            self.found.append(peer_address)
+
+class StubResolver:
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = failing
+
+    def __call__(self, host, port):
+        self.calls.append(host)
+        if host in self.failing:
+            raise socket.gaierror("stub failure")
+        n = Bitcoin.SEEDS.index(host)
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.{}.1'.format(n), 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.{}.2'.format(n), 0)),
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 0, 0, 0)),
+        ]
+
+class TestSeedResolver(unittest.TestCase):
+    def test_resolves_all_seeds(self):
+        manager = StubManager()
+        resolver = StubResolver()
+        SeedResolver(manager, resolver=resolver).resolve_seeds()
+
+        self.assertEqual(sorted(resolver.calls), sorted(Bitcoin.SEEDS))
+        self.assertEqual(len(manager.found), 2 * len(Bitcoin.SEEDS))
+        self.assertIn(('10.0.0.1', Bitcoin.DEFAULT_PORT), manager.found)
+
+    def test_cached_seeds_are_not_queried(self):
+        manager = StubManager()
+        resolver = StubResolver()
+        seed_resolver = SeedResolver(manager, resolver=resolver)
+
+        seed_resolver.resolve_seeds()
+        seed_resolver.resolve_seeds()
+        self.assertEqual(len(resolver.calls), len(Bitcoin.SEEDS))
+
+        # Expire one entry and only that seed gets queried again
+        seed_resolver.seed_cache[Bitcoin.SEEDS[0]]['expires'] = time.time() - 1
+        seed_resolver.resolve_seeds()
+        self.assertEqual(len(resolver.calls), len(Bitcoin.SEEDS) + 1)
+        self.assertEqual(resolver.calls[-1], Bitcoin.SEEDS[0])
+
+    def test_failed_seed_is_retried_sooner(self):
+        manager = StubManager()
+        resolver = StubResolver(failing=(Bitcoin.SEEDS[1],))
+        seed_resolver = SeedResolver(manager, resolver=resolver)
+        seed_resolver.resolve_seeds()
+
+        entry = seed_resolver.seed_cache[Bitcoin.SEEDS[1]]
+        self.assertEqual(entry['addresses'], [])
+        self.assertLessEqual(entry['expires'], time.time() + SeedResolver.SEED_RETRY_TIME)
+        self.assertEqual(len(manager.found), 2 * (len(Bitcoin.SEEDS) - 1))
+
+    def test_background_request(self):
+        manager = StubManager()
+        seed_resolver = SeedResolver(manager, resolver=StubResolver())
+        seed_resolver.start()
+        try:
+            seed_resolver.request()
+            deadline = time.time() + 5
+            while len(manager.found) < 2 * len(Bitcoin.SEEDS) and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            seed_resolver.shutdown()
+            seed_resolver.join(5)
+
+        self.assertEqual(len(manager.found), 2 * len(Bitcoin.SEEDS))
+
+class StubSocket:
+    def __init__(self):
+        self.sent = []
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+    def commands(self):
+        return [data[4:16].rstrip(b'\0').decode('ascii') for data in self.sent]
+
+class StubBlockchain:
+    def __init__(self):
+        self.blocks = {}
+        self.needs_headers = False
+        self.added = []
+        self.served = []
+
+    def get_needs_headers(self):
+        return self.needs_headers
+
+    def add_block_headers(self, headers):
+        self.added.extend(headers)
+        return True
+
+    def get_headers_after(self, locator_hashes, stop_hash, max_count):
+        self.served.append((locator_hashes, stop_hash, max_count))
+        return []
+
+class StubNetworkSPV(StubSPV):
+    def __init__(self):
+        StubSPV.__init__(self, blockchain=StubBlockchain())
+        self.time_data = []
+
+    def add_time_data(self, peer_time):
+        self.time_data.append(peer_time)
+
+class StubPeerManager:
+    expected_block_size = 500 * 1024
+    serve_blockchain = False
+
+    def __init__(self):
+        self.spv = StubNetworkSPV()
+        self.peers = {}
+        self.inv_lock = threading.Lock()
+        self.blockchain_sync_lock = threading.Lock()
+        self.inprogress_invs = {}
+        self.headers_request = None
+        self.reassigned = []
+        self.announced = []
+        self.announced_headers_connect = True
+
+    reassign_inv = Manager.reassign_inv
+    received_announced_headers = Manager.received_announced_headers
+
+    def will_request_inv(self, inv):
+        return Manager.REQUEST_GO
+
+    def received_transaction(self, inv, tx):
+        pass
+
+    def peer_is_bad(self, peer_address):
+        pass
+
+class RecordingPeerManager(StubPeerManager):
+    def reassign_inv(self, inv, from_peer):
+        self.reassigned.append((inv, from_peer))
+
+    def received_announced_headers(self, headers):
+        self.announced.append(headers)
+        return self.announced_headers_connect
+
+def connected_peer(manager, peer_version=Manager.PROTOCOL_VERSION):
+    peer = Peer(manager, ('10.0.0.1', Bitcoin.DEFAULT_PORT), sock=StubSocket())
+    peer.running = True
+    peer.state = 'init'
+    peer.step()
+    peer.peer_version = peer_version
+    peer.peer_time = time.time()
+    peer.peer_verack = 2
+    peer.handshake_complete()
+    return peer
+
+class TestPeerDeadlines(unittest.TestCase):
+    def test_request_timeout(self):
+        peer = connected_peer(StubPeerManager())
+
+        # No measurements yet, so the manager's fixed timeout is used
+        peer.latency = None
+        self.assertEqual(peer.request_timeout(0, 30), 30)
+
+        # Latency alone is enough for small requests, but not for large ones
+        peer.update_latency(2)
+        self.assertEqual(peer.request_timeout(0, 30), Peer.LATENCY_FACTOR * 2)
+        self.assertEqual(peer.request_timeout(1024 * 1024, 120), 120)
+
+        peer.update_throughput(1024 * 1024, 1)
+        self.assertEqual(peer.request_timeout(1024 * 1024, 120), Peer.LATENCY_FACTOR * 2 + Peer.SIZE_FACTOR)
+
+        # Clamped to the minimum and the fixed timeout
+        peer.latency = 0.01
+        self.assertEqual(peer.request_timeout(0, 30), Peer.MIN_REQUEST_TIMEOUT)
+        peer.latency = 100
+        self.assertEqual(peer.request_timeout(0, 30), 30)
+
+    def test_missed_deadline(self):
+        peer = connected_peer(StubPeerManager())
+        for _ in range(Peer.MAX_MISSED_DEADLINES - 1):
+            peer.missed_deadline()
+        self.assertEqual(peer.state, 'connected')
+        peer.missed_deadline()
+        self.assertEqual(peer.state, 'dead')
+
+    def test_overdue_block_is_reassigned(self):
+        manager = RecordingPeerManager()
+        peer = connected_peer(manager)
+
+        inv = Inv(Inv.MSG_BLOCK, os.urandom(32))
+        list(peer.request_invs({inv}))
+        self.assertEqual(peer.outgoing_data_queue[-1][4:16].rstrip(b'\0'), b'getdata')
+
+        peer.inv_deadlines[inv] = time.time() - 1
+        peer.handle_invs()
+        self.assertEqual(manager.reassigned, [(inv, peer)])
+        self.assertNotIn(inv, peer.inprogress_invs)
+        self.assertIn(inv, peer.abandoned_invs)
+        self.assertEqual(peer.missed_deadlines, 1)
+
+    def test_reassign_inv(self):
+        manager = StubPeerManager()
+        slow, fast, busy = connected_peer(manager), connected_peer(manager), connected_peer(manager)
+        slow.throughput, fast.throughput, busy.throughput = 1000, 100000, 200000
+        busy.inprogress_invs = dict((Inv(Inv.MSG_BLOCK, os.urandom(32)), 0) for _ in range(9))
+        manager.peers = {1: slow, 2: fast, 3: busy}
+
+        inv = Inv(Inv.MSG_BLOCK, os.urandom(32))
+        manager.inprogress_invs[inv] = slow
+        manager.reassign_inv(inv, slow)
+        self.assertNotIn(inv, manager.inprogress_invs)
+        self.assertEqual(list(fast.reassigned_invs), [inv])
+
+        # The request is picked up on the next step
+        fast.handle_invs()
+        self.assertIn(inv, fast.inprogress_invs)
+
+        # With nobody else around the same peer gets it back
+        manager.peers = {1: slow}
+        manager.reassign_inv(inv, slow)
+        self.assertEqual(list(slow.reassigned_invs), [inv])
+
+class TestPeerPing(unittest.TestCase):
+    def test_ping_pong(self):
+        peer = connected_peer(StubPeerManager())
+        peer.latency = None
+        peer.handle_ping()
+        self.assertIsNotNone(peer.ping_nonce)
+        self.assertEqual(peer.outgoing_data_queue[-1][4:16].rstrip(b'\0'), b'ping')
+
+        # No second ping while one is outstanding
+        queued = len(peer.outgoing_data_queue)
+        peer.ping_time -= Peer.PING_INTERVAL
+        peer.handle_ping()
+        self.assertEqual(len(peer.outgoing_data_queue), queued)
+        peer.ping_time += Peer.PING_INTERVAL
+
+        # A pong with the wrong nonce is ignored
+        peer.cmd_pong(struct.pack("<Q", (peer.ping_nonce + 1) % (1 << 64)))
+        self.assertIsNone(peer.latency)
+
+        peer.cmd_pong(struct.pack("<Q", peer.ping_nonce))
+        self.assertIsNone(peer.ping_nonce)
+        self.assertIsNotNone(peer.latency)
+
+        # Not until the next interval
+        peer.handle_ping()
+        self.assertIsNone(peer.ping_nonce)
+        peer.ping_time -= Peer.PING_INTERVAL
+        peer.handle_ping()
+        self.assertIsNotNone(peer.ping_nonce)
+
+    def test_old_peers_arent_pinged(self):
+        peer = connected_peer(StubPeerManager(), peer_version=60000)
+        peer.handle_ping()
+        self.assertIsNone(peer.ping_nonce)
+
+class TestPeerSendHeaders(unittest.TestCase):
+    def test_protocol_version(self):
+        self.assertGreaterEqual(Manager.PROTOCOL_VERSION, Manager.SENDHEADERS_VERSION)
+        self.assertEqual(Manager.SENDHEADERS_VERSION, 70012)
+
+    def test_sendheaders_after_handshake(self):
+        peer = connected_peer(StubPeerManager())
+        self.assertTrue(peer.sent_sendheaders)
+        self.assertEqual(peer.outgoing_data_queue[-1][4:16].rstrip(b'\0'), b'sendheaders')
+
+        peer = connected_peer(StubPeerManager(), peer_version=Manager.SENDHEADERS_VERSION - 1)
+        self.assertFalse(peer.sent_sendheaders)
+
+        peer.cmd_sendheaders(b'')
+        self.assertTrue(peer.peer_wants_headers)
+
+    def test_announced_headers_while_syncing_headers(self):
+        manager = RecordingPeerManager()
+        manager.spv.blockchain.needs_headers = True
+        peer = connected_peer(manager)
+        peer.syncing_blockchain = 0
+
+        headers = [StubHeader(), StubHeader()]
+        peer.handle_announced_headers(headers)
+        self.assertEqual(manager.announced, [headers])
+        self.assertEqual(peer.syncing_blockchain, 0)
+
+        # Headers that don't connect send us back to a normal sync
+        manager.announced_headers_connect = False
+        peer.handle_announced_headers([StubHeader()])
+        self.assertEqual(peer.syncing_blockchain, 1)
+
+    def test_announced_headers_fetch_blocks(self):
+        manager = StubPeerManager()
+        peer = connected_peer(manager)
+        peer.blocks_request = {'time': time.time()}
+
+        headers = [StubHeader(), StubHeader()]
+        peer.handle_announced_headers(headers)
+        self.assertIsNone(peer.blocks_request)
+        self.assertEqual(set(peer.inprogress_invs), set(Inv(Inv.MSG_BLOCK, header.hash()) for header in headers))
+        self.assertEqual(peer.socket.commands()[-1], 'getdata')
+
+    def test_received_announced_headers(self):
+        manager = StubPeerManager()
+        known, new = StubHeader(), StubHeader()
+        manager.spv.blockchain.blocks[known.hash()] = known
+
+        # Left to the getheaders in progress
+        manager.headers_request = {'peer': None}
+        self.assertTrue(manager.received_announced_headers([known, new]))
+        self.assertEqual(manager.spv.blockchain.added, [])
+
+        # Headers we already have aren't added again
+        manager.headers_request = None
+        self.assertTrue(manager.received_announced_headers([known, new]))
+        self.assertEqual(manager.spv.blockchain.added, [new])
+
+def locator_payload(locator_hashes, stop_hash):
+    return struct.pack("<L", Manager.PROTOCOL_VERSION) + Serialize.serialize_variable_int(len(locator_hashes)) + b''.join(locator_hashes) + stop_hash
+
+class TestPeerServing(unittest.TestCase):
+    def setUp(self):
+        self.manager = StubPeerManager()
+        self.manager.serve_blockchain = True
+        self.peer = connected_peer(self.manager)
+        self.peer.outgoing_data_queue.clear()
+
+    def test_requests_are_served_one_batch_at_a_time(self):
+        locator_hashes = [os.urandom(32) for _ in range(3)]
+        stop_hash = os.urandom(32)
+        self.peer.cmd_getheaders(locator_payload(locator_hashes, stop_hash))
+        self.peer.cmd_getblocks(locator_payload(locator_hashes, b'\x00' * 32))
+        self.assertEqual(len(self.peer.serve_requests), 2)
+
+        self.peer.handle_serve_requests()
+        self.assertEqual(self.manager.spv.blockchain.served, [(locator_hashes, stop_hash, Manager.MAX_HEADERS_PER_MESSAGE)])
+        self.assertEqual(self.peer.outgoing_data_queue[-1][4:16].rstrip(b'\0'), b'headers')
+
+        # Waits until the headers are sent
+        self.peer.handle_serve_requests()
+        self.assertEqual(len(self.manager.spv.blockchain.served), 1)
+
+        self.peer.handle_outgoing_data()
+        self.peer.handle_serve_requests()
+        self.assertEqual(self.manager.spv.blockchain.served[-1], (locator_hashes, b'\x00' * 32, Manager.MAX_BLOCKS_PER_INV))
+
+    def test_rate_limit(self):
+        for _ in range(Peer.SERVE_REQUEST_BURST + Peer.MAX_QUEUED_SERVE_REQUESTS):
+            if len(self.peer.serve_requests) == Peer.MAX_QUEUED_SERVE_REQUESTS - 1:
+                self.peer.handle_serve_requests()
+                self.peer.handle_outgoing_data()
+            self.peer.cmd_getheaders(locator_payload([os.urandom(32)], b'\x00' * 32))
+        while len(self.peer.serve_requests):
+            served = len(self.manager.spv.blockchain.served)
+            self.peer.handle_serve_requests()
+            self.peer.handle_outgoing_data()
+            if len(self.manager.spv.blockchain.served) == served:
+                break
+
+        # Out of tokens after the burst
+        self.assertEqual(len(self.manager.spv.blockchain.served), Peer.SERVE_REQUEST_BURST)
+        self.assertEqual(self.peer.state, 'connected')
+
+        # Tokens come back over time
+        self.peer.serve_tokens_time -= 1.0 / Peer.SERVE_REQUEST_RATE
+        self.peer.handle_serve_requests()
+        self.assertEqual(len(self.manager.spv.blockchain.served), Peer.SERVE_REQUEST_BURST + 1)
+
+    def test_flooding_peer_is_dropped(self):
+        for _ in range(Peer.MAX_QUEUED_SERVE_REQUESTS):
+            self.peer.cmd_getheaders(locator_payload([os.urandom(32)], b'\x00' * 32))
+        self.assertEqual(self.peer.state, 'connected')
+
+        self.peer.cmd_getheaders(locator_payload([os.urandom(32)], b'\x00' * 32))
+        self.assertEqual(self.peer.state, 'dead')
+
+    def test_bad_locator(self):
+        self.peer.cmd_getheaders(locator_payload([os.urandom(32) for _ in range(Manager.MAX_LOCATOR_HASHES + 1)], b'\x00' * 32))
+        self.assertEqual(self.peer.state, 'dead')
+
+        peer = connected_peer(self.manager)
+        peer.cmd_getheaders(locator_payload([os.urandom(32)], b'\x00' * 31))
+        self.assertEqual(peer.state, 'dead')
+
+    def test_not_serving(self):
+        self.manager.serve_blockchain = False
+        self.peer.cmd_getheaders(locator_payload([os.urandom(32)], b'\x00' * 32))
+        self.assertEqual(len(self.peer.serve_requests), 0)
+        self.assertEqual(self.peer.state, 'connected')
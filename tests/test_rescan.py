@@ -0,0 +1,145 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.block import Block, BlockHeader
+from pyspv.blockstore import BlockStore
+from pyspv.rescan import Rescan, RescanRangeUnavailable
+from pyspv.script import Script, TEMPLATE_P2PKH
+from pyspv.transaction import Transaction, TransactionOutput
+
+from stubs import StubSPV
+
+def make_blocks(count):
+    blocks = []
+    prev_block_hash = b'\x00' * 32
+    for _ in range(count):
+        header = BlockHeader(Bitcoin, prev_block_hash=prev_block_hash, nonce=int.from_bytes(os.urandom(4), 'little'))
+        outputs = [TransactionOutput(amount=1, script=Script(os.urandom(25)))]
+        blocks.append(Block(Bitcoin, header=header, transactions=[Transaction(Bitcoin, outputs=outputs)]))
+        prev_block_hash = header.hash()
+    return blocks
+
+class StubMonitor:
+    def get_item_scan_keys(self, collection_name, item, metadata):
+        return {TEMPLATE_P2PKH: set([item])} if collection_name == 'address' else {}
+
+    def get_scan_keys(self):
+        return {TEMPLATE_P2PKH: set()}
+
+class StubWallet:
+    def __init__(self):
+        self.wallet_lock = threading.Lock()
+        self.monitors = [StubMonitor()]
+        self.rescanned = []
+        self.reindexed = []
+
+    def get(self, collection_name, item):
+        return {}
+
+    def batch(self):
+        return contextlib.nullcontext()
+
+    def rescan_block(self, block, block_scanner, scan_keys):
+        self.rescanned.append((block.header.hash(), scan_keys))
+
+    def reindex_block(self, block):
+        self.reindexed.append(block.header.hash())
+
+class StubTransactionDatabase:
+    def __init__(self):
+        self.block_heights = []
+
+    def on_block(self, block, block_height=None):
+        self.block_heights.append((block.header.hash(), block_height))
+
+class StubBlockchain:
+    def __init__(self, blocks, start_height):
+        self.blocks = blocks
+        self.start_height = start_height
+
+    def get_best_chain_height(self):
+        return self.start_height + len(self.blocks) - 1
+
+    def get_main_chain_hashes(self, start_height, stop_height):
+        if start_height < self.start_height or stop_height >= self.start_height + len(self.blocks):
+            return None
+        return [block.header.hash() for block in self.blocks[start_height-self.start_height:stop_height-self.start_height+1]]
+
+class StubManager:
+    def __init__(self, blocks):
+        self.blocks = dict((block.header.hash(), block) for block in blocks)
+        self.requested = []
+        self.cancelled = []
+
+    def request_rescan_blocks(self, block_hashes, callback):
+        # Deliver them from another thread, in reverse, like peers would in no particular order
+        self.requested.extend(block_hashes)
+        blocks = [self.blocks[block_hash] for block_hash in reversed(block_hashes)]
+        threading.Thread(target=lambda: [callback(block) for block in blocks]).start()
+
+    def cancel_rescan_blocks(self, block_hashes):
+        self.cancelled.extend(block_hashes)
+
+class StubRescanSPV(StubSPV):
+    def __init__(self, path, blocks, start_height):
+        StubSPV.__init__(self, path, StubBlockchain(blocks, start_height))
+        self.blockstore = None
+        self.wallet = StubWallet()
+        self.txdb = StubTransactionDatabase()
+        self.network_manager = StubManager(blocks)
+
+class TestRescan(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blocks = make_blocks(100)
+
+        # The blockchain in memory has heights 1050 to 1099, and the store 1000 to 1079
+        self.spv = StubRescanSPV(self.path, self.blocks[50:], 1050)
+        self.spv.blockstore = BlockStore(self.spv)
+        for i, block in enumerate(self.blocks[:80]):
+            self.spv.blockstore.on_block(block)
+            self.spv.blockstore.on_block_added(block.header, 1000 + i)
+
+    def tearDown(self):
+        if self.spv.blockstore is not None:
+            self.spv.blockstore.close()
+        shutil.rmtree(self.path)
+
+    def test_rescan(self):
+        progress = []
+        rescan = Rescan(self.spv, 1010, items=[('address', b'\x01' * 20), ('other', b'')], progress=lambda *args: progress.append(args))
+        rescan.start()
+        rescan.join()
+
+        self.assertIsNone(rescan.error)
+        self.assertEqual(rescan.get_progress(), 1.0)
+        self.assertEqual([block_hash for block_hash, _ in self.spv.wallet.rescanned], [block.header.hash() for block in self.blocks[10:]])
+        self.assertEqual(self.spv.wallet.rescanned[0][1], [{TEMPLATE_P2PKH: set([b'\x01' * 20])}, {}])
+        self.assertEqual(self.spv.txdb.block_heights, [(block.header.hash(), 1010 + i) for i, block in enumerate(self.blocks[10:])])
+        self.assertEqual(self.spv.wallet.reindexed, [block.header.hash() for block in self.blocks[10:]])
+        self.assertEqual(progress[-1], (1099, 1010, 1099))
+
+        # Only the blocks past the store were downloaded
+        self.assertEqual(self.spv.network_manager.requested, [block.header.hash() for block in self.blocks[80:]])
+
+    def test_unavailable(self):
+        # Below the store and the blockchain in memory
+        with self.assertRaises(RescanRangeUnavailable):
+            Rescan(self.spv, 990)
+
+        # Everything from the network when there's no store
+        self.spv.blockstore.close()
+        self.spv.blockstore = None
+        with self.assertRaises(RescanRangeUnavailable):
+            Rescan(self.spv, 1040)
+
+        rescan = Rescan(self.spv, 1090, to_height=1095)
+        rescan.start()
+        rescan.join()
+        self.assertEqual(len(self.spv.wallet.rescanned), 6)
+        self.assertEqual(self.spv.wallet.rescanned[0][1], None)
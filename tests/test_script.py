@@ -0,0 +1,49 @@
+import os
+import unittest
+
+from pyspv.script import *
+
+class TestScript(unittest.TestCase):
+    def test_data_pushes(self):
+        script = Script()
+        script.push_op(OP_0)
+        for size in (0, 20, 75, 76, 255, 256, 70000):
+            script.push_bytes(bytes([size & 0xff]) * size)
+
+        pushes = get_data_pushes(script.program)
+        self.assertEqual([len(push) for push in pushes], [0, 0, 20, 75, 76, 255, 256, 70000])
+
+        # Truncated push, and a non-push opcode
+        self.assertIsNone(get_data_pushes(script.program[:-1]))
+        self.assertIsNone(get_data_pushes(bytes([20]) + os.urandom(20) + bytes([OP_CHECKSIG])))
+
+    def test_classify_outputs(self):
+        hash160 = os.urandom(20)
+        public_key = b'\x02' + os.urandom(32)
+
+        self.assertEqual(classify_output_script(bytes([OP_DUP, OP_HASH160, 20]) + hash160 + bytes([OP_EQUALVERIFY, OP_CHECKSIG])), (TEMPLATE_P2PKH, hash160))
+        self.assertEqual(classify_output_script(bytes([OP_HASH160, 20]) + hash160 + bytes([OP_EQUAL])), (TEMPLATE_P2SH, hash160))
+        self.assertEqual(classify_output_script(bytes([33]) + public_key + bytes([OP_CHECKSIG])), (TEMPLATE_P2PK, public_key))
+        self.assertEqual(classify_output_script(bytes([OP_RETURN, 33]) + public_key), (TEMPLATE_STEALTH_EPHEMERAL, public_key))
+
+        self.assertIsNone(classify_output_script(b''))
+        self.assertIsNone(classify_output_script(bytes([OP_RETURN, 20]) + hash160))
+        self.assertIsNone(classify_output_script(bytes([OP_HASH160, 20]) + hash160 + bytes([OP_EQUALVERIFY])))
+
+    def test_classify_inputs(self):
+        public_key = b'\x04' + os.urandom(64)
+        script = Script()
+        script.push_bytes(b'\x30' * 71)
+        script.push_bytes(public_key)
+        self.assertEqual(classify_input_script(script.program), (TEMPLATE_PUBKEY_SPEND, public_key))
+        self.assertIsNone(classify_input_script(script.program[:-1]))
+
+        redemption_script = bytes([OP_1, 33]) + os.urandom(33) + bytes([OP_1, OP_CHECKMULTISIG])
+        script = Script()
+        script.push_op(OP_0)
+        script.push_bytes(b'\x30' * 72)
+        script.push_bytes(redemption_script)
+        self.assertEqual(classify_input_script(script.program), (TEMPLATE_MULTISIG_SPEND, redemption_script))
+
+        self.assertIsNone(classify_input_script(b''))
+        self.assertIsNone(classify_input_script(bytes([OP_0])))
@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from pyspv import spendtable
+from pyspv.spendtable import SpendTable
+from pyspv.transaction import TransactionPrevOut
+
+class TestSpendTable(unittest.TestCase):
+    def make_table(self):
+        table = SpendTable()
+        self.prevouts = [TransactionPrevOut(os.urandom(32), i) for i in range(4)]
+        for i, prevout in enumerate(self.prevouts):
+            table.add(os.urandom(32), 'PubKeySpend', 'default' if i < 3 else 'other', (i + 1) * 1000, prevout)
+        table.add(os.urandom(32), 'MultisigScriptHashSpend', 'other', 7000)
+        return table
+
+    def test_columns(self):
+        table = self.make_table()
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table.class_names, ['PubKeySpend', 'MultisigScriptHashSpend'])
+        self.assertEqual(table.categories, ['default', 'other'])
+
+        spend_hash = table.get_spend_hash(1)
+        self.assertIn(spend_hash, table)
+        self.assertEqual(table.get_row(spend_hash), 1)
+        self.assertEqual(table.get_amount(1), 2000)
+        self.assertEqual(table.get_category(3), 'other')
+        self.assertEqual(table.get_class_name(4), 'MultisigScriptHashSpend')
+
+        self.assertEqual(table.get_prevout(2), self.prevouts[2].serialize())
+        self.assertIsNone(table.get_prevout(4))
+        self.assertEqual(table.get_prevouts(), set(prevout.serialize() for prevout in self.prevouts))
+
+        # The prevout flag stays put when the state changes
+        table.set_state(2, True, False, 100)
+        self.assertTrue(table.is_spent(2))
+        self.assertEqual(table.get_height(2), 100)
+        self.assertEqual(table.get_prevout(2), self.prevouts[2].serialize())
+
+    def test_find_rows(self):
+        table = self.make_table()
+        table.set_state(0, False, True, 10)
+        table.set_state(1, True, False, 10)
+        table.set_state(3, False, True, 10)
+        table.set_state(4, False, True, 0)
+
+        saved_numpy = spendtable.numpy
+        try:
+            for numpy in set([saved_numpy, None]):
+                spendtable.numpy = numpy
+                self.assertEqual(table.find_rows(['default'], SpendTable.FLAG_SPENDABLE), [0])
+                self.assertEqual(table.find_rows(['default', 'other'], SpendTable.FLAG_SPENDABLE), [0, 3, 4])
+                self.assertEqual(table.find_rows(['missing'], SpendTable.FLAG_SPENDABLE), [])
+                self.assertEqual(table.find_rows(None, 0, SpendTable.FLAG_SPENT), [0, 2, 3, 4])
+                self.assertEqual(table.get_balances(), {'default': 4000, 'other': 11000})
+                self.assertEqual(table.find_mature_rows(10), [0, 3, 4])
+                self.assertEqual(table.find_mature_rows(11), [4])
+        finally:
+            spendtable.numpy = saved_numpy
+
+        self.assertEqual(table.get_state(0), SpendTable.STATE_MATURE)
+        self.assertEqual(table.get_state(1), SpendTable.STATE_SPENT)
+        self.assertEqual(table.get_state(2), SpendTable.STATE_UNCONFIRMED)
+        table.set_state(2, False, False, 10)
+        self.assertEqual(table.get_state(2), SpendTable.STATE_CONFIRMING)
+        table.set_state(2, False, False, 10, mature=True)
+        self.assertEqual(table.get_state(2), SpendTable.STATE_MATURE)
+        self.assertEqual(table.get_state_balances(), {'default': [0, 0, 4000, 2000], 'other': [0, 0, 11000, 0]})
@@ -0,0 +1,47 @@
+import hashlib
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.keys import PrivateKey, PublicKey
+from pyspv.monitors.stealth import StealthAddressPaymentMonitor
+from pyspv.stealthscan import StealthScanner
+
+from stubs import StubSPV
+
+class TestStealthScanner(unittest.TestCase):
+    def setUp(self):
+        self.stealth_keys = [PrivateKey.create_new() for _ in range(3)]
+        self.ephemeral_keys = [PrivateKey.create_new().get_public_key(True).pubkey for _ in range(4)]
+
+        # The payment addresses, worked out the long way
+        self.expected = {}
+        for ephemeral_key in self.ephemeral_keys:
+            for stealth_key in self.stealth_keys:
+                shared_secret = int.from_bytes(hashlib.sha256(PublicKey(ephemeral_key).multiply(stealth_key.as_int()).pubkey).digest(), 'big')
+                payment_key = stealth_key.add_constant(shared_secret)
+                self.expected[payment_key.get_public_key(True).as_hash160(Bitcoin)] = (stealth_key, shared_secret)
+
+    def test_scan(self):
+        scanner = StealthScanner(Bitcoin, processes=1)
+        for stealth_key in self.stealth_keys:
+            scanner.add_key(stealth_key)
+
+        # Ephemeral keys that aren't points on the curve are skipped
+        self.assertEqual(scanner.scan(self.ephemeral_keys + [b'\x02' + b'\x00' * 32]), self.expected)
+
+    def test_parallel_scan(self):
+        scanner = StealthScanner(Bitcoin, processes=2)
+        scanner.PARALLEL_SCAN_THRESHOLD = 1
+        try:
+            for stealth_key in self.stealth_keys:
+                scanner.add_key(stealth_key)
+            self.assertEqual(scanner.scan(self.ephemeral_keys), self.expected)
+        finally:
+            scanner.close()
+
+    def test_monitor_processes(self):
+        # The stealth monitor's scanner uses as many processes as the block scanner
+        spv = StubSPV()
+        self.assertEqual(StealthAddressPaymentMonitor(spv).scanner.processes, 1)
+        spv.block_scan_processes = 3
+        self.assertEqual(StealthAddressPaymentMonitor(spv).scanner.processes, 3)
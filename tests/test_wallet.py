@@ -0,0 +1,393 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspv import Bitcoin
+from pyspv.block import Block, BlockHeader
+from pyspv.monitors.basemonitor import BaseMonitor
+from pyspv.script import Script
+from pyspv.serialize import Serialize
+from pyspv.transaction import Transaction, TransactionOutput, TransactionPrevOut
+from pyspv.wallet import Spend, Wallet
+
+from stubs import StubSPV
+
+class StubSpend(Spend):
+    unserialized = 0
+
+    def __init__(self, coin, category, amount, tx_hash, spent=False):
+        Spend.__init__(self, coin, category, amount)
+        self.tx_hash = tx_hash
+        self.spent = spent
+
+    def hash(self):
+        return self.coin.hash(self.tx_hash)
+
+    def is_spent(self, spv):
+        return self.spent
+
+    def is_spendable(self, spv):
+        return not self.spent and spv.txdb.get_tx_depth(self.tx_hash) >= self.coin.TRANSACTION_CONFIRMATION_DEPTH
+
+    def serialize(self):
+        return Serialize.serialize_string(self.category) + Serialize.serialize_variable_int(self.amount) + self.tx_hash + bytes([self.spent])
+
+    @classmethod
+    def unserialize(cls, data, coin):
+        category, data = Serialize.unserialize_string(data)
+        amount, data = Serialize.unserialize_variable_int(data)
+        cls.unserialized += 1
+        return cls(coin, category, amount, data[:32], spent=bool(data[32])), data[33:]
+
+class StubBlockSpend(StubSpend):
+    '''A spend with a prevout, so the wallet knows the height of its block'''
+
+    @property
+    def prevout(self):
+        return TransactionPrevOut(self.tx_hash, 0)
+
+    def is_spendable(self, spv):
+        height = spv.txdb.get_tx_height(self.tx_hash)
+        return not self.spent and height > 0 and spv.blockchain.height - height + 1 >= self.coin.TRANSACTION_CONFIRMATION_DEPTH
+
+class StubKeySpend(StubBlockSpend):
+    '''A spend the wallet can only sign for once the key for it is added'''
+
+    def is_spendable(self, spv):
+        return StubBlockSpend.is_spendable(self, spv) and spv.wallet.get_temp('signing_key', self.tx_hash) is not None
+
+    def get_signing_keys(self):
+        return [self.tx_hash]
+
+class StubKeyMonitor(BaseMonitor):
+    '''Private keys sign with themselves'''
+    spend_classes = []
+
+    def get_item_signing_keys(self, collection_name, item, metadata):
+        return set([item]) if collection_name == 'private_key' else set()
+
+class TestWallet(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+
+    def tearDown(self):
+        self.wallet.walletdb.close()
+        shutil.rmtree(self.path)
+
+    def load_wallet(self, snapshot=False, monitors=()):
+        self.wallet = Wallet(self.spv, monitors=list(monitors), snapshot=snapshot)
+        self.wallet.spend_classes['StubSpend'] = StubSpend
+        self.wallet.spend_classes['StubBlockSpend'] = StubBlockSpend
+        self.wallet.spend_classes['StubKeySpend'] = StubKeySpend
+        self.wallet.load()
+        return self.wallet
+
+    def add_spend(self, amount, category='default', depth=Bitcoin.TRANSACTION_CONFIRMATION_DEPTH, spent=False):
+        spend = StubSpend(Bitcoin, category, amount, os.urandom(32), spent=spent)
+        self.spv.txdb.depths[spend.tx_hash] = depth
+        self.wallet.add_spend(spend)
+        return spend
+
+    def test_select_spends(self):
+        wallet = self.load_wallet()
+        coin = Bitcoin.DUST_LIMIT
+        for _ in range(3):
+            self.add_spend(coin)
+        big = self.add_spend(100 * coin)
+        self.add_spend(50 * coin, category='other')
+        self.add_spend(10 * coin, spent=True)
+        immature = self.add_spend(10 * coin, depth=1)
+
+        # Perfect match, and not when it's excluded
+        self.assertEqual(wallet.select_spends(set(['default']), 100 * coin), [big])
+        self.assertEqual(wallet.select_spends(set(['default']), 100 * coin, dont_select=set([big.hash()])), [])
+
+        # The small coins add up, otherwise the smallest bigger coin
+        self.assertEqual(sum(spend.amount for spend in wallet.select_spends(set(['default']), 2 * coin)), 2 * coin)
+        self.assertEqual(wallet.select_spends(set(['default']), 5 * coin), [big])
+        self.assertEqual(wallet.select_spends(set(['default', 'other']), 5 * coin)[0].amount, 50 * coin)
+
+        # Immature coins become spendable as blocks are added
+        self.assertEqual(wallet.select_spends(set(['default']), 10 * coin), [big])
+        self.spv.txdb.depths[immature.tx_hash] = Bitcoin.TRANSACTION_CONFIRMATION_DEPTH
+        wallet.on_block_added(None, 0)
+        self.assertEqual(wallet.select_spends(set(['default']), 10 * coin), [immature])
+
+        # Only the spendable amounts are indexed, sorted
+        self.assertEqual([amount for amount, _ in wallet.spendable_amounts['default']], [coin] * 3 + [10 * coin, 100 * coin])
+
+        # and can go back with a reorganization
+        self.spv.txdb.depths[immature.tx_hash] = 1
+        wallet.on_block_removed(None, 0)
+        self.assertEqual(wallet.select_spends(set(['default']), 10 * coin), [big])
+
+        # Spending a coin takes it out
+        big.spent = True
+        wallet.update_spend(big)
+        self.assertEqual(wallet.select_spends(set(['default']), 100 * coin), [])
+        self.assertEqual([amount for amount, _ in wallet.spendable_amounts['default']], [coin] * 3)
+
+        # The index is rebuilt on load
+        self.spv.txdb.depths[immature.tx_hash] = Bitcoin.TRANSACTION_CONFIRMATION_DEPTH
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        self.assertEqual(wallet.select_spends(set(['default']), 10 * coin)[0].hash(), immature.hash())
+        self.assertEqual(wallet.select_spends(set(['default']), 100 * coin), [])
+
+    def test_spends(self):
+        wallet = self.load_wallet()
+        spend = self.add_spend(5 * Bitcoin.DUST_LIMIT)
+        self.add_spend(3 * Bitcoin.DUST_LIMIT, category='other')
+        self.assertEqual(wallet.balance, {'default': 5 * Bitcoin.DUST_LIMIT, 'other': 3 * Bitcoin.DUST_LIMIT})
+
+        # Spends are built from the wallet database each time
+        copy = wallet.get_spend(spend.hash())
+        self.assertIsNot(copy, spend)
+        self.assertEqual(copy, spend)
+        self.assertIsNone(wallet.get_spend(os.urandom(32)))
+        self.assertEqual(len(list(wallet.get_spends())), 2)
+
+        copy.spent = True
+        wallet.update_spend(copy)
+        self.assertTrue(wallet.get_spend(spend.hash()).spent)
+        self.assertEqual(wallet.balance['default'], 0)
+
+        # Adding it again only updates it
+        spend.spent = False
+        wallet.add_spend(spend)
+        self.assertEqual(wallet.balance['default'], 5 * Bitcoin.DUST_LIMIT)
+        self.assertEqual(len(wallet.spend_table), 2)
+
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        self.assertEqual(wallet.balance, {'default': 5 * Bitcoin.DUST_LIMIT, 'other': 3 * Bitcoin.DUST_LIMIT})
+
+    def test_snapshot(self):
+        wallet = self.load_wallet(snapshot=True)
+        spends = [self.add_spend(i * Bitcoin.DUST_LIMIT) for i in range(1, 11)]
+        immature = self.add_spend(20 * Bitcoin.DUST_LIMIT, depth=1)
+        wallet.save_snapshot()
+
+        # Only the immature spend is built from the snapshot
+        wallet.walletdb.close()
+        StubSpend.unserialized = 0
+        wallet = self.load_wallet(snapshot=True)
+        self.assertEqual(StubSpend.unserialized, 1)
+        self.assertEqual(wallet.balance['default'], 75 * Bitcoin.DUST_LIMIT)
+        self.assertEqual([amount for amount, _ in wallet.spendable_amounts['default']], [spend.amount for spend in spends])
+        self.assertEqual(wallet.select_spends(set(['default']), 10 * Bitcoin.DUST_LIMIT), [spends[9]])
+        self.assertNotIn(immature, wallet.select_spends(set(['default']), 20 * Bitcoin.DUST_LIMIT))
+
+        # and it still matures
+        self.spv.txdb.depths[immature.tx_hash] = Bitcoin.TRANSACTION_CONFIRMATION_DEPTH
+        wallet.on_block_added(None, 101)
+        self.assertEqual(wallet.select_spends(set(['default']), 20 * Bitcoin.DUST_LIMIT), [immature])
+
+        # A spend saved after the snapshot makes it out of date
+        spends[0].spent = True
+        wallet.update_spend(spends[0])
+        wallet.walletdb.close()
+        StubSpend.unserialized = 0
+        wallet = self.load_wallet(snapshot=True)
+        self.assertEqual(StubSpend.unserialized, 11)
+        self.assertEqual(wallet.balance['default'], 74 * Bitcoin.DUST_LIMIT)
+
+        # and so does a shorter blockchain
+        wallet.save_snapshot()
+        wallet.walletdb.close()
+        self.spv.blockchain.height = 99
+        StubSpend.unserialized = 0
+        wallet = self.load_wallet(snapshot=True)
+        self.assertEqual(StubSpend.unserialized, 11)
+
+    def test_select_spends_bnb(self):
+        wallet = self.load_wallet()
+        coin = Bitcoin.DUST_LIMIT
+        for amount in (3 * coin, 5 * coin, 7 * coin, 11 * coin):
+            self.add_spend(amount)
+        self.add_spend(20 * coin)
+
+        # 3 + 7 is close enough without change, approximate would rather leave change that isn't dust
+        spends = wallet.select_spends(set(['default']), 10 * coin - 1, strategy='bnb')
+        self.assertEqual(sorted(spend.amount for spend in spends), [3 * coin, 7 * coin])
+
+        spends = wallet.select_spends(set(['default']), 10 * coin - 1)
+        self.assertTrue(sum(spend.amount for spend in spends) >= 11 * coin - 1)
+
+        # A target that needs nearly every coin
+        for _ in range(60):
+            self.add_spend(1000000, category='many')
+        spends = wallet.select_spends(set(['many']), 60 * 1000000 - 300000, strategy='bnb')
+        self.assertEqual(len(spends), 60)
+
+    def test_balances(self):
+        wallet = self.load_wallet()
+        depth = Bitcoin.TRANSACTION_CONFIRMATION_DEPTH
+
+        def add_block_spend(amount, height, category='default'):
+            spend = StubBlockSpend(Bitcoin, category, amount, os.urandom(32))
+            self.spv.txdb.heights[spend.tx_hash] = height
+            wallet.add_spend(spend)
+            return spend
+
+        def add_block(height):
+            self.spv.blockchain.height = height
+            wallet.on_block_added(None, height)
+
+        def remove_block(height):
+            self.spv.blockchain.height = height - 1
+            wallet.on_block_removed(None, height)
+
+        def states(category='default'):
+            return wallet.get_balances()[category]
+
+        mature = add_block_spend(1000, 100 - depth + 1)
+        confirming = add_block_spend(2000, 98)
+        unconfirmed = add_block_spend(4000, 0)
+        add_block_spend(8000, 99, category='other')
+        self.assertEqual(states(), {'unconfirmed': 4000, 'confirming': 2000, 'mature': 1000, 'spent': 0})
+        self.assertEqual(wallet.get_balance('default'), 7000)
+        self.assertEqual(wallet.get_balance('other', 'confirming'), 8000)
+        self.assertEqual(wallet.get_spend_state(confirming.hash()), ('confirming', 3, False))
+
+        # Only the unconfirmed spend is looked at until the confirming one matures
+        StubBlockSpend.unserialized = 0
+        add_block(101)
+        self.assertEqual(StubBlockSpend.unserialized, 1)
+        self.spv.txdb.heights[unconfirmed.tx_hash] = 102
+        add_block(102)
+        self.assertEqual(states(), {'unconfirmed': 0, 'confirming': 6000, 'mature': 1000, 'spent': 0})
+
+        add_block(98 + depth - 1)
+        self.assertEqual(states(), {'unconfirmed': 0, 'confirming': 4000, 'mature': 3000, 'spent': 0})
+        self.assertEqual(wallet.select_spends(set(['default']), 2000), [confirming])
+
+        # A reorganization takes the confirmations back
+        remove_block(98 + depth - 1)
+        self.assertEqual(states(), {'unconfirmed': 0, 'confirming': 6000, 'mature': 1000, 'spent': 0})
+        remove_block(102)
+        del self.spv.txdb.heights[unconfirmed.tx_hash]
+        remove_block(101)
+        self.assertEqual(states(), {'unconfirmed': 4000, 'confirming': 2000, 'mature': 1000, 'spent': 0})
+
+        mature.spent = True
+        wallet.update_spend(mature)
+        self.assertEqual(states(), {'unconfirmed': 4000, 'confirming': 2000, 'mature': 0, 'spent': 1000})
+        self.assertEqual(wallet.get_balance('default'), 6000)
+
+        # The balances are the same when the wallet is loaded again
+        balances = wallet.get_balances()
+        wallet.walletdb.close()
+        wallet = self.load_wallet()
+        self.assertEqual(wallet.get_balances(), balances)
+
+    def test_reindex_block(self):
+        wallet = self.load_wallet()
+        self.spv.blockchain.height = 110
+        wallet.on_block_added(None, 110)
+
+        # A rescan finds payments in an old block before the transaction database knows their height
+        found = [StubBlockSpend(Bitcoin, 'default', amount, os.urandom(32)) for amount in (1000, 2000)]
+        for spend in found:
+            wallet.add_spend(spend)
+        other = self.add_spend(4000, depth=0)
+        self.assertEqual(wallet.get_balance('default', 'unconfirmed'), 7000)
+
+        for spend in found:
+            self.spv.txdb.heights[spend.tx_hash] = 50
+        wallet.reindex_block(StubBlock([spend.tx_hash for spend in found]))
+        self.assertEqual(wallet.get_balances()['default'], {'unconfirmed': 4000, 'confirming': 0, 'mature': 3000, 'spent': 0})
+        self.assertEqual(wallet.get_spend_state(found[0].hash()), ('mature', 61, True))
+        self.assertEqual(wallet.get_spend_state(other.hash())[0], 'unconfirmed')
+
+    def test_unsignable_spends(self):
+        wallet = self.load_wallet(monitors=[StubKeyMonitor])
+        self.spv.wallet = wallet
+        spend = StubKeySpend(Bitcoin, 'default', 1000, os.urandom(32))
+        self.spv.txdb.heights[spend.tx_hash] = 50
+        wallet.add_spend(spend)
+        self.assertEqual(wallet.get_spend_state(spend.hash()), ('mature', 51, False))
+        self.assertEqual(wallet.select_spends(set(['default']), 1000), [])
+
+        # More blocks don't make it spendable, so it isn't looked at again for each one
+        StubKeySpend.unserialized = 0
+        self.spv.blockchain.height = 101
+        wallet.on_block_added(None, 101)
+        self.assertEqual(StubKeySpend.unserialized, 0)
+
+        # Nor for items that don't sign with its key
+        wallet.add('private_key', os.urandom(32), {})
+        wallet.add('address', spend.tx_hash, {'label': 'a'})
+        wallet.update('address', spend.tx_hash, {'label': 'b'})
+        self.assertEqual(StubKeySpend.unserialized, 0)
+
+        # but it is for its key
+        wallet.add('private_key', spend.tx_hash, {'label': 'a'})
+        self.assertEqual(StubKeySpend.unserialized, 1)
+        self.assertEqual(wallet.get_spend_state(spend.hash()), ('mature', 52, False))
+
+        # unless only the key's label changed
+        wallet.add_temp('signing_key', spend.tx_hash, {})
+        wallet.update('private_key', spend.tx_hash, {'label': 'b'})
+        self.assertEqual(StubKeySpend.unserialized, 1)
+        self.assertEqual(wallet.get_spend_state(spend.hash()), ('mature', 52, False))
+
+        wallet.update('private_key', spend.tx_hash, {'label': 'b', 'imported': True})
+        self.assertEqual(wallet.get_spend_state(spend.hash()), ('mature', 52, True))
+        self.assertEqual([s.hash() for s in wallet.select_spends(set(['default']), 1000)], [spend.hash()])
+
+class StubBlock:
+    def __init__(self, tx_hashes):
+        self.tx_hashes = tx_hashes
+
+    def get_transaction_hashes(self):
+        return self.tx_hashes
+
+class BlockMonitor(BaseMonitor):
+    '''A monitor written before transactions were classified, that looks at whole blocks'''
+    spend_classes = []
+
+    def __init__(self, spv):
+        BaseMonitor.__init__(self, spv)
+        self.blocks = []
+        self.txs = []
+
+    def on_block(self, block):
+        self.blocks.append(block)
+
+    def on_tx(self, tx):
+        self.txs.append(tx)
+
+class TxMonitor(BaseMonitor):
+    spend_classes = []
+
+    def __init__(self, spv):
+        BaseMonitor.__init__(self, spv)
+        self.txs = []
+
+    def on_tx(self, tx):
+        self.txs.append(tx)
+
+class TestMonitorHandlers(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+
+    def tearDown(self):
+        self.wallet.walletdb.close()
+        shutil.rmtree(self.path)
+
+    def test_on_block_override(self):
+        self.wallet = Wallet(self.spv, monitors=[BlockMonitor, TxMonitor])
+        self.wallet.load()
+        block_monitor, tx_monitor = self.wallet.monitors
+
+        transactions = [Transaction(Bitcoin, outputs=[TransactionOutput(amount=1, script=Script(os.urandom(25)))]) for _ in range(3)]
+        block = Block(Bitcoin, header=BlockHeader(Bitcoin, prev_block_hash=os.urandom(32)), transactions=transactions)
+        self.wallet.on_block(block)
+
+        self.assertEqual(block_monitor.blocks, [block])
+        self.assertEqual(block_monitor.txs, [])
+        self.assertEqual([tx.hash() for tx in tx_monitor.txs], [tx.hash() for tx in transactions])
@@ -0,0 +1,136 @@
+import shelve
+import shutil
+import tempfile
+import threading
+import unittest
+
+from contextlib import closing
+
+from pyspv.walletdb import WalletDatabase
+
+from stubs import StubSPV
+
+class TestWalletDatabase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spv = StubSPV(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_items_and_spends(self):
+        walletdb = WalletDatabase(self.spv)
+        self.assertIsNone(walletdb.get_setting('creation_time'))
+        walletdb.set_setting('creation_time', 1234.5)
+
+        item_ids = [walletdb.add_item('address', 'a{}'.format(i), {'label': str(i)}, 1000 + i) for i in range(10)]
+        walletdb.update_item(item_ids[3], {'label': 'three'})
+        self.assertEqual(walletdb.get_item_metadata(item_ids[3]), {'label': 'three'})
+
+        walletdb.save_spend(b'1', 'Spend', b'one')
+        walletdb.save_spend(b'2', 'Spend', b'two')
+        walletdb.save_spend(b'1', 'Spend', b'one again')
+        walletdb.close()
+
+        walletdb = WalletDatabase(self.spv)
+        self.assertEqual(walletdb.get_setting('creation_time'), 1234.5)
+        items = list(walletdb.get_items())
+        self.assertEqual([item[2] for item in items], ['a{}'.format(i) for i in range(10)])
+        self.assertEqual(items[3], (item_ids[3], 'address', 'a3', {'label': 'three'}, 1003))
+
+        # An updated spend moves to the end
+        self.assertEqual(walletdb.get_spends(), [('Spend', b'two'), ('Spend', b'one again')])
+        walletdb.clear_spends()
+        self.assertEqual(walletdb.get_spends(), [])
+        walletdb.close()
+
+    def test_migrate_shelve(self):
+        with closing(shelve.open(self.spv.config.get_file('wallet'))) as d:
+            d['creation_time'] = 1234.5
+            d['wallet'] = {'address': {'a': {'label': 'x'}, 'b': {}}, 'redemption_script': {b'\x51': {}}}
+            d['spends'] = {b'1': {'class': 'Spend', 'data': b'one'}}
+
+        walletdb = WalletDatabase(self.spv)
+        self.assertEqual(walletdb.get_setting('creation_time'), 1234.5)
+        self.assertEqual(sorted((item[1], item[2], item[3], item[4]) for item in walletdb.get_items()),
+                         [('address', 'a', {'label': 'x'}, None), ('address', 'b', {}, None), ('redemption_script', b'\x51', {}, None)])
+        self.assertEqual(walletdb.get_spends(), [('Spend', b'one')])
+
+        # Only copied once
+        walletdb.add_item('address', 'c', {}, 1000)
+        walletdb.close()
+        walletdb = WalletDatabase(self.spv)
+        self.assertEqual(len(list(walletdb.get_items())), 4)
+        walletdb.close()
+
+    def test_interrupted_migration(self):
+        # The copy fails partway, after the items, on a spend without a class
+        with closing(shelve.open(self.spv.config.get_file('wallet'))) as d:
+            d['wallet'] = {'address': {'a': {}, 'b': {}}}
+            d['spends'] = {b'1': {'data': b'one'}}
+
+        with self.assertRaises(KeyError):
+            WalletDatabase(self.spv)
+
+        # Nothing was kept, not even the tables, so it's copied in full the next time
+        with closing(shelve.open(self.spv.config.get_file('wallet'))) as d:
+            d['spends'] = {b'1': {'class': 'Spend', 'data': b'one'}}
+
+        walletdb = WalletDatabase(self.spv)
+        self.assertEqual(sorted(item[2] for item in walletdb.get_items()), ['a', 'b'])
+        self.assertEqual(walletdb.get_spends(), [('Spend', b'one')])
+        walletdb.close()
+
+    def test_batch(self):
+        walletdb = WalletDatabase(self.spv)
+        with walletdb.batch():
+            item_id = walletdb.add_item('address', 'a', {}, 1000)
+            with walletdb.batch():
+                walletdb.save_spend(b'1', 'Spend', b'one')
+            walletdb.update_item(item_id, {'label': 'a'})
+
+            # Nothing is committed until the outer batch ends
+            other = WalletDatabase(self.spv)
+            self.assertEqual(list(other.get_items()), [])
+            self.assertEqual(other.get_spends(), [])
+
+        self.assertEqual(list(other.get_items()), [(item_id, 'address', 'a', {'label': 'a'}, 1000)])
+        self.assertEqual(other.get_spends(), [('Spend', b'one')])
+        other.close()
+        walletdb.close()
+
+    def test_batch_rollback(self):
+        walletdb = WalletDatabase(self.spv)
+        walletdb.save_spend(b'1', 'Spend', b'one')
+        with self.assertRaises(ValueError):
+            with walletdb.batch():
+                walletdb.save_spend(b'2', 'Spend', b'two')
+                with walletdb.batch():
+                    walletdb.add_item('address', 'a', {}, 1000)
+                    raise ValueError()
+
+        self.assertEqual(walletdb.get_spends(), [('Spend', b'one')])
+        self.assertEqual(list(walletdb.get_items()), [])
+        walletdb.close()
+
+    def test_batch_is_per_thread(self):
+        walletdb = WalletDatabase(self.spv)
+        written = threading.Event()
+
+        def write():
+            walletdb.save_spend(b'2', 'Spend', b'two')
+            written.set()
+
+        with self.assertRaises(ValueError):
+            with walletdb.batch():
+                walletdb.save_spend(b'1', 'Spend', b'one')
+
+                # Another thread's write waits for the batch instead of joining it
+                thread = threading.Thread(target=write)
+                thread.start()
+                self.assertFalse(written.wait(0.2))
+                raise ValueError()
+
+        thread.join()
+        self.assertEqual(walletdb.get_spends(), [('Spend', b'two')])
+        walletdb.close()